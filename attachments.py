@@ -0,0 +1,183 @@
+import os
+import struct
+import threading
+
+from protocol import (ProtocolError, encode_control, CONTROL_ATTACH_START, CONTROL_ATTACH_RESUME,
+                      CONTROL_ATTACH_END)
+
+# Chunk frame payload: transfer id || chunk index || encrypted chunk.
+# The id and index are authenticated as associated data, so chunks cannot
+# be replayed into another transfer or reordered.
+CHUNK_HEADER = struct.Struct("!16sQ")
+CHUNK_SIZE = 256 * 1024
+
+KIND_IMAGE = "image"
+KIND_FILE = "file"
+
+
+def encode_chunk(cipher, transfer_id, index, data):
+    header = CHUNK_HEADER.pack(transfer_id, index)
+    return header + cipher.encrypt(data, aad=header)
+
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+
+class OutgoingTransfer:
+    """A file being streamed to a peer, read one chunk at a time.
+
+    With `data` the content is already in memory: path is None and name
+    is required.
+    """
+
+    def __init__(self, path, kind=KIND_FILE, name=None, chunk_size=CHUNK_SIZE, transfer_id=None,
+                 cleanup=False, data=None):
+        self.path = path
+        self.data = data
+        # Remove the file once it has been sent, for temporary copies
+        self.cleanup = cleanup
+        self.kind = kind
+        self.name = os.path.basename(name or path)
+        self.chunk_size = chunk_size
+        self.id = transfer_id or os.urandom(16)
+        self.size = len(data) if data is not None else os.path.getsize(path)
+        self.chunks = chunk_count(self.size, chunk_size)
+        self.next_index = 0
+        self.resumed = threading.Event()
+
+    def start_message(self):
+        return encode_control(CONTROL_ATTACH_START, id=self.id.hex(), name=self.name, kind=self.kind,
+                              size=self.size, chunk_size=self.chunk_size)
+
+    def end_message(self):
+        return encode_control(CONTROL_ATTACH_END, id=self.id.hex(), chunks=self.chunks)
+
+    def resume_from(self, index):
+        self.next_index = min(max(0, index), self.chunks)
+        self.resumed.set()
+
+    def iter_chunks(self):
+        if self.data is not None:
+            view = memoryview(self.data)
+            while self.next_index < self.chunks:
+                start = self.next_index * self.chunk_size
+                yield self.next_index, view[start:start + self.chunk_size]
+                self.next_index += 1
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.next_index * self.chunk_size)
+            while self.next_index < self.chunks:
+                data = f.read(self.chunk_size)
+                if not data:
+                    raise ProtocolError(f"{self.path} shrank during transfer")
+                yield self.next_index, data
+                self.next_index += 1
+
+    @property
+    def progress(self):
+        return self.next_index / self.chunks if self.chunks else 1.0
+
+    def done(self):
+        if self.cleanup and self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class IncomingTransfer:
+    def __init__(self, spool_dir, msg):
+        self.id = bytes.fromhex(msg["id"])
+        self.name = os.path.basename(str(msg.get("name") or "attachment")) or "attachment"
+        self.kind = msg.get("kind", KIND_FILE)
+        self.size = int(msg["size"])
+        self.chunk_size = int(msg["chunk_size"])
+        if len(self.id) != 16 or self.size < 0 or self.chunk_size <= 0:
+            raise ProtocolError("Invalid attachment header")
+        self.chunks = chunk_count(self.size, self.chunk_size)
+        self.part_path = os.path.join(spool_dir, f"{self.id.hex()}.part")
+        self.path = os.path.join(spool_dir, f"{self.id.hex()}-{self.name}")
+
+        # Resume from whatever whole chunks a previous connection left behind
+        mode = "r+b" if os.path.exists(self.part_path) else "w+b"
+        self.file = open(self.part_path, mode)
+        self.next_index = min(os.path.getsize(self.part_path) // self.chunk_size, self.chunks)
+        self.file.truncate(self.next_index * self.chunk_size)
+        self.file.seek(self.next_index * self.chunk_size)
+        # Set once every chunk has been written and the file moved into place
+        self.complete = False
+
+    def resume_message(self):
+        return encode_control(CONTROL_ATTACH_RESUME, id=self.id.hex(), index=self.next_index)
+
+    def write(self, index, data):
+        # After a missing chunk (one dropped for a slow reader) the rest is
+        # skipped, and asked for again with resume_message() once it ends
+        if index != self.next_index:
+            return
+        self.file.write(data)
+        self.next_index += 1
+
+    def finish(self, chunks):
+        # -> whether it is complete; otherwise the file stays open for a resume
+        if chunks != self.chunks:
+            raise ProtocolError(f"Attachment {self.name} is incomplete")
+        if self.next_index != self.chunks:
+            self.file.flush()
+            return False
+        self.file.close()
+        if os.path.getsize(self.part_path) != self.size:
+            raise ProtocolError(f"Attachment {self.name} is incomplete")
+        os.replace(self.part_path, self.path)
+        self.complete = True
+        return True
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def progress(self):
+        return self.next_index / self.chunks if self.chunks else 1.0
+
+
+class AttachmentReceiver:
+    """Spools incoming chunked transfers to disk, one chunk in memory at a time."""
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.transfers = {}
+
+    def start(self, msg):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        old = self.transfers.pop(str(msg["id"]).lower(), None)
+        if old is not None:
+            old.close()
+        transfer = IncomingTransfer(self.spool_dir, msg)
+        self.transfers[transfer.id.hex()] = transfer
+        return transfer
+
+    def chunk(self, cipher, payload):
+        transfer_id, index = CHUNK_HEADER.unpack_from(payload)
+        transfer = self.transfers.get(transfer_id.hex())
+        if transfer is None:
+            raise ProtocolError("Chunk for unknown transfer")
+        header = payload[:CHUNK_HEADER.size]
+        transfer.write(index, cipher.decrypt(payload[CHUNK_HEADER.size:], aad=bytes(header)))
+        return transfer
+
+    def finish(self, msg):
+        # A transfer still missing chunks is kept; see IncomingTransfer.complete
+        transfer = self.transfers.get(str(msg["id"]).lower())
+        if transfer is None:
+            raise ProtocolError("End of unknown transfer")
+        if transfer.finish(msg.get("chunks")):
+            del self.transfers[transfer.id.hex()]
+        return transfer
+
+    def close(self):
+        # Partial files stay on disk so a reconnecting sender can resume
+        for transfer in self.transfers.values():
+            transfer.close()
+        self.transfers.clear()
+
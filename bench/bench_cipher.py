@@ -0,0 +1,63 @@
+import argparse
+import hashlib
+import hmac
+import os
+import time
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from encryption import MessageCipher, SUITE_CBC_HMAC, SUPPORTED_SUITES
+
+SIZES = [64, 1024, 64 * 1024, 1024 * 1024]
+
+
+def legacy_encrypt(key, mac_key, data):
+    # The original per-call construction, kept here as the baseline
+    iv = os.urandom(16)
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(data) + padder.finalize()
+    ciphertext = encryptor.update(padded) + encryptor.finalize()
+    return iv + hmac.new(mac_key, ciphertext, hashlib.sha256).digest() + ciphertext
+
+
+def measure(func, count):
+    start = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-message vs batched MessageCipher throughput")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--suites", nargs="+", choices=SUPPORTED_SUITES, default=list(SUPPORTED_SUITES))
+    parser.add_argument("--budget", type=int, default=64 * 1024 * 1024,
+                        help="bytes processed per measurement")
+    args = parser.parse_args()
+
+    key = os.urandom(16)
+    # The baseline is cbc-hmac, so it takes its MAC key from that suite
+    legacy_cipher = MessageCipher(key, SUITE_CBC_HMAC)
+    for suite in args.suites:
+        cipher = MessageCipher(key, suite)
+        print(f"\n{suite} ({cipher.overhead} bytes overhead per packet)")
+        print(f"{'size':>9} {'legacy/s':>12} {'encrypt/s':>12} {'encrypt_many/s':>15} "
+              f"{'decrypt/s':>12} {'decrypt_many/s':>15}")
+        for size in args.sizes:
+            count = max(16, min(100000, args.budget // size))
+            messages = [os.urandom(size) for _ in range(min(count, 64))]
+            batch = (messages * (count // len(messages) + 1))[:count]
+            packets = cipher.encrypt_many(batch)
+
+            legacy = measure(lambda: [legacy_encrypt(key, legacy_cipher.mac_key, m) for m in batch], count)
+            single = measure(lambda: [cipher.encrypt(m) for m in batch], count)
+            many = measure(lambda: cipher.encrypt_many(batch), count)
+            dec_single = measure(lambda: [cipher.decrypt(p) for p in packets], count)
+            dec_many = measure(lambda: cipher.decrypt_many(packets), count)
+            print(f"{size:>9} {legacy:>12.0f} {single:>12.0f} {many:>15.0f} "
+                  f"{dec_single:>12.0f} {dec_many:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
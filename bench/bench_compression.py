@@ -0,0 +1,97 @@
+import argparse
+import os
+import random
+import time
+
+from compression import Compressor, SUPPORTED_CODECS, train_dictionary, MIN_COMPRESS_SIZE
+from encryption import MessageCipher, SUITE_AES_GCM
+from protocol import HEADER_SIZE, SEQ_HEADER
+from server_core import history_page
+
+WORDS = ("the a to and you I it is that of for on in this we are be with have at not can just so but what was "
+         "ok yes no lol thanks sure meeting tomorrow today tonight later code review deploy build test bug fix "
+         "branch merge release server client message file image send sent link call lunch coffee weekend").split()
+PHRASES = ("sounds good", "let me know", "see you there", "on my way", "can you take a look",
+           "I pushed a fix", "the build is green again", "did you get my message?", "good morning everyone")
+NAMES = ("alice", "bob", "carol", "dave", "erin", "frank")
+EMOJI = ("😊", "😂", "❤️", "👍", "🎉", "🔥")
+
+
+def chat_message(rng):
+    # Mostly short lines, some paragraphs and pasted links or logs
+    kind = rng.random()
+    if kind < 0.6:
+        parts = [rng.choice(PHRASES)] + rng.choices(WORDS, k=rng.randint(1, 8))
+    elif kind < 0.9:
+        parts = rng.choices(WORDS, k=rng.randint(20, 120)) + [rng.choice(PHRASES)]
+    else:
+        parts = [f"https://example.com/{rng.choice(NAMES)}/{rng.randrange(10 ** 6)}?ref=chat"] + \
+                [f"{rng.choice(('INFO', 'WARN'))} server: {rng.choice(PHRASES)} id={rng.randrange(10 ** 9)}"
+                 for _ in range(rng.randint(1, 30))]
+    if rng.random() < 0.3:
+        parts.append(rng.choice(EMOJI))
+    return " ".join(parts).encode()
+
+
+def sample_page(rng, messages):
+    # As ServerCore.send_history builds it, in parts
+    entries = [{"from": f"Client 127.0.0.1:{rng.randrange(40000, 60000)}", "text": message.decode(),
+                "seq": 1000 + i, "time": 1.7e9 + i} for i, message in enumerate(messages)]
+    return history_page(entries, before=1000 + len(entries), older=True, more=True)
+
+
+def measure(compressor, payloads, cipher, parts=False):
+    # (bytes on the wire, compress us per payload, decompress us per payload)
+    start = time.perf_counter()
+    if not compressor:
+        plaintexts = [b"".join(payload) if parts else payload for payload in payloads]
+    elif parts:
+        plaintexts = [compressor.compress_parts(payload) for payload in payloads]
+    else:
+        plaintexts = [compressor.compress(payload) for payload in payloads]
+    compress_us = (time.perf_counter() - start) * 1e6 / len(payloads)
+    start = time.perf_counter()
+    if compressor:
+        for plaintext in plaintexts:
+            compressor.decompress(plaintext)
+    decompress_us = (time.perf_counter() - start) * 1e6 / len(payloads)
+    wire = sum(HEADER_SIZE + SEQ_HEADER.size + len(cipher.encrypt(plaintext)) for plaintext in plaintexts)
+    return wire, compress_us, decompress_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes on the wire and CPU cost of compression on chat traffic")
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--page", type=int, default=50, help="messages per history page")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    training = [chat_message(rng) for _ in range(5000)]
+    messages = [chat_message(rng) for _ in range(args.messages)]
+    pages = [sample_page(rng, messages[i:i + args.page]) for i in range(0, len(messages), args.page)]
+    dictionary = train_dictionary(training)
+    cipher = MessageCipher(os.urandom(16), SUITE_AES_GCM)
+    print(f"{len(messages)} messages, mean {sum(map(len, messages)) / len(messages):.0f} bytes, "
+          f"{sum(len(m) >= MIN_COMPRESS_SIZE for m in messages) / len(messages):.0%} over the threshold; "
+          f"{len(dictionary)} byte dictionary")
+
+    variants = [("none", None)]
+    for codec in SUPPORTED_CODECS:
+        for safe in (False, True):
+            for with_dict in (False, True):
+                name = f"{codec}{'+dict' if with_dict else ''} {'safe' if safe else 'on'}"
+                variants.append((name, Compressor(codec, dictionary if with_dict else None, safe=safe)))
+
+    for label, payloads, parts in (("messages", messages, False), ("history pages", pages, True)):
+        print(label)
+        baseline = None
+        for name, compressor in variants:
+            wire, compress_us, decompress_us = measure(compressor, payloads, cipher, parts)
+            baseline = baseline or wire
+            print(f"  {name:<16} wire {wire / 1e6:8.2f} MB ({wire / baseline:6.1%})   "
+                  f"compress {compress_us:7.1f} us   decompress {decompress_us:7.1f} us")
+
+
+if __name__ == "__main__":
+    main()
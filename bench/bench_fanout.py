@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+
+from config import ChatConfig, SERVER_IP, PORT
+from encryption import encrypt_message
+from protocol import FrameDecoder, encode_frame, FRAME_TEXT
+from server_core import raise_fd_limit
+
+
+class Receiver(asyncio.BufferedProtocol):
+    def __init__(self, arrivals):
+        self.decoder = FrameDecoder(4096)
+        self.arrivals = arrivals
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        now = time.perf_counter()
+        for _ in self.decoder.frames():
+            self.arrivals.append(now)
+
+
+def resident_kib(pid):
+    # -> VmRSS of pid in KiB, or None where /proc is not available
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    arrivals = []
+    transports = []
+    rss_before = resident_kib(args.server_pid) if args.server_pid else None
+    for i in range(args.connections):
+        transport, _ = await loop.create_connection(lambda: Receiver(arrivals), args.host, args.port)
+        transports.append(transport)
+        if i and i % 1000 == 0:
+            print(f"  {i} connections open")
+    print(f"{len(transports)} idle connections open")
+    if rss_before is not None:
+        await asyncio.sleep(1)
+        grown = resident_kib(args.server_pid) - rss_before
+        print(f"server RSS grew {grown / 1024:.1f} MB, {grown / len(transports):.1f} KiB per connection")
+
+    _, writer = await asyncio.open_connection(args.host, args.port)
+    await asyncio.sleep(1)
+
+    frame = encode_frame(FRAME_TEXT, encrypt_message(ChatConfig.from_env().key, "x" * args.size))
+    latencies = []
+    last_latencies = []
+    for _ in range(args.messages):
+        arrivals.clear()
+        start = time.perf_counter()
+        writer.write(frame)
+        deadline = start + args.timeout
+        while len(arrivals) < args.connections and time.perf_counter() < deadline:
+            await asyncio.sleep(0.0005)
+        sample = [(t - start) * 1000 for t in arrivals]
+        if sample:
+            latencies.extend(sample)
+            last_latencies.append(max(sample))
+        if len(sample) < args.connections:
+            print(f"  only {len(sample)}/{args.connections} receivers got the message")
+
+    writer.close()
+    for transport in transports:
+        transport.close()
+
+    print(f"fan-out latency over {args.messages} messages to {args.connections} peers:")
+    print(f"  per-recipient p50 {percentile(latencies, 50):.2f} ms  p99 {percentile(latencies, 99):.2f} ms")
+    print(f"  last-recipient p50 {percentile(last_latencies, 50):.2f} ms  "
+          f"p99 {percentile(last_latencies, 99):.2f} ms  mean {statistics.mean(last_latencies):.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Idle-connection fan-out latency against a headless server")
+    parser.add_argument("--host", default=SERVER_IP)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--spawn", action="store_true", help="start `python -m server --headless` first")
+    parser.add_argument("--server-pid", type=int, help="report this server's memory per connection "
+                                                        "(set automatically with --spawn)")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    server = None
+    if args.spawn:
+        server = subprocess.Popen([sys.executable, "-m", "server", "--headless",
+                                   "--host", args.host, "--port", str(args.port)])
+        args.server_pid = server.pid
+        time.sleep(1)
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
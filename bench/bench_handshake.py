@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from config import ChatConfig
+from encryption import SUPPORTED_SUITES, SUITE_AES_GCM
+from handshake import ClientHandshake, TicketCache, accept_hello
+from protocol import (HEADER, HEADER_SIZE, encode_frame, decode_control, FRAME_CONTROL, CONTROL_HELLO_RETRY,
+                      CONTROL_WELCOME)
+from server_core import ServerCore
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_server_side(count):
+    # The server's cost per hello, without sockets
+    key = os.urandom(16)
+    tickets = TicketCache(count + 1)
+    room_key = os.urandom(32)
+    client = ClientHandshake(key, SUPPORTED_SUITES)
+    hello = decode_control(client.hello())
+    welcome, _ = accept_hello(key, hello, SUITE_AES_GCM, tickets, room_key)
+    ticket = client.finish(decode_control(welcome)).ticket
+
+    start = time.perf_counter()
+    for _ in range(count):
+        accept_hello(key, hello, SUITE_AES_GCM, tickets, room_key)
+    full = count / (time.perf_counter() - start)
+
+    resumes = []
+    for _ in range(count):
+        client = ClientHandshake(key, SUPPORTED_SUITES, ticket)
+        resumes.append(decode_control(client.hello()))
+        ticket = ticket._replace(id=tickets.issue(ticket.secret))
+    start = time.perf_counter()
+    for hello in resumes:
+        accept_hello(key, hello, SUITE_AES_GCM, tickets, room_key)
+    resumed = count / (time.perf_counter() - start)
+    print(f"server accept_hello          full {full:10,.0f}/s   resumed {resumed:10,.0f}/s")
+
+
+async def read_frame(reader):
+    frame_type, length = HEADER.unpack(await reader.readexactly(HEADER_SIZE))
+    return frame_type, await reader.readexactly(length)
+
+
+async def connect(host, port, ticket=None):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        handshake = ClientHandshake(ChatConfig.from_env().key, SUPPORTED_SUITES, ticket)
+        writer.write(encode_frame(FRAME_CONTROL, handshake.hello()))
+        while True:
+            frame_type, payload = await read_frame(reader)
+            if frame_type != FRAME_CONTROL:
+                continue
+            msg = decode_control(payload)
+            if msg["type"] == CONTROL_HELLO_RETRY:
+                writer.write(encode_frame(FRAME_CONTROL, handshake.retry()))
+            elif msg["type"] == CONTROL_WELCOME:
+                return handshake.finish(msg)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    # Reconnect latency: one client reconnecting back to back
+    for resume in (False, True):
+        session = await connect(args.host, args.port)
+        latencies = []
+        for _ in range(args.reconnects):
+            start = time.perf_counter()
+            session = await connect(args.host, args.port, session.ticket if resume else None)
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert session.resumed == resume
+        print(f"reconnect {'resumed' if resume else 'full':<8}          "
+              f"p50 {percentile(latencies, 50):7.3f} ms   p99 {percentile(latencies, 99):7.3f} ms")
+
+    # Throughput: many clients handshaking at once
+    for resume in (False, True):
+        tickets = [(await connect(args.host, args.port)).ticket if resume else None
+                   for _ in range(args.concurrency)]
+
+        async def client(index):
+            ticket = tickets[index]
+            for _ in range(args.handshakes // args.concurrency):
+                session = await connect(args.host, args.port, ticket if resume else None)
+                ticket = session.ticket
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        total = args.handshakes // args.concurrency * args.concurrency
+        print(f"handshakes {'resumed' if resume else 'full':<8} x{args.concurrency:<4}  "
+              f"{total / elapsed:10,.0f}/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full vs resumed handshake cost and reconnect latency")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23498)
+    parser.add_argument("--reconnects", type=int, default=500)
+    parser.add_argument("--handshakes", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--spawn", action="store_true",
+                        help="run the server in its own process instead of a thread of this one")
+    args = parser.parse_args()
+
+    bench_server_side(args.handshakes)
+    server = None
+    if args.spawn:
+        server = subprocess.Popen([sys.executable, "-m", "server", "--headless", "--host", args.host,
+                                   "--port", str(args.port), "--history-dir", "", "--log", "WARNING"])
+        time.sleep(1)
+    else:
+        core = ServerCore(args.host, args.port, history_dir=None)
+        core.run_in_thread()
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from config import ChatConfig
+from encryption import MessageCipher
+from logs import StructuredFormatter, setup_logging, shutdown_logging
+from protocol import FrameReader, encode_frame, FRAME_TEXT
+from server_core import ServerCore, EVENT_MESSAGE
+
+MODE_LEVELS = {
+    "off": "WARNING",
+    "async": "INFO,server_core=DEBUG",
+    "sync": "INFO,server_core=DEBUG",
+    "trace": "INFO,server_core=TRACE",
+    "legacy": "WARNING",
+}
+MODES = tuple(MODE_LEVELS)
+
+
+def configure(mode, output, core):
+    # Returns a subscriber to remove afterwards, for the legacy print mode
+    setup_logging(MODE_LEVELS[mode], stream=output, trace_sample=0.01)
+    if mode == "sync":
+        # The same records written on the calling thread, for comparison
+        shutdown_logging()
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(StructuredFormatter())
+        logging.getLogger().handlers[:] = [handler]
+    elif mode == "legacy":
+        # What the server used to do: print every message and its hex dump
+        def legacy(event, conn, data):
+            if event == EVENT_MESSAGE:
+                print(f"[SERVER] Decrypted message: {data}", file=output, flush=True)
+                print(f"[SERVER] Encrypted message: {data.encode().hex()}", file=output, flush=True)
+        core.subscribe(legacy)
+        return legacy
+    return None
+
+
+def run(port, count, size):
+    sender = socket.create_connection(("127.0.0.1", port))
+    receiver = socket.create_connection(("127.0.0.1", port))
+    time.sleep(0.2)
+    cipher = MessageCipher(ChatConfig.from_env().key)
+    frames = [encode_frame(FRAME_TEXT, cipher.encrypt(os.urandom(size // 2).hex().encode()))
+              for _ in range(min(count, 1000))]
+    received = threading.Event()
+
+    def receive():
+        for n, _ in enumerate(FrameReader(receiver), 1):
+            if n == count:
+                received.set()
+                return
+
+    threading.Thread(target=receive, daemon=True).start()
+    start = time.perf_counter()
+    for i in range(count):
+        sender.sendall(frames[i % len(frames)])
+    if not received.wait(120):
+        raise TimeoutError("Not every message arrived")
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    time.sleep(0.2)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay throughput with logging off, async, sync and legacy prints")
+    parser.add_argument("--messages", type=int, default=50_000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 16 * 1024, 1024 * 1024])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--port", type=int, default=23499)
+    args = parser.parse_args()
+
+    core = ServerCore("127.0.0.1", args.port, history_dir=None, queue_size=args.messages + 16)
+    core.run_in_thread()
+    with tempfile.TemporaryFile("w") as output:
+        for size in args.sizes:
+            # Keep each run to roughly the same number of bytes
+            count = max(100, min(args.messages, 256 * 1024 * 1024 // size))
+            print(f"{count} messages of {size} bytes")
+            for mode in args.modes:
+                subscriber = configure(mode, output, core)
+                elapsed = run(args.port, count, size)
+                if subscriber is not None:
+                    core.subscribers.remove(subscriber)
+                print(f"  {mode:<7} {count / elapsed:12,.0f} msg/s  {count * size / elapsed / 1e6:9.1f} MB/s  "
+                      f"log output {output.tell() / 1e6:9.1f} MB")
+                output.seek(0)
+                output.truncate()
+    shutdown_logging()
+    core.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
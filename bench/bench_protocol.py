@@ -0,0 +1,55 @@
+import argparse
+import socket
+import threading
+import time
+
+from protocol import FrameReader, send_frame, FRAME_TEXT
+
+
+def sender(port, count, payload):
+    sock = socket.create_connection(("127.0.0.1", port))
+    for _ in range(count):
+        send_frame(sock, FRAME_TEXT, payload)
+    sock.close()
+
+
+def run(count, size):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    payload = b"x" * size
+    thread = threading.Thread(target=sender, args=(port, count, payload), daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    conn, _ = listener.accept()
+
+    received = 0
+    total_bytes = 0
+    for _, data in FrameReader(conn):
+        received += 1
+        total_bytes += len(data)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    listener.close()
+    thread.join()
+
+    if received != count:
+        raise RuntimeError(f"expected {count} frames, got {received}")
+    print(f"{size:>9} B x {count:>7}: {count / elapsed:>10.0f} frames/s  "
+          f"{total_bytes / elapsed / 1e6:>8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Back-to-back frame throughput over loopback")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 64 * 1024, 1024 * 1024])
+    args = parser.parse_args()
+    for size in args.sizes:
+        # Keep the total transfer bounded for the large sizes
+        run(max(10, min(args.count, (512 * 1024 * 1024) // size)), size)
+
+
+if __name__ == "__main__":
+    main()
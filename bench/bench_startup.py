@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from config import ENV_HOST, ENV_PORT
+from headless_client import connect
+
+# What each entry point imports, as `python -X importtime` sees it
+ENTRY_POINTS = ("server_core", "headless_client", "server", "client")
+HEAVY_MODULES = ("tkinter", "PIL", "emoji", "multiprocessing")
+
+HEADLESS_SENDER = """
+import asyncio
+import headless_client
+
+async def main():
+    client = await headless_client.connect()
+    client.send_text("startup")
+    client.close()
+
+asyncio.run(main())
+"""
+
+GUI_SENDER = """
+import tkinter as tk
+import client
+
+root = tk.Tk()
+app = client.ChatClient(root)
+app.entry.insert(0, "startup")
+app.send_msg()
+root.after(100, app.close_chat)
+root.mainloop()
+"""
+
+
+def import_profile(module):
+    # -> (cumulative import time in ms, {module: self time in ms}) for one cold interpreter
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True)
+    self_times, total = {}, 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        self_times[name.strip()] = int(self_us) / 1000
+        if name.strip() == module:
+            total = int(cumulative_us) / 1000
+    return total, self_times
+
+
+def report_imports(runs):
+    print(f"import time, median of {runs} cold interpreters:")
+    for module in ENTRY_POINTS:
+        profiles = [import_profile(module) for _ in range(runs)]
+        total = statistics.median(total for total, _ in profiles)
+        loaded = profiles[0][1]
+        heavy = [name for name in HEAVY_MODULES if name in loaded]
+        slowest = sorted(loaded.items(), key=lambda item: item[1], reverse=True)[:3]
+        print(f"  {module:<16} {total:7.1f} ms   loads {', '.join(heavy) or 'none of ' + '/'.join(HEAVY_MODULES)}")
+        print(f"  {'':<16} slowest: " + ", ".join(f"{name} {ms:.1f} ms" for name, ms in slowest))
+
+
+async def first_message(args, script, runs):
+    # Process start to the server delivering its first message to a listener
+    arrivals = asyncio.Queue()
+    listener = await connect(args.host, args.port,
+                             on_text=lambda seq, sender, text: arrivals.put_nowait(time.perf_counter()))
+    env = dict(os.environ, **{ENV_HOST: args.host, ENV_PORT: str(args.port)})
+    times = []
+    try:
+        for _ in range(runs):
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(sys.executable, "-c", script, env=env)
+            try:
+                times.append((await asyncio.wait_for(arrivals.get(), args.timeout) - start) * 1000)
+            except asyncio.TimeoutError:
+                print("  no message arrived")
+            await process.wait()
+    finally:
+        listener.close()
+    return times
+
+
+async def run(args):
+    # Waits for a spawned server to listen
+    deadline = time.perf_counter() + args.timeout
+    while True:
+        try:
+            (await connect(args.host, args.port)).close()
+            break
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+    print(f"cold start to first message delivered, median of {args.runs}:")
+    senders = [("headless client", HEADLESS_SENDER)]
+    if os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin"):
+        senders.append(("Tk client", GUI_SENDER))
+    else:
+        print("  (no display; skipping the Tk client, try xvfb-run)")
+    for name, script in senders:
+        times = await first_message(args, script, args.runs)
+        if times:
+            print(f"  {name:<16} {statistics.median(times):7.1f} ms   min {min(times):7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of each entry point and cold start to first message")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23498)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--imports-only", action="store_true", help="skip the cold start measurements")
+    args = parser.parse_args()
+
+    report_imports(args.runs)
+    if args.imports_only:
+        return
+    server = subprocess.Popen([sys.executable, "-m", "server", "--headless", "--host", args.host,
+                               "--port", str(args.port), "--history-dir", "", "--replay", "0", "--log", "WARNING"])
+    try:
+        asyncio.run(run(args))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
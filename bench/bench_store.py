@@ -0,0 +1,91 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from message_store import MessageStore
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(label, samples):
+    print(f"  {label:<28} p50 {percentile(samples, 50) * 1000:8.3f} ms  "
+          f"p99 {percentile(samples, 99) * 1000:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MessageStore append throughput and range-read latency")
+    parser.add_argument("--records", type=int, nargs="+", default=[100_000, 1_000_000],
+                        help="store sizes to measure, e.g. 10000000")
+    parser.add_argument("--size", type=int, default=120, help="payload bytes per record")
+    parser.add_argument("--page", type=int, default=100, help="records per range read")
+    parser.add_argument("--reads", type=int, default=1000)
+    parser.add_argument("--no-fsync", action="store_true")
+    parser.add_argument("--dir", help="where to create the store (default: a temporary directory)")
+    args = parser.parse_args()
+
+    key = os.urandom(16)
+    payload = b"x" * args.size
+    for records in args.records:
+        directory = tempfile.mkdtemp(prefix="bench_store_", dir=args.dir)
+        try:
+            print(f"{records} records of {args.size} bytes")
+            store = MessageStore(directory, key, fsync=not args.no_fsync)
+            start = time.perf_counter()
+            base = time.time()
+            for i in range(records):
+                store.append(payload, timestamp=base + i / 1000)
+            store.sync()
+            elapsed = time.perf_counter() - start
+            print(f"  append                       {records / elapsed:12,.0f} records/s  "
+                  f"{records * args.size / elapsed / 1e6:8.1f} MB/s  "
+                  f"{store.commits} commits ({records / store.commits:,.0f} records each)")
+
+            commits = []
+            for _ in range(200):
+                start = time.perf_counter()
+                store.append(payload)
+                store.sync()
+                commits.append(time.perf_counter() - start)
+            report("single append until durable", commits)
+            store.close()
+
+            start = time.perf_counter()
+            store = MessageStore(directory, key, fsync=not args.no_fsync)
+            print(f"  reopen and rebuild index     {time.perf_counter() - start:12.3f} s  "
+                  f"{len(store.index_offset)} index entries")
+
+            samples = []
+            for _ in range(args.reads):
+                lo = random.randint(1, max(1, records - args.page))
+                start = time.perf_counter()
+                store.read_range(lo, lo + args.page)
+                samples.append(time.perf_counter() - start)
+            report(f"range read of {args.page}", samples)
+
+            samples = []
+            for _ in range(args.reads):
+                at = base + random.uniform(0, records / 1000)
+                start = time.perf_counter()
+                store.read_time_range(at, at + args.page / 1000)
+                samples.append(time.perf_counter() - start)
+            report(f"time range read of {args.page}", samples)
+
+            samples = []
+            for _ in range(args.reads):
+                start = time.perf_counter()
+                store.latest(50)
+                samples.append(time.perf_counter() - start)
+            report("latest 50 (replay)", samples)
+            store.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import io
+import os
+import statistics
+import tempfile
+import time
+
+from image_cache import THUMBNAIL_SIZE
+from transcode import Transcoder, transcode, FORMAT_JPEG, FORMAT_WEBP
+
+
+def photo(width, height, seed):
+    # Smooth gradients with grain, which encode roughly like a camera photo rather than like noise or flat colour
+    from PIL import Image, ImageFilter
+
+    small = Image.effect_noise((width // 64, height // 64), 80).convert("RGB")
+    small = small.point(lambda v: (v * 7 + seed * 31) % 256)
+    base = small.resize((width, height), Image.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+    grain = Image.effect_noise((width, height), 12).convert("RGB")
+    return Image.blend(base, grain, 0.15)
+
+
+def make_original(path, megapixels, seed):
+    from PIL import Image
+
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    img = photo(width, width * 3 // 4, seed)
+    exif = Image.Exif()
+    exif[0x010F] = "Camera"
+    exif[0x0112] = 1
+    img.save(path, format="JPEG", quality=92, exif=exif.tobytes())
+
+
+def receiver_decode_ms(data, runs):
+    # What the receiving ChatView does before showing an image: decode to a thumbnail
+    from PIL import Image
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", THUMBNAIL_SIZE)
+        img.thumbnail(THUMBNAIL_SIZE)
+        img.load()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def legacy(path):
+    # The old send_image: the file as it is, or re-saved at quality 50 if over 1 MiB
+    from PIL import Image
+
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) > 1024 * 1024:
+        out = io.BytesIO()
+        Image.open(path).save(out, format="JPEG", quality=50)
+        data = out.getvalue()
+    return data, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sender-side image transcoding: encode time, bytes sent "
+                                                 "and receiver decode time")
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[2, 12, 48])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in args.megapixels:
+            path = os.path.join(directory, f"photo-{megapixels}.jpg")
+            make_original(path, megapixels, seed=int(megapixels))
+            print(f"{megapixels:g} MP photo, {os.path.getsize(path) / 1e6:.1f} MB")
+
+            data, encode_ms = legacy(path)
+            print(f"  {'legacy quality=50':<26} encode {encode_ms:8.1f} ms   sent {len(data) / 1e3:9.1f} kB   "
+                  f"receiver decode {receiver_decode_ms(data, args.runs):7.1f} ms")
+            variants = [(f"{fmt} preview", False, fmt, None) for fmt in (FORMAT_JPEG, FORMAT_WEBP)]
+            variants += [(f"jpeg preview + {fmt} full", True, FORMAT_JPEG, fmt) for fmt in (FORMAT_JPEG, FORMAT_WEBP)]
+            for label, full, preview_format, full_format in variants:
+                results = [transcode(path, full, preview_format, full_format) for _ in range(args.runs)]
+                image = results[0]
+                sent = len(image.preview) + (len(image.full) if full else 0)
+                print(f"  {label:<26} encode {statistics.median(r.encode_ms for r in results):8.1f} ms   "
+                      f"sent {sent / 1e3:9.1f} kB   "
+                      f"receiver decode {receiver_decode_ms(image.preview, args.runs):7.1f} ms   "
+                      f"(preview {len(image.preview) / 1e3:.1f} kB)")
+
+        # The pool hides the work from the UI thread, at a one-off cost to start its processes
+        path = os.path.join(directory, f"photo-{args.megapixels[0]}.jpg")
+        transcoder = Transcoder()
+        try:
+            for attempt in ("first image (starts the pool)", "next image"):
+                start = time.perf_counter()
+                future = transcoder.submit(path)
+                submit_ms = (time.perf_counter() - start) * 1000
+                future.result()
+                print(f"pool, {attempt:<30} UI thread {submit_ms:6.2f} ms   "
+                      f"ready after {(time.perf_counter() - start) * 1000:8.1f} ms")
+        finally:
+            transcoder.shutdown()
+
+
+if __name__ == "__main__":
+    main()
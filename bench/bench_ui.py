@@ -0,0 +1,77 @@
+import argparse
+import resource
+import threading
+import time
+import tkinter as tk
+
+from chat_view import UIDispatcher, ChatView
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+
+def feed(chat, rate, duration, done):
+    # Post messages from a background thread the way the receive loop does
+    interval = 0.01
+    per_interval = max(1, int(rate * interval))
+    sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for _ in range(per_interval):
+            chat.add_message("Bench", f"message {sent} :thumbs_up:", bubble_color="green", align="left")
+            sent += 1
+        time.sleep(max(0.0, start + sent / rate - time.perf_counter()))
+    done.append(sent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UI tick cost while receiving a message burst "
+                                                 "(run under Xvfb for a headless machine)")
+    parser.add_argument("--rate", type=int, default=1000, help="messages per second")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--show", action="store_true", help="keep the window mapped")
+    args = parser.parse_args()
+
+    root = tk.Tk()
+    if not args.show:
+        root.withdraw()
+    text = tk.Text(root, height=25, width=70, wrap=tk.WORD)
+    text.pack()
+    text.config(state=tk.DISABLED)
+    ui = UIDispatcher(root)
+    chat = ChatView(ui, text)
+    ui.start()
+
+    # Measure how late a 16 ms frame timer fires while the burst is drawn
+    frame_gaps = []
+    last = [time.perf_counter()]
+
+    def frame():
+        now = time.perf_counter()
+        frame_gaps.append(now - last[0])
+        last[0] = now
+        root.after(16, frame)
+
+    done = []
+    threading.Thread(target=feed, args=(chat, args.rate, args.duration, done), daemon=True).start()
+    root.after(16, frame)
+    root.after(int(args.duration * 1000) + 500, root.quit)
+    root.mainloop()
+
+    ticks = [t * 1000 for t in ui.tick_times]
+    gaps = [g * 1000 for g in frame_gaps[1:]]
+    print(f"messages posted: {done[0] if done else 'incomplete'}, left pending: {len(chat.pending)}, "
+          f"in widget: {chat.hi - chat.lo}")
+    print(f"tick cost     p50 {percentile(ticks, 50):6.2f} ms  p99 {percentile(ticks, 99):6.2f} ms  "
+          f"max {max(ticks, default=0):6.2f} ms")
+    print(f"frame period  p50 {percentile(gaps, 50):6.2f} ms  p99 {percentile(gaps, 99):6.2f} ms  "
+          f"max {max(gaps, default=0):6.2f} ms")
+    print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    chat.close()
+    root.destroy()
+
+
+if __name__ == "__main__":
+    main()
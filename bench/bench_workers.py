@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from config import ChatConfig
+from encryption import SUPPORTED_SUITES
+from handshake import ClientHandshake
+from protocol import HEADER, HEADER_SIZE, encode_frame, decode_control, FRAME_CONTROL, FRAME_TEXT
+
+
+async def connect(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    handshake = ClientHandshake(ChatConfig.from_env().key, SUPPORTED_SUITES)
+    writer.write(encode_frame(FRAME_CONTROL, handshake.hello()))
+    while True:
+        frame_type, length = HEADER.unpack(await reader.readexactly(HEADER_SIZE))
+        payload = await reader.readexactly(length)
+        if frame_type == FRAME_CONTROL:
+            return reader, writer, handshake.finish(decode_control(payload))
+
+
+async def count_text(reader, expected, done):
+    received = 0
+    try:
+        while received < expected:
+            frame_type, length = HEADER.unpack(await reader.readexactly(HEADER_SIZE))
+            await reader.readexactly(length)
+            if frame_type == FRAME_TEXT:
+                received += 1
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        done.append((received, time.perf_counter()))
+
+
+async def load(args):
+    # Every client sends `messages` messages and receives everyone else's
+    clients = [await connect(args.host, args.port) for _ in range(args.clients)]
+    await asyncio.sleep(0.5)
+    expected = args.messages * (args.clients - 1)
+    done = []
+    readers = [asyncio.create_task(count_text(reader, expected, done)) for reader, _, _ in clients]
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        for _, writer, session in clients:
+            writer.write(encode_frame(FRAME_TEXT, session.cipher.encrypt(os.urandom(args.size // 2).hex().encode())))
+        await asyncio.gather(*(writer.drain() for _, writer, _ in clients))
+    try:
+        await asyncio.wait_for(asyncio.gather(*readers), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    for _, writer, _ in clients:
+        writer.close()
+    delivered = sum(received for received, _ in done)
+    elapsed = max((finished for _, finished in done), default=time.perf_counter()) - start
+    return delivered, expected * args.clients, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate delivery rate of the server with 1..N worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23497)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=200, help="messages sent by each client")
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores; {args.clients} clients each sending {args.messages} messages of {args.size} bytes")
+    for workers in args.workers:
+        server = subprocess.Popen([sys.executable, "-m", "server", "--headless", "--host", args.host,
+                                   "--port", str(args.port), "--workers", str(workers), "--history-dir", "",
+                                   "--queue-size", str(args.messages * args.clients), "--log", "WARNING"])
+        try:
+            time.sleep(2)
+            delivered, expected, elapsed = asyncio.run(load(args))
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"  {workers:>2} workers  {delivered / elapsed:12,.0f} deliveries/s   "
+              f"{args.messages * args.clients / elapsed:10,.0f} messages/s   delivered {delivered / expected:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import socket
+import threading
+import time
+
+from protocol import FrameReader, FrameWriter, send_frame, FRAME_TEXT
+
+MODES = ("send_frame", "writer", "writer-nowait")
+
+
+def burst(mode, sock, count, payload, bursts, latency):
+    # Sends `bursts` bursts of count / bursts frames, 10 ms apart; returns
+    # the syscalls made and the idle time slept between bursts
+    per_burst = count // bursts
+    idle = 0.0
+    writer = None if mode == "send_frame" else FrameWriter(sock, latency=0.0 if mode == "writer-nowait" else latency)
+    for n in range(bursts):
+        if n:
+            start = time.perf_counter()
+            time.sleep(0.01)
+            idle += time.perf_counter() - start
+        for _ in range(per_burst):
+            if writer is None:
+                send_frame(sock, FRAME_TEXT, payload)
+            else:
+                writer.send(FRAME_TEXT, payload)
+    if writer is None:
+        # A header and a payload sendall each
+        return 2 * per_burst * bursts, idle
+    writer.close()
+    return writer.stats()["syscalls"], idle
+
+
+def run(mode, count, size, bursts, latency):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    sock = socket.create_connection(listener.getsockname())
+    conn, _ = listener.accept()
+    total = count // bursts * bursts
+    received = []
+
+    def receive():
+        for n, _ in enumerate(FrameReader(conn), 1):
+            if n == total:
+                received.append(time.perf_counter())
+                return
+
+    thread = threading.Thread(target=receive, daemon=True)
+    thread.start()
+    payload = b"x" * size
+    start = time.perf_counter()
+    syscalls, idle = burst(mode, sock, count, payload, bursts, latency)
+    thread.join(60)
+    # Idle gaps between bursts are not counted
+    elapsed = max(received[0] - start - idle, 1e-9)
+    sock.close()
+    conn.close()
+    listener.close()
+    print(f"  {mode:<15} {total / elapsed:12,.0f} frames/s   syscalls/frame {syscalls / total:6.3f}   "
+          f"bytes/syscall {total * (size + 9) / syscalls:10,.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bursts of frames: a write per frame vs batched vectored writes")
+    parser.add_argument("--count", type=int, default=100_000)
+    parser.add_argument("--bursts", type=int, default=100)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 16 * 1024])
+    parser.add_argument("--latency", type=float, default=0.001, help="the writer's batching budget in seconds")
+    args = parser.parse_args()
+    for size in args.sizes:
+        count = max(args.bursts, min(args.count, 256 * 1024 * 1024 // size))
+        print(f"{count} frames of {size} bytes in {args.bursts} bursts")
+        for mode in MODES:
+            run(mode, count, size, args.bursts, args.latency)
+
+
+if __name__ == "__main__":
+    main()
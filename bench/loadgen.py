@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from attachments import KIND_IMAGE
+from config import SERVER_IP, PORT
+from headless_client import connect
+from protocol import CONTROL_ATTACH_END
+from server_core import raise_fd_limit
+
+# Load generator clients connect this many at a time
+CONNECT_CONCURRENCY = 200
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram:
+    """Latencies in log-linear buckets, in the style of HdrHistogram.
+
+    Values below 2**bits are counted exactly; above that every power of
+    two is split into 2**(bits - 1) equal buckets, so a reported
+    percentile is never more than 1/2**(bits - 1) above the true value
+    while memory stays a few hundred buckets whatever the range.
+    """
+
+    def __init__(self, bits=7):
+        self.bits = bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        value = max(0, int(value))
+        shift = max(0, value.bit_length() - self.bits)
+        lower = value >> shift << shift
+        self.counts[lower] = self.counts.get(lower, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, pct):
+        # The highest value in the bucket holding the pct-th percentile
+        if not self.count:
+            return None
+        rank = max(1, round(self.count * pct / 100))
+        seen = 0
+        for lower in sorted(self.counts):
+            seen += self.counts[lower]
+            if seen >= rank:
+                width = 1 << max(0, lower.bit_length() - self.bits)
+                return min(lower + width - 1, self.max)
+        return self.max
+
+    def summary(self):
+        result = {"count": self.count, "min": self.min, "max": self.max,
+                  "mean": round(self.total / self.count, 1) if self.count else None}
+        for pct in PERCENTILES:
+            result[f"p{pct:g}".replace(".", "")] = self.percentile(pct)
+        return result
+
+
+class Load:
+    """Shared state of one run: what was sent and received, and when."""
+
+    def __init__(self, args):
+        self.args = args
+        self.text_latency = Histogram()
+        self.image_latency = Histogram()
+        self.window = None
+        self.sent = {"text": 0, "images": 0}
+        self.connected = self.failed = self.disconnected = 0
+        # Incoming image ids -> send time, between attach_start and attach_end
+        self.pending_images = {}
+        # One random blob; messages are slices of it, so they compress like chat and not like padding
+        self.blob = os.urandom(32 * 1024).hex().encode()
+
+    def measuring(self, sent_ns):
+        return self.window is not None and self.window[0] <= sent_ns < self.window[1]
+
+    def on_text(self, seq, sender, text):
+        sent_ns = int(text.split(" ", 1)[0])
+        if self.measuring(sent_ns):
+            self.text_latency.record((time.perf_counter_ns() - sent_ns) // 1000)
+
+    def on_attachment(self, event, msg):
+        # Image names carry their send time; latency is taken when the last chunk is in
+        if event != CONTROL_ATTACH_END:
+            if msg["name"].startswith("load-"):
+                self.pending_images[msg["id"]] = int(msg["name"][5:].split(".")[0])
+            return
+        sent_ns = self.pending_images.pop(msg["id"], None)
+        if sent_ns is not None and self.measuring(sent_ns):
+            self.image_latency.record((time.perf_counter_ns() - sent_ns) // 1000)
+
+    def message(self, index):
+        size = max(self.args.size, 32)
+        offset = random.randrange(len(self.blob) - size)
+        header = b"%d %d " % (time.perf_counter_ns(), index)
+        return header + self.blob[offset:offset + size - len(header)]
+
+
+async def open_client(load, index, gate):
+    args = load.args
+    probe = index < args.probes
+    options = {"compress": not args.no_compress}
+    if probe:
+        options.update(on_text=load.on_text, on_attachment=load.on_attachment)
+    async with gate:
+        try:
+            client = await connect(args.host, args.port, **options)
+        except (OSError, asyncio.TimeoutError) as e:
+            load.failed += 1
+            if load.failed <= 3:
+                print(f"  client {index} failed to connect: {e!r}")
+            return None
+    load.connected += 1
+    return client
+
+
+async def drive(load, client, index, image_path, stop_at):
+    # Poisson arrivals: the clients together send about args.rate messages a second
+    args = load.args
+    mean_gap = args.clients / args.rate
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(random.expovariate(1 / mean_gap))
+        if loop.time() >= stop_at or client.closed.done():
+            return
+        if image_path is not None and random.random() < args.image_ratio:
+            load.sent["images"] += 1
+            try:
+                await client.send_file(image_path, KIND_IMAGE, name=f"load-{time.perf_counter_ns()}.bin")
+            except (OSError, asyncio.TimeoutError, ConnectionError):
+                break
+        else:
+            load.sent["text"] += 1
+            client.send_text(load.message(index))
+            await client.drain()
+
+
+async def run(args):
+    load = Load(args)
+    gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    start = time.perf_counter()
+    clients = await asyncio.gather(*(open_client(load, i, gate) for i in range(args.clients)))
+    clients = [client for client in clients if client is not None]
+    print(f"{load.connected} clients connected in {time.perf_counter() - start:.1f}s ({load.failed} failed)")
+    if not clients:
+        return None
+
+    image_path = None
+    if args.image_ratio > 0:
+        fd, image_path = tempfile.mkstemp(suffix=".bin", prefix="loadgen-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(args.image_size))
+
+    loop = asyncio.get_running_loop()
+    # Warm-up traffic is sent but not measured; sends stop at the end of the window
+    begin = loop.time()
+    stop_at = begin + args.warmup + args.duration
+    drivers = [loop.create_task(drive(load, client, i, image_path, stop_at)) for i, client in enumerate(clients)]
+    await asyncio.sleep(args.warmup)
+    received_before = sum(client.frames_received for client in clients)
+    bytes_before = sum(client.bytes_received for client in clients)
+    sent_before = dict(load.sent)
+    now_ns = time.perf_counter_ns()
+    load.window = (now_ns, now_ns + int(args.duration * 1e9))
+    await asyncio.sleep(args.duration)
+    elapsed = loop.time() - begin - args.warmup
+    received = sum(client.frames_received for client in clients) - received_before
+    received_bytes = sum(client.bytes_received for client in clients) - bytes_before
+    sent = {kind: load.sent[kind] - sent_before[kind] for kind in load.sent}
+    await asyncio.gather(*drivers, return_exceptions=True)
+    # Stragglers sent inside the window still count towards latency
+    await asyncio.sleep(args.drain)
+
+    load.disconnected = sum(client.closed.done() for client in clients)
+    for client in clients:
+        client.close()
+    if image_path is not None:
+        os.remove(image_path)
+
+    recipients = len(clients) - 1
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "system": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "clients": {"connected": load.connected, "failed": load.failed, "disconnected": load.disconnected},
+        "sent": sent,
+        "duration": round(elapsed, 3),
+        "throughput": {
+            "messages_per_s": round(sum(sent.values()) / elapsed, 1),
+            "frames_received_per_s": round(received / elapsed, 1),
+            "bytes_received_per_s": round(received_bytes / elapsed),
+            # Texts delivered to every other client; images are many chunk frames, so only texts count here
+            "expected_text_deliveries_per_s": round(sent["text"] * recipients / elapsed, 1),
+        },
+        "latency_us": {"text": load.text_latency.summary(), "image": load.image_latency.summary()},
+    }
+
+
+def compare(result, baseline):
+    # Relative change of the headline numbers against an earlier run
+    rows = [("messages/s", ("throughput", "messages_per_s")),
+            ("frames received/s", ("throughput", "frames_received_per_s"))]
+    for kind in ("text", "image"):
+        for pct in ("p50", "p99", "p999"):
+            rows.append((f"{kind} {pct} us", ("latency_us", kind, pct)))
+    print("against baseline:")
+    for label, path in rows:
+        old, new = baseline, result
+        for key in path:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if old and new is not None:
+            print(f"  {label:<20} {old:>12,} -> {new:>12,}  ({new / old - 1:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Many headless clients against a server: throughput and "
+                                                 "end-to-end latency, written as JSON")
+    parser.add_argument("--host", default=SERVER_IP)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--probes", type=int, default=20,
+                        help="clients that decrypt what they receive and record latency")
+    parser.add_argument("--rate", type=float, default=50.0, help="messages per second from all clients together")
+    parser.add_argument("--size", type=int, default=200, help="text message size in bytes")
+    parser.add_argument("--image-ratio", type=float, default=0.0, help="fraction of messages that are images")
+    parser.add_argument("--image-size", type=int, default=64 * 1024)
+    parser.add_argument("--no-compress", action="store_true", help="do not offer compression")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds of unmeasured traffic first")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for late deliveries")
+    parser.add_argument("--output", default="loadgen.json", help='JSON results file ("-" for stdout)')
+    parser.add_argument("--baseline", help="an earlier results file to compare against")
+    parser.add_argument("--spawn", action="store_true", help="start `python -m server --headless` first")
+    parser.add_argument("--server-args", default="", help="extra arguments for the spawned server")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    server = None
+    if args.spawn:
+        server = subprocess.Popen([sys.executable, "-m", "server", "--headless", "--host", args.host,
+                                   "--port", str(args.port), "--history-dir", "", "--log", "WARNING",
+                                   *args.server_args.split()])
+        time.sleep(1)
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if result is None:
+        sys.exit(1)
+
+    throughput, latency = result["throughput"], result["latency_us"]
+    print(f"{result['sent']['text']} texts and {result['sent']['images']} images in {result['duration']}s: "
+          f"{throughput['messages_per_s']:,} messages/s, {throughput['frames_received_per_s']:,} frames received/s")
+    for kind, summary in latency.items():
+        if summary["count"]:
+            print(f"  {kind:<5} latency  p50 {summary['p50']:>9,} us  p99 {summary['p99']:>9,} us  "
+                  f"p99.9 {summary['p999']:>9,} us  max {summary['max']:>9,} us  ({summary['count']} samples)")
+    if result["clients"]["disconnected"]:
+        print(f"  {result['clients']['disconnected']} clients were disconnected")
+
+    text = json.dumps(result, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import logging
+import queue
+import sqlite3
+import time
+import tkinter as tk
+from collections import deque
+from datetime import datetime
+
+from image_cache import ThumbnailLoader, PhotoCache
+
+TICK_MS = 15
+# Leave the rest of a 16 ms frame for Tk to redraw
+TICK_BUDGET = 0.008
+MAX_ENTRIES_PER_FLUSH = 500
+
+# Messages kept in the Text widget; older ones live in the history buffer
+MAX_VISIBLE_ENTRIES = 500
+PAGE_ENTRIES = 100
+INSERT_MARK = "history_insert"
+
+BUBBLE_COLORS = ("blue", "green", "red")
+ALIGNS = ("left", "right", "center")
+
+log = logging.getLogger(__name__)
+
+
+def emojize(text):
+    # Only :shortcodes: are replaced, so the emoji package and its large
+    # table are not loaded until a message has a colon in it
+    if ":" not in text:
+        return text
+    import emoji
+    return emoji.emojize(text)
+
+
+class UIDispatcher:
+    """Runs work posted from any thread on the Tk main loop.
+
+    Network threads call post(); an after() tick drains the queue within a
+    time budget and then runs the flush hooks, which batch their own widget
+    updates. Nothing but this tick touches Tk.
+    """
+
+    def __init__(self, root, tick_ms=TICK_MS, budget=TICK_BUDGET):
+        self.root = root
+        self.tick_ms = tick_ms
+        self.budget = budget
+        self.queue = queue.SimpleQueue()
+        self.flush_hooks = []
+        self.tick_times = deque(maxlen=4096)
+        self.running = False
+
+    def post(self, func, *args):
+        self.queue.put((func, args))
+
+    def add_flush_hook(self, hook):
+        self.flush_hooks.append(hook)
+
+    def start(self):
+        self.running = True
+        self.root.after(self.tick_ms, self.tick)
+
+    def stop(self):
+        self.running = False
+
+    def tick(self):
+        start = time.perf_counter()
+        deadline = start + self.budget
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    func, args = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                func(*args)
+            for hook in self.flush_hooks:
+                hook()
+        except Exception:
+            log.exception("Error in UI update")
+        self.tick_times.append(time.perf_counter() - start)
+        if self.running:
+            self.root.after(self.tick_ms, self.tick)
+
+
+class HistoryBuffer:
+    """Every entry shown in a ChatView, spilled to a private on-disk sqlite file.
+
+    sqlite keeps only a small page cache in memory, so a session's memory
+    stays flat however many messages it receives. Tk thread only.
+    """
+
+    def __init__(self, path=""):
+        # An empty path makes sqlite create a temporary file removed on close
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                        "seq INTEGER PRIMARY KEY, kind TEXT, text TEXT, arg, align TEXT)")
+        first, last = self.db.execute("SELECT MIN(seq), MAX(seq) FROM entries").fetchone()
+        # Entries are numbered [first, count); older ones fetched later go below first
+        self.first = first or 0
+        self.count = 0 if last is None else last + 1
+
+    def prepend(self, entries):
+        start = self.first - len(entries)
+        self.db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                            ((start + i,) + entry for i, entry in enumerate(entries)))
+        self.first = start
+        self.db.commit()
+        return start
+
+    def extend(self, entries):
+        start = self.count
+        self.db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                            ((start + i,) + entry for i, entry in enumerate(entries)))
+        self.count += len(entries)
+        self.db.commit()
+        return start
+
+    def range(self, lo, hi):
+        rows = self.db.execute("SELECT kind, text, arg, align FROM entries "
+                               "WHERE seq >= ? AND seq < ? ORDER BY seq", (lo, hi))
+        return [tuple(row) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+
+class ChatView:
+    """Chat transcript in a tk.Text, appended to in batches from any thread.
+
+    add_message()/add_image() only queue an entry; the dispatcher tick
+    inserts everything pending with one widget edit and one scroll.
+
+    Only a window of entries [lo, hi) lives in the widget. Everything is
+    also written to a HistoryBuffer; scrolling to the top pages older
+    entries back in, and entries beyond the window are evicted from the
+    far end. While the user reads old pages, new messages go to the
+    buffer only and are paged in when they scroll back down.
+
+    Scrolling past the oldest buffered entry calls on_need_older(), which
+    should fetch an older page from the server and pass it to add_older().
+    """
+
+    def __init__(self, dispatcher, text, max_entries=MAX_VISIBLE_ENTRIES, page=PAGE_ENTRIES,
+                 on_need_older=None):
+        self.dispatcher = dispatcher
+        self.text = text
+        self.max_entries = max_entries
+        self.page = page
+        self.pending = deque()
+        self.history = HistoryBuffer()
+        self.lo = self.hi = 0
+        self.line_counts = deque()
+        self.marks = {}
+        self.on_need_older = on_need_older
+        self.older_requested = False
+        self.more_older = True
+        self.thumbnails = ThumbnailLoader()
+        self.photos = PhotoCache()
+        self.configured_tags = set()
+        for align in ALIGNS:
+            for color in BUBBLE_COLORS:
+                self.bubble_tag(color, align)
+            self.image_tag(align)
+        dispatcher.add_flush_hook(self.flush)
+        dispatcher.add_flush_hook(self.place_images)
+
+    def bubble_tag(self, color, align):
+        tag = f"tag_{align}_{color}"
+        if tag not in self.configured_tags:
+            self.text.tag_config(tag, background=color, foreground="white",
+                                 justify=align, font=("Arial", 12), spacing1=5,
+                                 lmargin1=20 if align == "left" else 150,
+                                 rmargin=20 if align == "right" else 150)
+            self.configured_tags.add(tag)
+        return tag
+
+    def image_tag(self, align):
+        tag = f"img_tag_{align}"
+        if tag not in self.configured_tags:
+            self.text.tag_config(tag, justify=align)
+            self.configured_tags.add(tag)
+        return tag
+
+    def message_entry(self, sender, msg, bubble_color="blue", align="right", timestamp=None):
+        # Formatting happens on the calling thread, not the Tk loop
+        sent = datetime.now() if timestamp is None else datetime.fromtimestamp(timestamp)
+        return ("text", f"{sender} ({sent.strftime('%I:%M %p')}):\n{emojize(msg)}\n",
+                bubble_color, align)
+
+    def add_message(self, sender, msg, bubble_color="blue", align="right", timestamp=None):
+        self.pending.append(self.message_entry(sender, msg, bubble_color, align, timestamp))
+
+    def add_image(self, sender, source, align="right"):
+        # source is the encoded image (bytes or a file path)
+        timestamp = datetime.now().strftime("%I:%M %p")
+        self.pending.append(("image", f"{sender} ({timestamp}):\n", source, align))
+
+    def add_older(self, entries, more=True):
+        # entries from message_entry(), oldest first; more=False when there are no older ones
+        self.dispatcher.post(self._prepend, entries, more)
+
+    def _prepend(self, entries, more):
+        if entries:
+            self.history.prepend(entries)
+        self.older_requested = False
+        self.more_older = more
+
+    @property
+    def live(self):
+        return self.hi == self.history.count
+
+    def flush(self):
+        top, bottom = self.text.yview()
+        if self.pending:
+            entries = [self.pending.popleft()
+                       for _ in range(min(len(self.pending), MAX_ENTRIES_PER_FLUSH))]
+            live = self.live
+            start = self.history.extend(entries)
+            if live:
+                self.text.config(state=tk.NORMAL)
+                self.append(start, entries)
+                if bottom >= 1.0:
+                    self.trim_top(self.max_entries)
+                else:
+                    # Scrolled up: keep what the user is reading, spill the newest
+                    self.trim_bottom(self.max_entries)
+                self.text.config(state=tk.DISABLED)
+                if bottom >= 1.0:
+                    self.text.yview(tk.END)
+                return
+
+        # Page the window when the user scrolls against either end of it
+        if top <= 0.0 and bottom < 1.0:
+            if self.lo > self.history.first:
+                self.page_older()
+            elif self.on_need_older is not None and self.more_older and not self.older_requested:
+                self.older_requested = True
+                self.on_need_older()
+        elif bottom >= 1.0 and top > 0.0 and not self.live:
+            self.page_newer()
+
+    def append(self, start, entries):
+        self.text.mark_set(INSERT_MARK, "end-1c")
+        self.text.mark_gravity(INSERT_MARK, tk.RIGHT)
+        self.line_counts.extend(self.render(start, entries))
+        self.hi = start + len(entries)
+
+    def page_older(self):
+        lo = max(self.history.first, self.lo - self.page)
+        entries = self.history.range(lo, self.lo)
+        self.text.config(state=tk.NORMAL)
+        self.text.mark_set(INSERT_MARK, "1.0")
+        self.text.mark_gravity(INSERT_MARK, tk.RIGHT)
+        counts = self.render(lo, entries)
+        self.line_counts.extendleft(reversed(counts))
+        self.lo = lo
+        self.trim_bottom(self.max_entries)
+        self.text.config(state=tk.DISABLED)
+        # Keep the line the user was reading at the top of the view
+        self.text.yview(f"{sum(counts) + 1}.0")
+
+    def page_newer(self):
+        hi = min(self.history.count, self.hi + self.page)
+        entries = self.history.range(self.hi, hi)
+        self.text.config(state=tk.NORMAL)
+        self.append(self.hi, entries)
+        self.trim_top(self.max_entries)
+        self.text.config(state=tk.DISABLED)
+
+    def render(self, start, entries):
+        # Insert entries at INSERT_MARK, batching runs of text into one call
+        text = self.text
+        counts = []
+        chunks = []
+        for seq, (kind, body, arg, align) in enumerate(entries, start):
+            if kind == "text":
+                chunks += [body, (self.bubble_tag(arg, align),), "\n", ()]
+                counts.append(body.count("\n") + 1)
+                continue
+            if chunks:
+                text.insert(INSERT_MARK, *chunks)
+                chunks = []
+            tag = self.image_tag(align)
+            text.insert(INSERT_MARK, body, (tag,))
+            # The thumbnail is decoded on the pool and dropped in at this mark
+            mark = f"img_{seq}"
+            text.mark_set(mark, INSERT_MARK)
+            text.mark_gravity(mark, tk.LEFT)
+            text.insert(INSERT_MARK, "\n", (tag,), "\n", ())
+            self.marks[mark] = seq
+            self.thumbnails.submit(arg, mark)
+            counts.append(body.count("\n") + 2)
+        if chunks:
+            text.insert(INSERT_MARK, *chunks)
+        return counts
+
+    def trim_top(self, keep):
+        lines = 0
+        while len(self.line_counts) > keep:
+            lines += self.line_counts.popleft()
+            self.lo += 1
+        if lines:
+            self.text.delete("1.0", f"{lines + 1}.0")
+            self.forget_marks()
+
+    def trim_bottom(self, keep):
+        lines = 0
+        while len(self.line_counts) > keep:
+            lines += self.line_counts.pop()
+            self.hi -= 1
+        if lines:
+            self.text.delete(f"{sum(self.line_counts) + 1}.0", "end-1c")
+            self.forget_marks()
+
+    def forget_marks(self):
+        for mark, seq in list(self.marks.items()):
+            if not self.lo <= seq < self.hi:
+                del self.marks[mark]
+                self.text.mark_unset(mark)
+
+    def place_images(self):
+        done = self.thumbnails.poll()
+        if not done:
+            return
+        text = self.text
+        text.config(state=tk.NORMAL)
+        for mark, key, img, error in done:
+            if self.marks.pop(mark, None) is None:
+                continue  # evicted before the thumbnail was ready
+            if error is None:
+                text.image_create(mark, image=self.photos.photo_for(key, img))
+            else:
+                text.insert(mark, f"[Image display error: {str(error)}]")
+            text.mark_unset(mark)
+        text.config(state=tk.DISABLED)
+
+    def close(self):
+        self.thumbnails.shutdown()
+        self.history.close()
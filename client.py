@@ -1,18 +1,38 @@
 import tkinter as tk
 from tkinter import messagebox, filedialog
+import argparse
+import json
+import logging
+import random
 import socket
 import threading
-import emoji
-from encryption import encrypt_message, decrypt_message
-from config import SERVER_IP, PORT, KEY
-from datetime import datetime
 import time
+from encryption import MessageCipher, SUPPORTED_SUITES
+from config import ChatConfig, ATTACHMENT_DIR, COMPRESSION_DICT
+from compression import offer, accept_welcome, load_dictionary
+from protocol import (FrameReader, FrameWriter, encode_control, decode_control, control_int, SEQ_HEADER,
+                      HEARTBEAT_MISSES, FRAME_TEXT, FRAME_CONTROL, FRAME_CHUNK, FRAME_HISTORY, CONTROL_HELLO_RETRY,
+                      CONTROL_WELCOME, CONTROL_ATTACH_START, CONTROL_ATTACH_RESUME, CONTROL_ATTACH_END,
+                      CONTROL_HISTORY, CONTROL_PING, CONTROL_ACK)
+from handshake import ClientHandshake
+from attachments import AttachmentReceiver, OutgoingTransfer, encode_chunk, KIND_IMAGE, KIND_FILE
+from transcode import Transcoder
 import os
-from PIL import Image, ImageTk
+from chat_view import UIDispatcher, ChatView, PAGE_ENTRIES
+from logs import setup_logging, trace_packet
+
+# Named explicitly: run as a script this module is __main__
+log = logging.getLogger("client")
+
+CONNECT_TIMEOUT = 10
+# Reconnect backoff: doubles from the first delay up to the last, with jitter
+RECONNECT_MIN_DELAY = 0.05
+RECONNECT_MAX_DELAY = 30.0
 
 class ChatClient:
-    def __init__(self, root):
+    def __init__(self, root, config=None):
         self.root = root
+        self.config = config or ChatConfig.from_env()
         self.root.title("Client - Secure Chat")
         self.root.geometry("600x700")
         self.running = True
@@ -23,9 +43,39 @@ class ChatClient:
         self.bind_keys()
         self.toggle_theme()
 
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Network threads never touch Tk directly; they go through the dispatcher
+        self.ui = UIDispatcher(self.root)
+        self.chat = ChatView(self.ui, self.chat_window, on_need_older=self.request_older)
+        self.ui.start()
+
+        # Legacy cbc-hmac under the static key until the handshake completes.
+        # Then self.cipher is the session cipher and self.room decrypts
+        # broadcasts, and server text frames carry their message's seq.
+        self.cipher = self.room = MessageCipher(self.config.key)
+        self.session = None
+        # Lets a reconnect resume the session without a new key exchange
+        self.ticket = None
+        self.last_seq = 0
+        # What the server recorded this client's messages as, one name per
+        # connection; they are not shown again when history replays them
+        self.names = set()
+        # Server history below this seq predates the session; fetched on demand
+        self.oldest_seq = None
+        # Text and history are compressed before encryption if the server agrees
+        self.dictionary = load_dictionary(COMPRESSION_DICT)
+        self.compressor = None
+        # Transfers by id until sent; upload threads remove their own
+        self.uploads = {}
+        self.uploads_lock = threading.Lock()
+        self.transcoder = Transcoder()
+        self.attachments = AttachmentReceiver(ATTACHMENT_DIR)
+        # Set by the welcome when the server wants pings; 0 means none
+        self.heartbeat = 0
+        self.last_received = 0.0
+        self.connected = threading.Event()
+
         try:
-            self.client_socket.connect((SERVER_IP, PORT))
+            self.connect()
         except Exception as e:
             messagebox.showerror("Connection Error", str(e))
             self.root.destroy()
@@ -33,6 +83,7 @@ class ChatClient:
 
         self.receive_thread = threading.Thread(target=self.receive_msgs, daemon=True)
         self.receive_thread.start()
+        threading.Thread(target=self.keep_alive, daemon=True).start()
 
     def create_widgets(self):
         # Chat window
@@ -63,11 +114,23 @@ class ChatClient:
         self.image_button = tk.Button(button_frame, text="Send Image", command=self.send_image)
         self.image_button.grid(row=0, column=1, padx=5)
 
+        # Images go as a preview; this adds the full-resolution version after it
+        self.full_size = tk.BooleanVar(value=False)
+        self.full_size_check = tk.Checkbutton(button_frame, text="Full size", variable=self.full_size)
+        self.full_size_check.grid(row=1, column=1, padx=5)
+
+        self.file_button = tk.Button(button_frame, text="Send File", command=self.send_file)
+        self.file_button.grid(row=0, column=2, padx=5)
+
         self.theme_button = tk.Button(button_frame, text="Toggle Theme", command=self.toggle_theme)
-        self.theme_button.grid(row=0, column=2, padx=5)
+        self.theme_button.grid(row=0, column=3, padx=5)
 
         self.exit_button = tk.Button(button_frame, text="Exit", command=self.close_chat)
-        self.exit_button.grid(row=0, column=3, padx=5)
+        self.exit_button.grid(row=0, column=4, padx=5)
+
+        # Transfer progress
+        self.status_label = tk.Label(self.root, text="")
+        self.status_label.pack(pady=5)
 
     def bind_keys(self):
         self.root.bind('<Return>', lambda event: self.send_msg())
@@ -84,132 +147,317 @@ class ChatClient:
         self.entry.config(bg=entry_bg, fg=fg)
         self.dark_mode = not self.dark_mode
 
+    def connect(self):
+        self.client_socket = socket.create_connection((self.config.host, self.config.port), timeout=CONNECT_TIMEOUT)
+        self.frames = iter(FrameReader(self.client_socket))
+        # Whole frames only, batched: uploads interleave chunk frames with chat messages
+        self.writer = FrameWriter(self.client_socket)
+        self.handshake()
+        self.last_received = time.monotonic()
+        self.connected.set()
+
+    def handshake(self):
+        self.client_socket.settimeout(CONNECT_TIMEOUT)
+        options = offer(self.dictionary)
+        if self.last_seq:
+            # Reconnecting: the server sends everything after the last message seen
+            options["since"] = self.last_seq
+        handshake = ClientHandshake(self.config.key, SUPPORTED_SUITES, self.ticket, heartbeat=True, **options)
+        self.send(FRAME_CONTROL, handshake.hello())
+        # Frames queued before the welcome still use the legacy suite
+        for frame_type, data in self.frames:
+            if frame_type == FRAME_CONTROL:
+                msg = decode_control(data)
+                if msg["type"] == CONTROL_HELLO_RETRY:
+                    self.send(FRAME_CONTROL, handshake.retry())
+                    continue
+                if msg["type"] == CONTROL_WELCOME:
+                    self.start_session(handshake.finish(msg))
+                    self.compressor = accept_welcome(msg, self.dictionary)
+                    self.heartbeat = msg.get("heartbeat", 0)
+                    if msg.get("name"):
+                        self.names.add(msg["name"])
+                    self.client_socket.settimeout(None)
+                    return
+            self.handle_frame(frame_type, data)
+        raise ConnectionError("Server closed the connection during handshake")
+
+    def start_session(self, session):
+        self.session = session
+        self.cipher = session.cipher
+        self.room = session.room
+        self.ticket = session.ticket
+        log.info("Session established", extra={"suite": self.cipher.suite, "resumed": session.resumed})
+
+    def compress(self, data):
+        return data if self.compressor is None else self.compressor.compress(data)
+
+    def decompress(self, data):
+        return data if self.compressor is None else self.compressor.decompress(data)
+
+    def send(self, frame_type, payload):
+        self.writer.send(frame_type, payload)
+
     def send_msg(self):
         msg = self.entry.get().strip()
         if msg:
-            encrypted_msg = encrypt_message(KEY, msg)
-            print(f"[CLIENT] Sending message: {msg}")
-            print(f"[CLIENT] Encrypted message: {encrypted_msg.hex()}")
+            encrypted_msg = self.cipher.encrypt(self.compress(msg.encode()))
             try:
-                self.client_socket.send(encrypted_msg)
+                self.send(FRAME_TEXT, encrypted_msg)
+                log.debug("Sent message", extra={"bytes": len(encrypted_msg), "suite": self.cipher.suite})
+                trace_packet(log, "Sent packet", encrypted_msg)
                 self.display_message("You", msg, bubble_color="blue", align="right")
             except:
                 self.display_message("System", "Failed to send. Disconnected.", "red", align="center")
             self.entry.delete(0, tk.END)
             
     def send_image(self):
-        file_path = filedialog.askopenfilename(filetypes=[("Image Files", "*.jpg *.jpeg *.png")])
+        file_path = filedialog.askopenfilename(filetypes=[("Image Files", "*.jpg *.jpeg *.png *.webp")])
+        if file_path:
+            # Resized and re-encoded in a worker process; the window stays responsive meanwhile
+            self.set_status(f"Preparing {os.path.basename(file_path)}...")
+            self.transcoder.submit(file_path, full=self.full_size.get()).add_done_callback(self.send_transcoded)
+
+    def send_transcoded(self, future):
+        # On the process pool's result thread
+        if not self.running:
+            return
+        try:
+            image = future.result()
+        except Exception as e:
+            self.set_status("")
+            self.ui.post(messagebox.showerror, "Error", f"Failed to send image: {e}")
+            return
+        transfers = [OutgoingTransfer(None, KIND_IMAGE, image.preview_name, data=image.preview)]
+        if image.full is not None:
+            transfers.append(OutgoingTransfer(None, KIND_FILE, image.full_name, data=image.full))
+        self.start_upload(*transfers)
+        self.display_image("You", image.preview, align="right")
+
+    def send_file(self):
+        file_path = filedialog.askopenfilename()
         if file_path:
             try:
-                # Create temp file path in the same directory as the original
-                temp_file = os.path.join(os.path.dirname(file_path), "temp_compressed_client.jpg")
-                
-                # Compress image if too large
-                img = Image.open(file_path)
-                if os.path.getsize(file_path) > 1024*1024:  # 1MB
-                    img.save(temp_file, quality=50)
-                    with open(temp_file, "rb") as f:
-                        image_data = f.read()
-                    os.remove(temp_file)  # Remove only if we created it
-                else:
-                    with open(file_path, "rb") as f:
-                        image_data = f.read()
-                
-                # Prefix with 'IMAGE:' to identify as image data
-                image_data = b'IMAGE:' + image_data
-                
-                self.client_socket.send(image_data)
-                self.display_image("You", image_data[6:], align="right")
+                transfer = OutgoingTransfer(file_path, KIND_FILE)
+                self.start_upload(transfer)
+                self.display_message("You", f"📎 {transfer.name}", bubble_color="blue", align="right")
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to send image: {str(e)}")
+                messagebox.showerror("Error", f"Failed to send file: {str(e)}")
 
-    def receive_msgs(self):
+    def start_upload(self, *transfers):
+        # One thread sends them in order, so an image's preview goes before its full version
+        with self.uploads_lock:
+            for transfer in transfers:
+                self.uploads[transfer.id.hex()] = transfer
+        threading.Thread(target=self.upload_all, args=(transfers,), daemon=True).start()
+
+    def upload_all(self, transfers):
+        for transfer in transfers:
+            if not self.upload(transfer):
+                return
+
+    def upload(self, transfer):
+        # Runs on its own thread; chunks share the socket with chat messages.
+        # Bound to the connection it started on: after a reconnect the old
+        # writer refuses frames and a new upload resumes the transfer.
+        writer, cipher = self.writer, self.cipher
         try:
-            while self.running:
-                data = self.client_socket.recv(1024*1024)  # Increased buffer size for images
-                if not data:
-                    break
-                    
-                # Check if it's an image
-                if data.startswith(b'IMAGE:'):
-                    # Handle image
-                    image_data = data[6:]  # Remove 'IMAGE:' prefix
-                    self.display_image("Server", image_data, align="left")
-                else:
-                    # Handle regular message
-                    decrypted_msg = decrypt_message(KEY, data)
-                    print(f"[CLIENT] Received encrypted message: {data.hex()}")
-                    print(f"[CLIENT] Decrypted message: {decrypted_msg}")
-                    self.display_message("Server", decrypted_msg, bubble_color="green", align="left")
+            transfer.resumed.clear()
+            writer.send(FRAME_CONTROL, transfer.start_message())
+            if not transfer.resumed.wait(30):
+                raise TimeoutError("Server did not accept the transfer")
+            for index, data in transfer.iter_chunks():
+                if not self.running:
+                    return False
+                writer.send(FRAME_CHUNK, encode_chunk(cipher, transfer.id, index, data), bulk=True)
+                self.show_progress("Sending", transfer)
+            # Behind the chunks, which chat messages and pings overtake
+            writer.send(FRAME_CONTROL, transfer.end_message(), bulk=True)
         except Exception as e:
-            print(f"[CLIENT] Error receiving messages: {e}")
-        finally:
-            self.display_message("System", "Server disconnected. Closing client in 3 seconds...", "red", align="center")
-            self.chat_window.update()
-            time.sleep(3)
-            self.close_chat()
-
-    def display_message(self, sender, msg, bubble_color="blue", align="right"):
-        self.chat_window.config(state=tk.NORMAL)
-        timestamp = datetime.now().strftime("%I:%M %p")
-        full_msg = f"{sender} ({timestamp}):\n{emoji.emojize(msg)}\n\n"
-        self.chat_window.insert(tk.END, full_msg)
-
-        tag = f"tag_{align}_{bubble_color}"
-        self.chat_window.tag_add(tag, "end-3l", "end-1l")
-        self.chat_window.tag_config(tag, background=bubble_color, foreground="white",
-                                    justify=align, font=("Arial", 12), spacing1=5,
-                                    lmargin1=20 if align == "left" else 150,
-                                    rmargin=20 if align == "right" else 150)
-        self.chat_window.config(state=tk.DISABLED)
-        self.chat_window.yview(tk.END)
-        
-    def display_image(self, sender, image_data, align="right"):
-        self.chat_window.config(state=tk.NORMAL)
-        timestamp = datetime.now().strftime("%I:%M %p")
-        
-        # Create a temporary image file
-        temp_file = "temp_img_client.jpg"
-        with open(temp_file, "wb") as f:
-            f.write(image_data)
-            
-        # Display sender info
-        self.chat_window.insert(tk.END, f"{sender} ({timestamp}):\n")
-        
-        try:
-            # Display image
-            img = Image.open(temp_file)
-            img.thumbnail((300, 300))  # Resize to fit in chat
-            photo = ImageTk.PhotoImage(img)
-            
-            self.chat_window.image_create(tk.END, image=photo)
-            self.chat_window.image = photo  # Keep reference
-            
-            self.chat_window.insert(tk.END, "\n\n")
-            
-            # Configure tag for alignment
-            tag = f"img_tag_{align}"
-            self.chat_window.tag_add(tag, "end-3l", "end-1l")
-            self.chat_window.tag_config(tag, justify=align)
-        except Exception as e:
-            self.chat_window.insert(tk.END, f"[Image display error: {str(e)}]\n\n")
-        
-        self.chat_window.config(state=tk.DISABLED)
-        self.chat_window.yview(tk.END)
+            # Left in self.uploads so it can resume after reconnecting
+            self.set_status(f"Sending {transfer.name} paused: {e}")
+            return False
+
+        with self.uploads_lock:
+            self.uploads.pop(transfer.id.hex(), None)
+        self.show_progress("Sending", transfer)
+        transfer.done()
+        return True
+
+    def receive_msgs(self):
+        while self.running:
+            try:
+                for frame_type, data in self.frames:
+                    self.last_received = time.monotonic()
+                    if not self.running:
+                        return
+                    self.handle_frame(frame_type, data)
+            except Exception as e:
+                log.warning("Error receiving messages: %s", e)
+            if self.running:
+                self.reconnect()
+
+    def reconnect(self):
+        # On the receive thread, until connected again or closed
+        self.connected.clear()
+        self.drop_connection()
+        self.display_message("System", "Connection lost. Reconnecting...", "red", align="center")
+        delay = RECONNECT_MIN_DELAY
+        while self.running:
+            try:
+                self.connect()
+            except Exception as e:
+                log.info("Reconnect failed: %s", e, extra={"retry_in": round(delay, 3)})
+                self.drop_connection()
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            self.display_message("System", "Reconnected.", "green", align="center")
+            # Downloads cut off by the reconnect carry on from their last whole chunk
+            for transfer in list(self.attachments.transfers.values()):
+                self.send(FRAME_CONTROL, transfer.resume_message())
+            with self.uploads_lock:
+                paused = list(self.uploads.values())
+            if paused:
+                self.start_upload(*paused)
+            return
+
+    def drop_connection(self):
         try:
-            os.remove(temp_file)  # Clean up
-        except:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
+        self.client_socket.close()
+        self.writer.close()
+
+    def keep_alive(self):
+        # Own thread: pings while connected and notices a server gone silent,
+        # which a half-open connection never reports by itself
+        while self.running:
+            interval = self.heartbeat or 1.0
+            time.sleep(interval)
+            if not self.heartbeat or not self.connected.is_set():
+                continue
+            if time.monotonic() - self.last_received > interval * HEARTBEAT_MISSES:
+                log.warning("No response from the server for %.0fs", time.monotonic() - self.last_received)
+                # Unblocks the receive thread, which reconnects
+                try:
+                    self.client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                continue
+            try:
+                self.send(FRAME_CONTROL, encode_control(CONTROL_PING))
+            except Exception:
+                pass
+
+    def handle_frame(self, frame_type, data):
+        if frame_type == FRAME_TEXT:
+            if self.session is not None:
+                header = bytes(data[:SEQ_HEADER.size])
+                self.last_seq = SEQ_HEADER.unpack(header)[0]
+                msg = json.loads(self.decompress(self.room.decrypt(data[SEQ_HEADER.size:], aad=header)))
+                sender, decrypted_msg = msg["from"], msg["text"]
+            else:
+                sender, decrypted_msg = "Server", self.cipher.decrypt_text(data)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Received message", extra={"seq": self.last_seq, "bytes": len(data)})
+            trace_packet(log, "Received packet", data)
+            self.display_message(sender, decrypted_msg, bubble_color="green", align="left")
+        elif frame_type == FRAME_HISTORY:
+            self.show_history(json.loads(self.decompress(self.cipher.decrypt(data))))
+        elif frame_type == FRAME_CHUNK:
+            self.show_progress("Receiving", self.attachments.chunk(self.room, data))
+        elif frame_type == FRAME_CONTROL:
+            msg = decode_control(data)
+            if msg["type"] == CONTROL_ACK:
+                self.last_seq = max(self.last_seq, control_int(msg, "seq"))
+            elif msg["type"] == CONTROL_ATTACH_RESUME:
+                transfer = self.uploads.get(msg["id"])
+                if transfer is not None:
+                    transfer.resume_from(int(msg["index"]))
+            elif msg["type"] == CONTROL_ATTACH_START:
+                # The server streams without waiting for attach_resume, which
+                # only asks it for missing chunks
+                self.attachments.start(msg)
+            elif msg["type"] == CONTROL_ATTACH_END:
+                transfer = self.attachments.finish(msg)
+                if not transfer.complete:
+                    # Chunks went missing on the way: the server sends the rest
+                    self.send(FRAME_CONTROL, transfer.resume_message())
+                    return
+                self.show_progress("Receiving", transfer)
+                self.display_attachment("Server", transfer, align="left")
+
+    def show_history(self, body):
+        messages = body["messages"]
+        if body["older"] or self.oldest_seq is None:
+            self.oldest_seq = messages[0]["seq"] if messages else body["before"]
+        if body["older"]:
+            self.chat.add_older([self.chat.message_entry(m["from"], m["text"], "green", "left", m["time"])
+                                 for m in messages], body["more"])
+            return
+        # Replayed on connect (or what was missed while reconnecting), shown before anything live
+        for m in messages:
+            if m["seq"] <= self.last_seq:
+                continue
+            self.last_seq = m["seq"]
+            if m["from"] in self.names:
+                # Shown when it was sent
+                continue
+            self.display_message(m["from"], m["text"], bubble_color="green", align="left", timestamp=m["time"])
+
+    def request_older(self):
+        # Called on the Tk thread when the user scrolls above everything loaded
+        if self.oldest_seq is None or self.oldest_seq <= 1:
+            self.chat.add_older([], more=False)
+            return
+        try:
+            self.send(FRAME_CONTROL, encode_control(CONTROL_HISTORY, before=self.oldest_seq, limit=PAGE_ENTRIES))
+        except OSError as e:
+            log.warning("Could not request history: %s", e)
+
+    def show_progress(self, action, transfer):
+        if transfer.progress >= 1.0:
+            self.set_status("")
+        else:
+            self.set_status(f"{action} {transfer.name}: {transfer.progress:.0%}")
+
+    def set_status(self, text):
+        self.ui.post(self.status_label.config, {"text": text})
+
+    def display_attachment(self, sender, transfer, align="left"):
+        if transfer.kind == KIND_IMAGE:
+            self.display_image(sender, transfer.path, align=align)
+        else:
+            self.display_message(sender, f"📎 {transfer.name} (saved to {transfer.path})",
+                                 bubble_color="green" if align == "left" else "blue", align=align)
+
+    def display_message(self, sender, msg, bubble_color="blue", align="right", timestamp=None):
+        # Safe from any thread; drawn on the next UI tick
+        self.chat.add_message(sender, msg, bubble_color, align, timestamp)
+
+    def display_image(self, sender, source, align="right"):
+        self.chat.add_image(sender, source, align)
 
     def close_chat(self):
         self.running = False
+        self.ui.stop()
+        self.chat.close()
+        self.transcoder.shutdown()
         try:
+            self.writer.close()
+            log.debug("Writer stats", extra=self.writer.stats())
             self.client_socket.close()
         except:
             pass
         self.root.quit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Secure chat client")
+    ChatConfig.add_arguments(parser)
+    config = ChatConfig.from_args(parser.parse_args())
+    setup_logging()
     root = tk.Tk()
-    app = ChatClient(root)
+    app = ChatClient(root, config)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+from collections import deque
+
+from message_store import MessageStore
+
+# Bus frames: type (1 byte) || header length (4) || body length (4) || JSON header || body
+BUS_HEADER = struct.Struct("!BII")
+# worker -> bus, first frame: which worker this is
+BUS_HELLO = 1
+# worker -> bus: a chat message to number, store and fan out
+BUS_PUBLISH = 2
+# bus -> every worker: a published message with its seq
+BUS_DELIVER = 3
+# worker -> bus -> other workers: a received attachment to stream
+BUS_ATTACHMENT = 5
+# worker -> bus -> worker: a page of stored messages
+BUS_HISTORY = 6
+
+# How often the supervisor checks on its workers
+WORKER_POLL_INTERVAL = 1.0
+
+log = logging.getLogger(__name__)
+
+
+def has_reuse_port():
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+def encode_bus(bus_type, body=b"", **fields):
+    header = json.dumps(fields, separators=(",", ":")).encode()
+    return BUS_HEADER.pack(bus_type, len(header), len(body)) + header + body
+
+
+async def read_bus(reader):
+    bus_type, header_length, body_length = BUS_HEADER.unpack(await reader.readexactly(BUS_HEADER.size))
+    header = json.loads(await reader.readexactly(header_length))
+    body = await reader.readexactly(body_length) if body_length else b""
+    return bus_type, header, body
+
+
+class MessageBus:
+    """Runs in the supervisor: numbers, stores and fans out every worker's messages.
+
+    Each worker holds one Unix socket connection to the bus. Messages are
+    delivered to all workers (the publisher included) in seq order, so
+    every client sees the same order whichever worker it is on. Images and
+    attachments only go to the other workers. The bus owns the message
+    store and answers history requests; the latest page and reconnect
+    syncs are read in line, so they and the live messages after them
+    never overlap.
+    """
+
+    def __init__(self, path, store=None):
+        self.path = path
+        self.store = store
+        self.last_seq = 0
+        self.workers = {}
+        self.server = None
+        # Set while the supervisor shuts its workers down
+        self.closing = False
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._serve, self.path)
+        os.chmod(self.path, 0o600)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for writer in self.workers.values():
+            writer.close()
+
+    def record(self, sender, data):
+        if self.store is None:
+            self.last_seq += 1
+            return self.last_seq
+        return self.store.append(json.dumps({"from": sender, "text": data.decode()}).encode())
+
+    async def send(self, frame, exclude=None):
+        for worker, writer in list(self.workers.items()):
+            if worker != exclude:
+                writer.write(frame)
+        # A slow worker holds up the bus rather than letting its backlog grow without bound
+        for worker, writer in list(self.workers.items()):
+            if worker != exclude:
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+    async def _serve(self, reader, writer):
+        worker = None
+        try:
+            bus_type, header, _ = await read_bus(reader)
+            if bus_type != BUS_HELLO:
+                return
+            worker = header["worker"]
+            self.workers[worker] = writer
+            log.info("Worker %s joined the bus", worker, extra={"workers": len(self.workers)})
+            while True:
+                bus_type, header, body = await read_bus(reader)
+                if bus_type == BUS_PUBLISH:
+                    seq = self.record(header["from"], body)
+                    await self.send(encode_bus(BUS_DELIVER, body, seq=seq, worker=worker, **header))
+                elif bus_type == BUS_ATTACHMENT:
+                    await self.send(encode_bus(bus_type, body, **header), exclude=worker)
+                elif bus_type == BUS_HISTORY:
+                    await self._history(writer, header)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                del self.workers[worker]
+                log.log(logging.INFO if self.closing else logging.WARNING, "Worker %s left the bus", worker,
+                        extra={"workers": len(self.workers)})
+            writer.close()
+
+    async def _history(self, writer, header):
+        records, next_seq = [], self.last_seq + 1
+        if self.store is not None:
+            next_seq = self.store.next_seq
+            if header.get("after") is not None:
+                # A reconnect's backlog may reach back past the tail to disk.
+                # What is published meanwhile is delivered before this reply
+                # and skipped for the replaying connection, so it goes in too.
+                records = await asyncio.get_running_loop().run_in_executor(
+                    None, self.store.read_range, max(header["after"] + 1, next_seq - header["limit"]), next_seq)
+                records += self.store.read_range(next_seq, self.store.next_seq)
+                next_seq = self.store.next_seq
+            elif header.get("before") is None:
+                records = self.store.latest(header["limit"])
+            else:
+                records = await asyncio.get_running_loop().run_in_executor(
+                    None, self.store.before, header["before"], header["limit"])
+        body = json.dumps([[seq, timestamp, payload.decode()] for seq, timestamp, payload in records]).encode()
+        writer.write(encode_bus(BUS_HISTORY, body, id=header["id"], next_seq=next_seq))
+
+
+class BusClient:
+    """A worker's connection to the MessageBus; everything it receives is handed to the ServerCore."""
+
+    def __init__(self, core, path, worker):
+        self.core = core
+        self.path = path
+        self.worker = worker
+        self.reader = self.writer = None
+        # Connections that published each message still on its way through
+        # the bus, oldest first, so their own message is not echoed back
+        self.origins = deque()
+        self.requests = {}
+        self.next_request = 0
+        self.task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.writer.write(encode_bus(BUS_HELLO, worker=self.worker))
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def publish(self, sender, data, origin=None):
+        self.origins.append(origin)
+        self.writer.write(encode_bus(BUS_PUBLISH, data, **{"from": sender}))
+
+    def share_attachment(self, path, kind, name):
+        self.writer.write(encode_bus(BUS_ATTACHMENT, path=path, kind=kind, name=name))
+
+    async def history(self, before, limit, after=None):
+        # (records, next_seq); before=None asks for the latest page, or
+        # with `after` for the latest messages after that seq
+        request = self.next_request
+        self.next_request += 1
+        future = self.requests[request] = asyncio.get_running_loop().create_future()
+        self.writer.write(encode_bus(BUS_HISTORY, id=request, before=before, limit=limit, after=after))
+        return await future
+
+    async def _run(self):
+        core = self.core
+        try:
+            while True:
+                bus_type, header, body = await read_bus(self.reader)
+                if bus_type == BUS_DELIVER:
+                    origin = self.origins.popleft() if header["worker"] == self.worker else None
+                    core.deliver(header["seq"], header["from"], body, exclude=origin)
+                elif bus_type == BUS_ATTACHMENT:
+                    core.relay_attachment(header["path"], header["kind"], header["name"])
+                elif bus_type == BUS_HISTORY:
+                    records = [(seq, timestamp, payload.encode()) for seq, timestamp, payload in json.loads(body)]
+                    future = self.requests.pop(header["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result((records, header["next_seq"]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.error("Lost the message bus; stopping worker %s", self.worker)
+        except asyncio.CancelledError:
+            return
+        core.stop()
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def run_worker(worker, bus_path, core_options, log_options):
+    # Entry point of each worker process
+    from logs import setup_logging
+    from server_core import ServerCore
+
+    setup_logging(**log_options)
+    address = core_options.get("metrics_address")
+    if address:
+        # Each worker serves its own metrics, on the next port or a suffixed socket path
+        host, _, port = address.rpartition(":")
+        if port.isdigit() and "/" not in address:
+            address = f"{host}:{int(port) + worker}"
+        else:
+            address = f"{address}.{worker}"
+        core_options = dict(core_options, metrics_address=address)
+    core = ServerCore(history_dir=None, reuse_port=True, bus_path=bus_path, worker=worker, **core_options)
+    core.run()
+
+
+def run_cluster(workers, core_options, history_dir, key, log_options):
+    """Serve from `workers` processes sharing one port through SO_REUSEPORT.
+
+    The calling process becomes the supervisor: it runs the MessageBus,
+    keeps the message store and restarts workers that exit.
+    """
+    # Only the supervisor needs multiprocessing; a single-process server never imports it
+    import multiprocessing
+
+    if not has_reuse_port():
+        raise RuntimeError("--workers needs SO_REUSEPORT, which this platform lacks")
+    runtime_dir = tempfile.mkdtemp(prefix="secure-chat-")
+    bus_path = os.path.join(runtime_dir, "bus.sock")
+    context = multiprocessing.get_context("spawn")
+
+    def spawn(worker):
+        process = context.Process(target=run_worker, name=f"worker-{worker}", daemon=True,
+                                  args=(worker, bus_path, core_options, log_options))
+        process.start()
+        return process
+
+    async def supervise():
+        # Stopped like the headless server, by Ctrl+C or SIGTERM, shutting the workers down first
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        store = MessageStore(history_dir, key) if history_dir else None
+        bus = MessageBus(bus_path, store)
+        await bus.start()
+        processes = [spawn(worker) for worker in range(workers)]
+        log.info("Started %s workers", workers)
+        try:
+            while True:
+                await asyncio.sleep(WORKER_POLL_INTERVAL)
+                for worker, process in enumerate(processes):
+                    if not process.is_alive():
+                        log.warning("Worker %s exited with %s; restarting it", worker, process.exitcode)
+                        processes[worker] = spawn(worker)
+        finally:
+            bus.closing = True
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join(5)
+            bus.close()
+            if store is not None:
+                store.close()
+
+    try:
+        asyncio.run(supervise())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        shutil.rmtree(runtime_dir, ignore_errors=True)
@@ -0,0 +1,220 @@
+import argparse
+import hashlib
+import os
+import struct
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:  # optional: zlib is always available
+    zstandard = None
+
+CODEC_ZSTD = "zstd"
+CODEC_ZLIB = "zlib"
+# Preference order used when negotiating with a peer
+SUPPORTED_CODECS = ((CODEC_ZSTD,) if zstandard is not None else ()) + (CODEC_ZLIB,)
+
+MODE_OFF = "off"
+MODE_ON = "on"
+# For attacker-influenced content: see Compressor
+MODE_SAFE = "safe"
+COMPRESSION_MODES = (MODE_OFF, MODE_ON, MODE_SAFE)
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# Smaller plaintexts are sent as they are
+MIN_COMPRESS_SIZE = 128
+PAD_BUCKET = 64
+MAX_DECOMPRESSED = 64 * 1024 * 1024
+DICTIONARY_SIZE = 16 * 1024
+
+# Every plaintext starts with one of these flags
+FLAG_RAW = 0
+FLAG_COMPRESSED = 1
+# flag || compressed length || compressed || zero padding
+FLAG_PADDED = 2
+PADDED_HEADER = struct.Struct("!BI")
+# flag || part count || (part length || part)..., each part flagged on its own
+FLAG_PARTS = 3
+PARTS_HEADER = struct.Struct("!BI")
+PART_LENGTH = struct.Struct("!I")
+
+
+def negotiate_codec(offered):
+    for codec in SUPPORTED_CODECS:
+        if codec in offered:
+            return codec
+    return None
+
+
+def dictionary_id(dictionary):
+    return hashlib.sha256(dictionary).hexdigest()[:16]
+
+
+def load_dictionary(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def offer(dictionary=None):
+    """Client hello fields offering every codec here, and a dictionary by id."""
+    fields = {"compress": list(SUPPORTED_CODECS)}
+    if dictionary is not None:
+        fields["dict"] = dictionary_id(dictionary)
+    return fields
+
+
+def accept_welcome(msg, dictionary=None):
+    """The Compressor a welcome settled on, or None when compression is off."""
+    codec = msg.get("compress")
+    if codec is None:
+        return None
+    return Compressor(codec, dictionary if msg.get("dict") else None, safe=bool(msg.get("safe")))
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """A shared dictionary for either codec, from sample messages (bytes)."""
+    if zstandard is not None:
+        return zstandard.train_dictionary(size, list(samples)).as_bytes()
+    # zlib takes raw preset content; the most frequent words go last, where
+    # back-references to them are shortest
+    words = Counter(word for sample in samples for word in sample.split())
+    dictionary = b""
+    for word, _ in words.most_common():
+        if len(dictionary) + len(word) + 1 > size:
+            break
+        dictionary = word + b" " + dictionary
+    return dictionary
+
+
+class Compressor:
+    """Compresses plaintexts ahead of encryption with one negotiated codec.
+
+    Every output starts with a flag byte, so a receiver handles compressed
+    and raw plaintexts alike; anything below the threshold, or that does
+    not shrink, goes out raw.
+
+    safe mode is for content an attacker can influence. Compressed sizes
+    are padded to PAD_BUCKET, and content from different senders (the
+    parts given to compress_parts, such as a history page's messages) is
+    never compressed together, so an attacker cannot learn another user's
+    text from how well their own compresses alongside it.
+    """
+
+    def __init__(self, codec=CODEC_ZLIB, dictionary=None, threshold=MIN_COMPRESS_SIZE, safe=False):
+        if codec not in SUPPORTED_CODECS:
+            raise ValueError(f"Unsupported compression codec: {codec}")
+        self.codec = codec
+        self.dictionary = dictionary
+        self.threshold = threshold
+        self.safe = safe
+        if codec == CODEC_ZSTD:
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data)
+            self._zstd_decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def _compress(self, data):
+        if self.codec == CODEC_ZSTD:
+            return self._zstd_compressor.compress(data)
+        if self.dictionary is None:
+            return zlib.compress(data, ZLIB_LEVEL)
+        compressor = zlib.compressobj(ZLIB_LEVEL, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def _decompress(self, data):
+        if self.codec == CODEC_ZSTD:
+            if zstandard.frame_content_size(data) > MAX_DECOMPRESSED:
+                raise ValueError("Compressed message is too large")
+            return self._zstd_decompressor.decompress(data, max_output_size=MAX_DECOMPRESSED)
+        if self.dictionary is None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = zlib.decompressobj(zdict=self.dictionary)
+        plain = decompressor.decompress(data, MAX_DECOMPRESSED)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Compressed message is too large")
+        return plain
+
+    def compress(self, data):
+        if len(data) >= self.threshold:
+            packed = self._compress(data)
+            if self.safe:
+                size = PADDED_HEADER.size + len(packed)
+                padding = -size % PAD_BUCKET
+                if size + padding <= len(data):
+                    return PADDED_HEADER.pack(FLAG_PADDED, len(packed)) + packed + bytes(padding)
+            elif len(packed) < len(data):
+                return bytes((FLAG_COMPRESSED,)) + packed
+        return bytes((FLAG_RAW,)) + data
+
+    def compress_parts(self, parts):
+        # One plaintext made of several senders' content; decompress() joins
+        # the parts again. Only safe mode keeps each part to itself.
+        if not self.safe:
+            return self.compress(b"".join(parts))
+        packed = b"".join(PART_LENGTH.pack(len(part)) + part for part in map(self.compress, parts))
+        size = sum(map(len, parts))
+        if PARTS_HEADER.size + len(packed) > size:
+            return bytes((FLAG_RAW,)) + b"".join(parts)
+        return PARTS_HEADER.pack(FLAG_PARTS, len(parts)) + packed
+
+    def _join_parts(self, data):
+        _, count = PARTS_HEADER.unpack_from(data)
+        offset = PARTS_HEADER.size
+        plain = []
+        size = 0
+        for _ in range(count):
+            (length,) = PART_LENGTH.unpack_from(data, offset)
+            offset += PART_LENGTH.size
+            part = data[offset:offset + length]
+            offset += length
+            if len(part) != length or (part and part[0] == FLAG_PARTS):
+                raise ValueError("Corrupt compressed message: bad part")
+            plain.append(self.decompress(part))
+            size += len(plain[-1])
+            if size > MAX_DECOMPRESSED:
+                raise ValueError("Compressed message is too large")
+        return b"".join(plain)
+
+    def decompress(self, data):
+        data = memoryview(data)
+        if not data:
+            raise ValueError("Empty message")
+        flag = data[0]
+        try:
+            if flag == FLAG_RAW:
+                return bytes(data[1:])
+            if flag == FLAG_COMPRESSED:
+                return self._decompress(data[1:])
+            if flag == FLAG_PADDED:
+                _, length = PADDED_HEADER.unpack_from(data)
+                return self._decompress(data[PADDED_HEADER.size:PADDED_HEADER.size + length])
+            if flag == FLAG_PARTS:
+                return self._join_parts(data)
+        except (zlib.error, struct.error) as e:
+            raise ValueError(f"Corrupt compressed message: {e}") from None
+        raise ValueError(f"Unknown compression flag {flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a shared compression dictionary on chat text")
+    parser.add_argument("corpus", nargs="+", help="text files with one message per line")
+    parser.add_argument("-o", "--output", default="chat.dict")
+    parser.add_argument("--size", type=int, default=DICTIONARY_SIZE)
+    args = parser.parse_args()
+
+    samples = []
+    for path in args.corpus:
+        with open(path, "rb") as f:
+            samples += [line.rstrip(b"\r\n") for line in f if line.strip()]
+    dictionary = train_dictionary(samples, args.size)
+    with open(args.output, "wb") as f:
+        f.write(dictionary)
+    print(f"Wrote {len(dictionary)} byte dictionary {dictionary_id(dictionary)} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
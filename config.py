@@ -2,12 +2,94 @@ import os
 
 SERVER_IP = "127.0.0.1"
 PORT = 12345
+ATTACHMENT_DIR = "attachments"
+HISTORY_DIR = "history"
+# Optional shared dictionary (python -m compression corpus.txt)
+COMPRESSION_DICT = "chat.dict"
 
-if not os.path.exists("aes_key.bin"):
-    KEY = os.urandom(16)
-    with open("aes_key.bin", "wb") as f:
-        f.write(KEY)
-else:
-    with open("aes_key.bin", "rb") as f:
-        KEY = f.read()
+# The shared key, created on first use if it does not exist
+KEY_FILE = "aes_key.bin"
+KEY_SIZES = (16, 24, 32)
 
+# Environment variables read by ChatConfig.from_env(); CHAT_KEY is the key itself, in hex
+ENV_HOST = "CHAT_HOST"
+ENV_PORT = "CHAT_PORT"
+ENV_KEY = "CHAT_KEY"
+ENV_KEY_FILE = "CHAT_KEY_FILE"
+
+
+def load_key(path=KEY_FILE, create=True):
+    try:
+        with open(path, "rb") as f:
+            key = f.read()
+    except FileNotFoundError:
+        if not create:
+            raise
+        key = os.urandom(16)
+        # Exclusive, so two processes starting together cannot each write their own
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return load_key(path, create=False)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+    if len(key) not in KEY_SIZES:
+        raise ValueError(f"{path} holds a {len(key)}-byte key; expected 16, 24 or 32 bytes")
+    return key
+
+
+class ChatConfig:
+    """Where to connect or listen, and the shared key.
+
+    Built from the environment, command-line arguments or both; nothing
+    is read from disk until `key` is first used. The key comes from
+    CHAT_KEY if set, otherwise from the key file (--key-file,
+    CHAT_KEY_FILE or aes_key.bin in the working directory).
+    """
+
+    def __init__(self, host=SERVER_IP, port=PORT, key_file=KEY_FILE, key=None):
+        self.host = host
+        self.port = port
+        self.key_file = key_file
+        self._key = key
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        key = bytes.fromhex(environ[ENV_KEY]) if environ.get(ENV_KEY) else None
+        if key is not None and len(key) not in KEY_SIZES:
+            raise ValueError(f"{ENV_KEY} holds a {len(key)}-byte key; expected 16, 24 or 32 bytes")
+        return cls(host=environ.get(ENV_HOST, SERVER_IP), port=int(environ.get(ENV_PORT, PORT)),
+                   key_file=environ.get(ENV_KEY_FILE, KEY_FILE), key=key)
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("--host", help=f"address to use (default: ${ENV_HOST} or {SERVER_IP})")
+        parser.add_argument("--port", type=int, help=f"port to use (default: ${ENV_PORT} or {PORT})")
+        parser.add_argument("--key-file", help=f"shared key file, created if missing "
+                                               f"(default: ${ENV_KEY_FILE} or {KEY_FILE})")
+
+    @classmethod
+    def from_args(cls, args, environ=None):
+        # Arguments given on the command line win over the environment
+        config = cls.from_env(environ)
+        if args.host is not None:
+            config.host = args.host
+        if args.port is not None:
+            config.port = args.port
+        if args.key_file is not None:
+            config.key_file, config._key = args.key_file, None
+        return config
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = load_key(self.key_file)
+        return self._key
+
+
+def __getattr__(name):
+    # Older code imports KEY; it is read when first asked for rather than when config is imported
+    if name == "KEY":
+        return ChatConfig.from_env().key
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,44 +1,203 @@
 import hmac
 import hashlib
+from functools import lru_cache
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives import hashes
 import os
 
-SECRET_HMAC_KEY = b'SuperSecretHMACKey'
+from metrics import REGISTRY
 
-def encrypt_message(key, plaintext):
-    iv = os.urandom(16)
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
-    encryptor = cipher.encryptor()
+SUITE_CBC_HMAC = "cbc-hmac"
+SUITE_AES_GCM = "aes-gcm"
+SUITE_CHACHA20 = "chacha20-poly1305"
+# Preference order used when negotiating with a peer
+SUPPORTED_SUITES = (SUITE_AES_GCM, SUITE_CHACHA20, SUITE_CBC_HMAC)
 
-    padder = padding.PKCS7(128).padder()
-    padded_data = padder.update(plaintext.encode()) + padder.finalize()
+# AEAD packets start with a version byte naming their suite
+VERSION_AES_GCM = 0x02
+VERSION_CHACHA20 = 0x03
+AEAD_VERSIONS = {VERSION_AES_GCM: SUITE_AES_GCM, VERSION_CHACHA20: SUITE_CHACHA20}
+SUITE_VERSIONS = {suite: version for version, suite in AEAD_VERSIONS.items()}
 
-    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
+BLOCK_SIZE = 16
+IV_SIZE = 16
+MAC_SIZE = 32
+HEADER_SIZE = IV_SIZE + MAC_SIZE
+NONCE_SIZE = 12
+TAG_SIZE = 16
+AEAD_HEADER_SIZE = 1 + NONCE_SIZE
 
-    hmac_obj = hmac.new(SECRET_HMAC_KEY, encrypted_data, hashlib.sha256)
-    hmac_digest = hmac_obj.digest()
+# Rejected packets, by why; "hmac" and "tag" failures mean tampering or a wrong key
+DECRYPT_FAILURES = REGISTRY.counter("chat_decrypt_failures_total", "Packets that failed to decrypt", ("reason",))
+FAILED_MALFORMED = DECRYPT_FAILURES.labels("malformed")
+FAILED_HMAC = DECRYPT_FAILURES.labels("hmac")
+FAILED_PADDING = DECRYPT_FAILURES.labels("padding")
+FAILED_VERSION = DECRYPT_FAILURES.labels("version")
+FAILED_TAG = DECRYPT_FAILURES.labels("tag")
 
-    return iv + hmac_digest + encrypted_data
 
-def decrypt_message(key, encrypted_packet):
-    iv = encrypted_packet[:16]
-    received_hmac = encrypted_packet[16:48]
-    encrypted_text = encrypted_packet[48:]
+def derive_keys(key):
+    # Split the shared key into independent encryption and MAC keys
+    material = HKDF(algorithm=hashes.SHA256(), length=len(key) + MAC_SIZE,
+                    salt=None, info=b"secure-chat cbc-hmac").derive(key)
+    return material[:len(key)], material[len(key):]
+
+
+def derive_aead(key, suite):
+    if suite == SUITE_AES_GCM:
+        return AESGCM(HKDF(algorithm=hashes.SHA256(), length=len(key), salt=None,
+                           info=b"secure-chat aes-gcm").derive(key))
+    if suite == SUITE_CHACHA20:
+        return ChaCha20Poly1305(HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                                     info=b"secure-chat chacha20-poly1305").derive(key))
+    raise ValueError(f"Unknown cipher suite: {suite}")
+
+
+def derive_subkey(key, purpose):
+    # An independent key for another use of the shared key, such as storage
+    return HKDF(algorithm=hashes.SHA256(), length=len(key), salt=None,
+                info=b"secure-chat " + purpose).derive(key)
+
+
+def negotiate_suite(offered):
+    for suite in SUPPORTED_SUITES:
+        if suite in offered:
+            return suite
+    return SUITE_CBC_HMAC
+
+
+class MessageCipher:
+    """Encrypts chat packets under one key and cipher suite.
+
+    cbc-hmac packets:  iv || HMAC(iv || ciphertext) || ciphertext
+    AEAD packets:      version || nonce || ciphertext || tag
+
+    Create one per key and reuse it; key derivation, the AES key schedule and
+    the keyed HMAC state are set up once here instead of on every message.
+    An AEAD cipher decrypts packets of either AEAD version. Optional aad
+    (associated data) is authenticated but not encrypted or sent.
+    """
+
+    def __init__(self, key, suite=SUITE_CBC_HMAC):
+        self.key = key
+        self.suite = suite
+        if suite == SUITE_CBC_HMAC:
+            self.enc_key, self.mac_key = derive_keys(key)
+            self._algorithm = algorithms.AES(self.enc_key)
+            self._mac = hmac.new(self.mac_key, digestmod=hashlib.sha256)
+        else:
+            self.version = SUITE_VERSIONS[suite]
+            self._aead = derive_aead(key, suite)
+            self._aeads = {self.version: self._aead}
+
+    @property
+    def overhead(self):
+        if self.suite == SUITE_CBC_HMAC:
+            return HEADER_SIZE + BLOCK_SIZE
+        return AEAD_HEADER_SIZE + TAG_SIZE
 
-    hmac_obj = hmac.new(SECRET_HMAC_KEY, encrypted_text, hashlib.sha256)
-    expected_hmac = hmac_obj.digest()
+    def _digest(self, iv, ciphertext, aad=b""):
+        mac = self._mac.copy()
+        if aad:
+            mac.update(len(aad).to_bytes(8, "big"))
+            mac.update(aad)
+        mac.update(iv)
+        mac.update(ciphertext)
+        return mac.digest()
 
-    if not hmac.compare_digest(received_hmac, expected_hmac):
-        raise ValueError("HMAC verification failed! Possible message tampering.")
+    def _encrypt(self, iv, data, aad=b""):
+        pad = BLOCK_SIZE - len(data) % BLOCK_SIZE
+        encryptor = Cipher(self._algorithm, modes.CBC(iv)).encryptor()
+        ciphertext = encryptor.update(data) + encryptor.update(bytes((pad,)) * pad) + encryptor.finalize()
+        return iv + self._digest(iv, ciphertext, aad) + ciphertext
 
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
-    decryptor = cipher.decryptor()
+    def _encrypt_aead(self, nonce, data, aad=b""):
+        header = bytes((self.version,)) + nonce
+        return header + self._aead.encrypt(nonce, data, header[:1] + aad)
 
-    decrypted_padded = decryptor.update(encrypted_text) + decryptor.finalize()
+    def encrypt(self, data, aad=b""):
+        if self.suite == SUITE_CBC_HMAC:
+            return self._encrypt(os.urandom(IV_SIZE), data, aad)
+        return self._encrypt_aead(os.urandom(NONCE_SIZE), data, aad)
 
-    unpadder = padding.PKCS7(128).unpadder()
-    decrypted_text = unpadder.update(decrypted_padded) + unpadder.finalize()
+    def decrypt(self, packet, aad=b""):
+        if self.suite == SUITE_CBC_HMAC:
+            return self._decrypt_cbc(packet, aad)
+        return self._decrypt_aead(packet, aad)
 
-    return decrypted_text.decode()
+    def _decrypt_cbc(self, packet, aad=b""):
+        packet = memoryview(packet)
+        if len(packet) < HEADER_SIZE + BLOCK_SIZE or (len(packet) - HEADER_SIZE) % BLOCK_SIZE:
+            FAILED_MALFORMED.inc()
+            raise ValueError("Malformed encrypted packet")
+        iv = packet[:IV_SIZE]
+        received_hmac = packet[IV_SIZE:HEADER_SIZE]
+        ciphertext = packet[HEADER_SIZE:]
 
+        if not hmac.compare_digest(received_hmac, self._digest(iv, ciphertext, aad)):
+            FAILED_HMAC.inc()
+            raise ValueError("HMAC verification failed! Possible message tampering.")
+
+        decryptor = Cipher(self._algorithm, modes.CBC(iv)).decryptor()
+        padded = decryptor.update(ciphertext) + decryptor.finalize()
+        pad = padded[-1]
+        if not 1 <= pad <= BLOCK_SIZE or padded[-pad:] != bytes((pad,)) * pad:
+            FAILED_PADDING.inc()
+            raise ValueError("Invalid padding")
+        return padded[:-pad]
+
+    def _decrypt_aead(self, packet, aad=b""):
+        packet = memoryview(packet)
+        if len(packet) < AEAD_HEADER_SIZE + TAG_SIZE:
+            FAILED_MALFORMED.inc()
+            raise ValueError("Malformed encrypted packet")
+        version = packet[0]
+        aead = self._aeads.get(version)
+        if aead is None:
+            if version not in AEAD_VERSIONS:
+                FAILED_VERSION.inc()
+                raise ValueError(f"Unknown packet version {version}")
+            aead = self._aeads[version] = derive_aead(self.key, AEAD_VERSIONS[version])
+        try:
+            return aead.decrypt(packet[1:AEAD_HEADER_SIZE], packet[AEAD_HEADER_SIZE:], bytes(packet[:1]) + aad)
+        except InvalidTag:
+            FAILED_TAG.inc()
+            raise ValueError("Authentication failed! Possible message tampering.") from None
+
+    def encrypt_many(self, messages):
+        # One urandom call supplies the IVs or nonces for the whole batch
+        if self.suite == SUITE_CBC_HMAC:
+            size, encrypt = IV_SIZE, self._encrypt
+        else:
+            size, encrypt = NONCE_SIZE, self._encrypt_aead
+        nonces = memoryview(os.urandom(size * len(messages)))
+        return [encrypt(bytes(nonces[i * size:(i + 1) * size]), data)
+                for i, data in enumerate(messages)]
+
+    def decrypt_many(self, packets):
+        decrypt = self.decrypt
+        return [decrypt(packet) for packet in packets]
+
+    def encrypt_text(self, text):
+        return self.encrypt(text.encode())
+
+    def decrypt_text(self, packet):
+        return self.decrypt(packet).decode()
+
+
+@lru_cache(maxsize=16)
+def get_cipher(key, suite=SUITE_CBC_HMAC):
+    return MessageCipher(key, suite)
+
+
+def encrypt_message(key, plaintext):
+    if isinstance(plaintext, str):
+        plaintext = plaintext.encode()
+    return get_cipher(key).encrypt(plaintext)
+
+
+def decrypt_message(key, encrypted_packet):
+    return get_cipher(key).decrypt(encrypted_packet).decode()
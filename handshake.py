@@ -0,0 +1,174 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from encryption import MessageCipher
+from protocol import ProtocolError, encode_control, CONTROL_HELLO, CONTROL_WELCOME
+
+NONCE_SIZE = 16
+TICKET_SIZE = 16
+SESSION_KEY_SIZE = 32
+ROOM_KEY_SIZE = 32
+ROOM_AAD = b"room key"
+TICKET_CACHE_SIZE = 10000
+TICKET_LIFETIME = 3600.0
+
+# A connection's keys: the session cipher protects frames between this
+# client and the server, the room cipher protects frames the server
+# broadcasts (encrypted once for every peer).
+Session = namedtuple("Session", "cipher room ticket resumed")
+SessionTicket = namedtuple("SessionTicket", "id secret")
+
+
+def public_bytes(private_key):
+    return private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+
+def derive_session(psk, secret, client_nonce, server_nonce, transcript=b""):
+    """Session key, resumption secret and confirmation key for one connection.
+
+    The shared key is the HKDF salt, so only peers holding it arrive at
+    the same keys; the ephemeral (or resumed) secret gives every session
+    its own. transcript binds the public keys exchanged.
+    """
+    material = HKDF(algorithm=hashes.SHA256(), length=SESSION_KEY_SIZE + 64, salt=psk,
+                    info=b"secure-chat session" + client_nonce + server_nonce + transcript).derive(secret)
+    return material[:SESSION_KEY_SIZE], material[SESSION_KEY_SIZE:-32], material[-32:]
+
+
+def confirmation(confirm_key, suite):
+    return hmac.new(confirm_key, b"server finished " + suite.encode(), hashlib.sha256).hexdigest()
+
+
+class TicketCache:
+    """Resumption secrets by ticket id, bounded and expiring, oldest evicted first.
+
+    Tickets are single use: redeeming one removes it, and the server
+    hands out a fresh ticket with every welcome.
+    """
+
+    def __init__(self, max_tickets=TICKET_CACHE_SIZE, lifetime=TICKET_LIFETIME):
+        self.max_tickets = max_tickets
+        self.lifetime = lifetime
+        self.tickets = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"issued": 0, "resumed": 0, "missed": 0, "evicted": 0}
+
+    def issue(self, secret):
+        ticket_id = os.urandom(TICKET_SIZE)
+        with self.lock:
+            self.tickets[ticket_id] = (secret, time.monotonic() + self.lifetime)
+            self.counters["issued"] += 1
+            while len(self.tickets) > self.max_tickets:
+                self.tickets.popitem(last=False)
+                self.counters["evicted"] += 1
+        return ticket_id
+
+    def redeem(self, ticket_id):
+        with self.lock:
+            entry = self.tickets.pop(ticket_id, None)
+            if entry is None or entry[1] < time.monotonic():
+                self.counters["missed"] += 1
+                return None
+            self.counters["resumed"] += 1
+            return entry[0]
+
+    def __len__(self):
+        return len(self.tickets)
+
+
+class ClientHandshake:
+    """Client side of the connect-time key exchange, independent of any socket.
+
+    hello() builds the first frame. With a ticket from an earlier session
+    it only asks to resume, which needs no X25519 operations; if the
+    server no longer has the ticket it answers hello_retry and retry()
+    builds a full hello. finish() checks the welcome and returns a Session.
+    options are extra hello fields offered to the server, such as codecs.
+    """
+
+    def __init__(self, psk, suites, ticket=None, **options):
+        self.psk = psk
+        self.suites = list(suites)
+        self.ticket = ticket
+        self.options = options
+        self.nonce = os.urandom(NONCE_SIZE)
+        self.private_key = None
+
+    def hello(self):
+        fields = dict(self.options, suites=self.suites, nonce=self.nonce.hex())
+        if self.ticket is not None:
+            fields["ticket"] = self.ticket.id.hex()
+        else:
+            self.private_key = X25519PrivateKey.generate()
+            fields["pub"] = public_bytes(self.private_key).hex()
+        return encode_control(CONTROL_HELLO, **fields)
+
+    def retry(self):
+        self.ticket = None
+        return self.hello()
+
+    def finish(self, msg):
+        suite = msg["suite"]
+        server_nonce = bytes.fromhex(msg["nonce"])
+        if msg.get("resumed"):
+            if self.ticket is None:
+                raise ProtocolError("Server resumed a session that was not offered")
+            secret, transcript = self.ticket.secret, b""
+        else:
+            if self.private_key is None:
+                raise ProtocolError("Server skipped the key exchange")
+            server_pub = bytes.fromhex(msg["pub"])
+            secret = self.private_key.exchange(X25519PublicKey.from_public_bytes(server_pub))
+            transcript = public_bytes(self.private_key) + server_pub
+        key, resumption, confirm_key = derive_session(self.psk, secret, self.nonce, server_nonce, transcript)
+        if not hmac.compare_digest(confirmation(confirm_key, suite), str(msg.get("confirm", ""))):
+            raise ProtocolError("Handshake failed: the server does not hold the shared key")
+
+        cipher = MessageCipher(key, suite)
+        room = MessageCipher(cipher.decrypt(bytes.fromhex(msg["room"]), aad=ROOM_AAD), suite)
+        ticket = SessionTicket(bytes.fromhex(msg["ticket"]), resumption) if "ticket" in msg else None
+        return Session(cipher, room, ticket, bool(msg.get("resumed")))
+
+
+def accept_hello(psk, msg, suite, tickets, room_key, **options):
+    """Server side: answer a hello with (welcome payload, session cipher).
+
+    options are extra welcome fields, such as the codec the server chose.
+
+    Returns (None, None) when the client only offered a ticket the cache
+    no longer holds; the caller asks it to retry with a full hello.
+    """
+    client_nonce = bytes.fromhex(msg["nonce"])
+    if len(client_nonce) != NONCE_SIZE:
+        raise ProtocolError("Invalid handshake nonce")
+    server_nonce = os.urandom(NONCE_SIZE)
+    fields = dict(options, suite=suite, nonce=server_nonce.hex())
+
+    secret = tickets.redeem(bytes.fromhex(msg["ticket"])) if "ticket" in msg else None
+    if secret is not None:
+        transcript = b""
+        fields["resumed"] = True
+    elif "pub" in msg:
+        client_pub = bytes.fromhex(msg["pub"])
+        private_key = X25519PrivateKey.generate()
+        server_pub = public_bytes(private_key)
+        secret = private_key.exchange(X25519PublicKey.from_public_bytes(client_pub))
+        transcript = client_pub + server_pub
+        fields["pub"] = server_pub.hex()
+    else:
+        return None, None
+
+    key, resumption, confirm_key = derive_session(psk, secret, client_nonce, server_nonce, transcript)
+    cipher = MessageCipher(key, suite)
+    fields["confirm"] = confirmation(confirm_key, suite)
+    fields["room"] = cipher.encrypt(room_key, aad=ROOM_AAD).hex()
+    fields["ticket"] = tickets.issue(resumption).hex()
+    return encode_control(CONTROL_WELCOME, **fields), cipher
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+
+from attachments import AttachmentReceiver, OutgoingTransfer, encode_chunk, KIND_FILE
+from compression import offer, accept_welcome
+from config import ChatConfig
+from encryption import SUPPORTED_SUITES
+from handshake import ClientHandshake
+from protocol import (FrameDecoder, ProtocolError, encode_frame, encode_control, decode_control, control_int,
+                      SEQ_HEADER, FRAME_TEXT, FRAME_CONTROL, FRAME_CHUNK, FRAME_HISTORY, CONTROL_HELLO_RETRY,
+                      CONTROL_WELCOME, CONTROL_ATTACH_START, CONTROL_ATTACH_RESUME, CONTROL_ATTACH_END,
+                      CONTROL_PING, CONTROL_ACK)
+
+CONNECT_TIMEOUT = 10
+# How long an upload waits for the server to accept it
+UPLOAD_TIMEOUT = 30
+
+log = logging.getLogger(__name__)
+
+
+class HeadlessClient(asyncio.BufferedProtocol):
+    """A chat client without a UI, on an asyncio event loop.
+
+    Speaks the same protocol as ChatClient: handshake, compression,
+    heartbeats, history and chunked attachments. What arrives is handed
+    to optional callbacks instead of a window:
+
+    - on_text(seq, sender, text): a chat message, decrypted and decompressed
+    - on_history(body): a decoded history page
+    - on_attachment(event, msg): the attach_start and attach_end controls
+      of an incoming attachment
+
+    Text frames are only decrypted if on_text is set, and chunks only if
+    spool_dir is, so thousands of clients that just count what they
+    receive stay cheap. There is no reconnect: a dropped connection sets
+    `closed` and the caller decides what to do. A caller that reconnects
+    passes since=<last seq seen> to get what it missed as history pages.
+    last_seq includes the client's own messages, which the server acks
+    with their seq; `name` is what history records them as.
+    """
+
+    def __init__(self, key=None, compress=True, dictionary=None, heartbeat=True, spool_dir=None,
+                 since=None, on_text=None, on_history=None, on_attachment=None):
+        self.key = key if key is not None else ChatConfig.from_env().key
+        self.since = since
+        self.compress = compress
+        self.dictionary = dictionary
+        self.heartbeat = heartbeat
+        self.on_text = on_text
+        self.on_history = on_history
+        self.on_attachment = on_attachment
+        self.decoder = FrameDecoder()
+        self.attachments = AttachmentReceiver(spool_dir) if spool_dir else None
+        self.transport = None
+        self.handshake = None
+        self.session = None
+        self.cipher = self.room = None
+        self.compressor = None
+        self.last_seq = 0
+        self.name = None
+        # Outgoing transfers waiting for the server's attach_resume
+        self.uploads = {}
+        self.ping_handle = None
+        self.welcomed = None
+        self.closed = None
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.frames_sent = 0
+
+    def connection_made(self, transport):
+        loop = asyncio.get_running_loop()
+        self.transport = transport
+        self.welcomed = loop.create_future()
+        self.closed = loop.create_future()
+        options = offer(self.dictionary) if self.compress else {}
+        if self.since is not None:
+            options["since"] = self.since
+        self.handshake = ClientHandshake(self.key, SUPPORTED_SUITES, heartbeat=self.heartbeat, **options)
+        self.send(FRAME_CONTROL, self.handshake.hello())
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def drain(self):
+        await self.can_write.wait()
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.bytes_received += nbytes
+        self.decoder.buffer_updated(nbytes)
+        try:
+            for frame_type, payload in self.decoder.frames():
+                self.frames_received += 1
+                self.handle_frame(frame_type, payload)
+        except (ProtocolError, ValueError) as e:
+            log.warning("Dropping the connection: %s", e)
+            self.transport.abort()
+
+    def connection_lost(self, exc):
+        self.can_write.set()
+        if self.ping_handle is not None:
+            self.ping_handle.cancel()
+        if self.attachments is not None:
+            self.attachments.close()
+        if not self.welcomed.done():
+            self.welcomed.set_exception(exc or ConnectionError("Server closed the connection during handshake"))
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def handle_frame(self, frame_type, data):
+        if self.session is None and frame_type in (FRAME_TEXT, FRAME_CHUNK):
+            # Relayed before the welcome under the static key, without a seq;
+            # the replay after the welcome covers the message, and a chunk
+            # missed here is asked for again when its transfer ends
+            return
+        if frame_type == FRAME_TEXT:
+            self.last_seq = SEQ_HEADER.unpack_from(data)[0]
+            if self.on_text is not None:
+                header = bytes(data[:SEQ_HEADER.size])
+                msg = json.loads(self.decompress(self.room.decrypt(data[SEQ_HEADER.size:], aad=header)))
+                self.on_text(self.last_seq, msg["from"], msg["text"])
+        elif frame_type == FRAME_HISTORY:
+            if self.on_history is not None:
+                self.on_history(json.loads(self.decompress(self.cipher.decrypt(data))))
+        elif frame_type == FRAME_CHUNK:
+            if self.attachments is not None:
+                self.attachments.chunk(self.room, data)
+        elif frame_type == FRAME_CONTROL:
+            self.handle_control(decode_control(data))
+
+    def handle_control(self, msg):
+        if msg["type"] == CONTROL_WELCOME:
+            self.session = self.handshake.finish(msg)
+            self.cipher, self.room = self.session.cipher, self.session.room
+            self.compressor = accept_welcome(msg, self.dictionary) if self.compress else None
+            self.name = msg.get("name")
+            interval = msg.get("heartbeat", 0)
+            if interval:
+                self.ping_handle = asyncio.get_running_loop().call_later(interval, self.ping, interval)
+            self.welcomed.set_result(self.session)
+        elif msg["type"] == CONTROL_HELLO_RETRY:
+            self.send(FRAME_CONTROL, self.handshake.retry())
+        elif msg["type"] == CONTROL_ACK:
+            self.last_seq = max(self.last_seq, control_int(msg, "seq"))
+        elif msg["type"] == CONTROL_ATTACH_RESUME:
+            waiter = self.uploads.get(msg["id"])
+            if waiter is not None and not waiter.done():
+                waiter.set_result(int(msg["index"]))
+        elif msg["type"] == CONTROL_ATTACH_START:
+            if self.attachments is not None:
+                # The server streams without waiting for attach_resume, which
+                # only asks it for missing chunks
+                self.attachments.start(msg)
+            if self.on_attachment is not None:
+                self.on_attachment(CONTROL_ATTACH_START, msg)
+        elif msg["type"] == CONTROL_ATTACH_END:
+            if self.attachments is not None:
+                transfer = self.attachments.finish(msg)
+                if not transfer.complete:
+                    # Chunks went missing on the way: the server sends the rest
+                    self.send(FRAME_CONTROL, transfer.resume_message())
+                    return
+            if self.on_attachment is not None:
+                self.on_attachment(CONTROL_ATTACH_END, msg)
+
+    def ping(self, interval):
+        if not self.transport.is_closing():
+            self.send(FRAME_CONTROL, encode_control(CONTROL_PING))
+            self.ping_handle = asyncio.get_running_loop().call_later(interval, self.ping, interval)
+
+    def decompress(self, data):
+        return data if self.compressor is None else self.compressor.decompress(data)
+
+    def send(self, frame_type, payload):
+        self.frames_sent += 1
+        self.transport.write(encode_frame(frame_type, payload))
+
+    def send_text(self, data):
+        # `data` is bytes or str; only valid once welcomed
+        if isinstance(data, str):
+            data = data.encode()
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.send(FRAME_TEXT, self.cipher.encrypt(data))
+
+    async def send_file(self, path, kind=KIND_FILE, name=None, data=None):
+        """Upload a file, or `data` under `name`, as a chunked attachment; returns once the last chunk is written."""
+        transfer = OutgoingTransfer(path, kind, name, data=data)
+        key = transfer.id.hex()
+        waiter = self.uploads[key] = asyncio.get_running_loop().create_future()
+        try:
+            self.send(FRAME_CONTROL, transfer.start_message())
+            transfer.resume_from(await asyncio.wait_for(waiter, UPLOAD_TIMEOUT))
+            for index, data in transfer.iter_chunks():
+                self.send(FRAME_CHUNK, encode_chunk(self.cipher, transfer.id, index, data))
+                await self.drain()
+            self.send(FRAME_CONTROL, transfer.end_message())
+        finally:
+            del self.uploads[key]
+        return transfer
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def connect(host=None, port=None, timeout=CONNECT_TIMEOUT, **options):
+    """Open a HeadlessClient and wait for its handshake; options go to HeadlessClient.
+
+    The host and port default to ChatConfig.from_env().
+    """
+    if host is None or port is None:
+        config = ChatConfig.from_env()
+        host = config.host if host is None else host
+        port = config.port if port is None else port
+    loop = asyncio.get_running_loop()
+    transport, client = await asyncio.wait_for(
+        loop.create_connection(lambda: HeadlessClient(**options), host, port), timeout)
+    try:
+        await asyncio.wait_for(asyncio.shield(client.welcomed), timeout)
+    except BaseException:
+        transport.abort()
+        raise
+    return client
@@ -0,0 +1,172 @@
+import asyncio
+from collections import deque
+
+from protocol import DEFAULT_WRITE_LATENCY
+
+POLICY_DROP = "drop"
+POLICY_DISCONNECT = "disconnect"
+POLICY_COALESCE = "coalesce"
+SLOW_CONSUMER_POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_COALESCE)
+
+DEFAULT_QUEUE_SIZE = 256
+DEFAULT_COALESCE_LIMIT = 8 * 1024 * 1024
+
+
+class Outbox:
+    """Bounded outbound queue drained by one writer task per connection.
+
+    The writer waits for the transport to drain before flushing more, so a
+    slow reader only ever fills its own queue. When the queue is full the
+    hub's slow-consumer policy decides what happens to the next frame.
+
+    Like FrameWriter, a connection written to within the last
+    write_latency seconds waits out the rest of it before the next write,
+    so bursts share one writelines() call.
+    """
+
+    def __init__(self, hub, conn):
+        self.hub = hub
+        self.conn = conn
+        self.pending = deque()
+        self.wakeup = asyncio.Event()
+        # Cleared while the queue is at least half full, for streaming senders
+        self.space = asyncio.Event()
+        self.space.set()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def put(self, frame):
+        hub = self.hub
+        if len(self.pending) < hub.queue_size:
+            self.pending.append(frame)
+            self.wakeup.set()
+            if len(self.pending) * 2 >= hub.queue_size:
+                self.space.clear()
+            return True
+
+        if hub.policy == POLICY_COALESCE:
+            last = self.pending[-1]
+            if len(last) + len(frame) <= hub.coalesce_limit:
+                if not isinstance(last, bytearray):
+                    last = self.pending[-1] = bytearray(last)
+                last += frame
+                hub.counters["coalesced"] += 1
+                return True
+        elif hub.policy == POLICY_DROP:
+            hub.counters["dropped"] += 1
+            return False
+
+        hub.counters["slow_disconnects"] += 1
+        hub.remove(self.conn)
+        self.conn.transport.abort()
+        return False
+
+    async def _run(self):
+        conn = self.conn
+        hub = self.hub
+        counters = hub.counters
+        loop = asyncio.get_running_loop()
+        last_write = 0.0
+        try:
+            while True:
+                if not self.pending:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                delay = last_write + hub.write_latency - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                batch = list(self.pending)
+                self.pending.clear()
+                conn.transport.writelines(batch)
+                counters["sent"] += len(batch)
+                counters["writes"] += 1
+                counters["bytes_written"] += sum(map(len, batch))
+                await conn.drain()
+                last_write = loop.time()
+                self.space.set()
+        except asyncio.CancelledError:
+            pass
+
+    def close(self):
+        self.task.cancel()
+        self.pending.clear()
+        self.space.set()
+
+
+class BroadcastHub:
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, policy=POLICY_DROP,
+                 coalesce_limit=DEFAULT_COALESCE_LIMIT, write_latency=DEFAULT_WRITE_LATENCY):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.coalesce_limit = coalesce_limit
+        self.write_latency = write_latency
+        self.outboxes = {}
+        self.counters = {"broadcasts": 0, "enqueued": 0, "sent": 0, "dropped": 0,
+                         "coalesced": 0, "slow_disconnects": 0, "writes": 0, "bytes_written": 0}
+
+    def add(self, conn):
+        self.outboxes[conn] = Outbox(self, conn)
+
+    def remove(self, conn):
+        outbox = self.outboxes.pop(conn, None)
+        if outbox is not None:
+            outbox.close()
+
+    def send(self, conn, frame):
+        outbox = self.outboxes.get(conn)
+        if outbox is not None and outbox.put(frame):
+            self.counters["enqueued"] += 1
+
+    def broadcast(self, frame, exclude=None, recipients=None):
+        # frame is encoded (and encrypted) once and every queue shares it. It
+        # may also be a callable returning the frame for a connection (or
+        # None to skip it), for callers that encode once per variant (such
+        # as cipher suite). Returns how many queues took it.
+        self.counters["broadcasts"] += 1
+        frame_for = frame if callable(frame) else None
+        if recipients is None:
+            targets = list(self.outboxes.items())
+        else:
+            targets = [(conn, self.outboxes[conn]) for conn in recipients if conn in self.outboxes]
+        enqueued = 0
+        for conn, outbox in targets:
+            if conn is exclude:
+                continue
+            if frame_for is not None:
+                frame = frame_for(conn)
+                if frame is None:
+                    continue
+            if outbox.put(frame):
+                enqueued += 1
+        self.counters["enqueued"] += enqueued
+        return enqueued
+
+    async def wait_for_space(self, conns, timeout=None):
+        waiters = [outbox.space.wait() for outbox in map(self.outboxes.get, conns)
+                   if outbox is not None and not outbox.space.is_set()]
+        if not waiters:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.gather(*waiters), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def queue_depths(self):
+        return {conn: outbox.depth for conn, outbox in self.outboxes.items()}
+
+    def stats(self):
+        depths = [outbox.depth for outbox in self.outboxes.values()]
+        stats = dict(self.counters)
+        stats["connections"] = len(depths)
+        stats["queued"] = sum(depths)
+        stats["max_queue_depth"] = max(depths, default=0)
+        writes = stats["writes"] or 1
+        stats["frames_per_write"] = stats["sent"] / writes
+        stats["bytes_per_write"] = stats["bytes_written"] / writes
+        return stats
@@ -0,0 +1,125 @@
+import hashlib
+import io
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+THUMBNAIL_SIZE = (300, 300)
+CACHE_BYTES = 64 * 1024 * 1024
+MAX_UI_IMAGES = 200
+
+
+def content_key(source):
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(256 * 1024), b""):
+                digest.update(block)
+    else:
+        digest.update(source)
+    return digest.hexdigest()
+
+
+def image_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+class ThumbnailCache:
+    """Thread-safe LRU of decoded thumbnails keyed by content hash, bounded by pixel memory."""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+            return img
+
+    def put(self, key, img):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= image_bytes(old)
+            self.entries[key] = img
+            self.size += image_bytes(img)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= image_bytes(evicted)
+
+
+class ThumbnailLoader:
+    """Decodes and thumbnails images on a worker pool.
+
+    submit() returns immediately; finished thumbnails are queued as
+    (token, key, image, error) and collected on the Tk thread with poll().
+    """
+
+    def __init__(self, cache=None, workers=2, size=THUMBNAIL_SIZE):
+        self.cache = cache or ThumbnailCache()
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        self.results = queue.SimpleQueue()
+
+    def submit(self, source, token):
+        # source is the encoded image as bytes or a path to it
+        self.executor.submit(self._load, source, token)
+
+    def _load(self, source, token):
+        try:
+            key = content_key(source)
+            img = self.cache.get(key)
+            if img is None:
+                # PIL loads with the first image rather than at startup
+                from PIL import Image
+
+                img = Image.open(source if isinstance(source, str) else io.BytesIO(source))
+                img.draft("RGB", self.size)
+                img.thumbnail(self.size)
+                img.load()
+                self.cache.put(key, img)
+            self.results.put((token, key, img, None))
+        except Exception as e:
+            self.results.put((token, None, None, e))
+
+    def poll(self):
+        done = []
+        while True:
+            try:
+                done.append(self.results.get_nowait())
+            except queue.Empty:
+                return done
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PhotoCache:
+    """PhotoImages shown in the chat window, keyed by content hash.
+
+    Tk only keeps an image on screen while Python holds a reference to its
+    PhotoImage. Identical images share one PhotoImage, and only the most
+    recent max_images stay alive; older ones are released and blank out.
+    Must only be used from the Tk thread.
+    """
+
+    def __init__(self, max_images=MAX_UI_IMAGES):
+        self.max_images = max_images
+        self.photos = OrderedDict()
+
+    def photo_for(self, key, img):
+        photo = self.photos.get(key)
+        if photo is None:
+            from PIL import ImageTk
+
+            photo = self.photos[key] = ImageTk.PhotoImage(img)
+            while len(self.photos) > self.max_images:
+                self.photos.popitem(last=False)
+        else:
+            self.photos.move_to_end(key)
+        return photo
@@ -0,0 +1,184 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# Below DEBUG: sampled packet dumps, only ever enabled per module while debugging
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+DEFAULT_LEVELS = "INFO"
+DEFAULT_TRACE_SAMPLE = 0.01
+TRACE_BYTES = 64
+QUEUE_SIZE = 10000
+# Records written per batch (one write and one flush) by the log thread
+WRITE_BATCH = 512
+WRITE_DELAY = 0.005
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_writer = None
+_configured = set()
+_trace_sample = 0.0
+
+
+class StructuredFormatter(logging.Formatter):
+    """One line per record: the message followed by its extra= fields.
+
+    Fields are meant for sizes, sequence numbers, latencies and the like;
+    callers never pass message contents.
+    """
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+        if self.json_lines:
+            entry = {"time": round(record.created, 6), "level": record.levelname,
+                     "logger": record.name, "msg": record.getMessage()}
+            entry.update(fields)
+            if record.exc_info:
+                entry["exc"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        created = time.strftime("%H:%M:%S", time.localtime(record.created))
+        line = f"{created}.{int(record.msecs):03d} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the log thread without ever blocking the caller.
+
+    When the queue is full (the console cannot keep up) records are
+    counted and dropped instead of stalling the network threads.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the log thread. Callers only pass immutable
+        # args and fields, so the record can be handed over as it is.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter:
+    """Background thread that formats queued records and writes them in batches."""
+
+    _STOP = object()
+
+    def __init__(self, log_queue, stream, formatter):
+        self.queue = log_queue
+        self.stream = stream
+        self.formatter = formatter
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        format_record = self.formatter.format
+        while True:
+            batch = [self.queue.get()]
+            # Let a burst accumulate rather than waking for every record
+            time.sleep(WRITE_DELAY)
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Records queued after the marker by other threads are still written
+            stop = any(record is self._STOP for record in batch)
+            if stop:
+                batch = [record for record in batch if record is not self._STOP]
+            lines = []
+            for record in batch:
+                try:
+                    lines.append(format_record(record))
+                except Exception as e:
+                    lines.append(f"Unformattable log record {record.msg!r}: {e}")
+            if lines:
+                self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
+            if stop:
+                return
+
+    def stop(self):
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+
+def parse_levels(spec):
+    # "INFO,server_core=DEBUG" -> {"": "INFO", "server_core": "DEBUG"}; "" is the root logger
+    levels = {}
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = part.rpartition("=")
+        levels[name] = level.upper()
+    return levels
+
+
+def setup_logging(levels=None, json_lines=False, stream=None, trace_sample=None, queue_size=QUEUE_SIZE):
+    """Route all logging through a background thread and apply per-module levels.
+
+    levels is a spec such as "INFO,server_core=DEBUG"; it defaults to the
+    CHAT_LOG environment variable. trace_sample (default CHAT_TRACE_SAMPLE)
+    is the fraction of packets dumped by trace_packet() on TRACE loggers.
+    Calling it again replaces the previous setup.
+    """
+    global _writer, _trace_sample
+    shutdown_logging()
+    if levels is None:
+        levels = os.environ.get("CHAT_LOG", DEFAULT_LEVELS)
+    if trace_sample is None:
+        trace_sample = float(os.environ.get("CHAT_TRACE_SAMPLE", DEFAULT_TRACE_SAMPLE))
+    _trace_sample = trace_sample
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for name in _configured:
+        logging.getLogger(name).setLevel(logging.NOTSET)
+    _configured.clear()
+    for name, level in parse_levels(levels).items():
+        logging.getLogger(name or None).setLevel(level)
+        if name:
+            _configured.add(name)
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    root.addHandler(handler)
+    _writer = LogWriter(handler.queue, stream or sys.stderr, StructuredFormatter(json_lines))
+    return handler
+
+
+@atexit.register
+def shutdown_logging():
+    # Flushes whatever is still queued
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+def trace_packet(logger, msg, packet, **fields):
+    """Log the start of an (encrypted) packet for a sample of calls at TRACE level."""
+    if logger.isEnabledFor(TRACE) and random.random() < _trace_sample:
+        fields["bytes"] = len(packet)
+        fields["head"] = bytes(packet[:TRACE_BYTES]).hex()
+        logger.log(TRACE, msg, extra=fields)
@@ -0,0 +1,342 @@
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from collections import deque
+
+from encryption import MessageCipher, SUITE_AES_GCM, derive_subkey
+
+# Each record is: packet length || seq || timestamp (microseconds) || packet.
+# seq and timestamp stay in the clear so the index can be rebuilt without
+# decrypting anything; they are authenticated as the packet's associated data.
+RECORD_HEADER = struct.Struct("!IQq")
+RECORD_AAD = slice(4, RECORD_HEADER.size)
+
+SEGMENT_SUFFIX = ".log"
+# Segments are named after the seq of their first record
+SEGMENT_NAME = re.compile(r"(\d{20})" + re.escape(SEGMENT_SUFFIX))
+SEGMENT_BYTES = 64 * 1024 * 1024
+# Every INDEX_INTERVAL-th record is indexed; lookups scan forward from there
+INDEX_INTERVAL = 64
+# Newest records kept decrypted in memory for replay to connecting clients
+TAIL_RECORDS = 1024
+# Appends block once this many records are waiting for the writer
+MAX_PENDING = 64 * 1024
+READ_BLOCK = 64 * 1024
+READ_FLAGS = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+
+log = logging.getLogger(__name__)
+
+if hasattr(os, "pread"):
+    pread = os.pread
+else:  # Windows
+    _seek_lock = threading.Lock()
+
+    def pread(fd, size, offset):
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, size)
+
+
+class MessageStore:
+    """Append-only encrypted message log split across segment files.
+
+    Records are numbered from 1 and each is encrypted on its own with a key
+    derived from the chat key. append() assigns the seq and timestamp and
+    returns at once; a writer thread encrypts everything queued since its
+    last pass and writes it with one write and one fsync (group commit).
+
+    The index is sparse and in memory: the segment, offset and timestamp
+    of every INDEX_INTERVAL-th record, a few MB for 10M records. It is
+    rebuilt from the record headers on open, and a torn record left by a
+    crash is truncated away.
+
+    If a write fails the store stops accepting records: later appends
+    raise rather than leave a gap that recovery would truncate at.
+    """
+
+    def __init__(self, directory, key, segment_bytes=SEGMENT_BYTES, index_interval=INDEX_INTERVAL,
+                 tail_records=TAIL_RECORDS, fsync=True):
+        self.directory = directory
+        self.cipher = MessageCipher(derive_subkey(key, b"message-store"), SUITE_AES_GCM)
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync = fsync
+
+        self.segments = []  # read-only descriptor per segment, oldest first
+        self.index_segment = array("I")
+        self.index_offset = array("Q")
+        self.index_time = array("q")
+        self.committed_seq = 0
+        self.commits = 0
+        self.file = None
+        self.position = 0
+
+        self.tail = deque(maxlen=tail_records)
+        self.queue = []
+        # The batch the writer is committing; with the queue, every record past committed_seq
+        self.writing = []
+        self.closed = False
+        self.failed = None
+        self.changed = threading.Condition()
+
+        os.makedirs(directory, exist_ok=True)
+        self.last_time = self._recover()
+        self.next_seq = self.committed_seq + 1
+        self.tail.extend(self._read_disk(max(1, self.next_seq - tail_records), self.next_seq, raw=True))
+        self.writer = threading.Thread(target=self._write_loop, name="message-store", daemon=True)
+        self.writer.start()
+
+    def _segment_path(self, base_seq):
+        return os.path.join(self.directory, f"{base_seq:020d}{SEGMENT_SUFFIX}")
+
+    def _recover(self):
+        # Other files in the directory (a stray server.log) are left alone
+        segments = sorted(int(match.group(1)) for match in map(SEGMENT_NAME.fullmatch, os.listdir(self.directory))
+                          if match)
+        last_time = 0
+        path = None
+        for base_seq in segments:
+            if base_seq != self.committed_seq + 1:
+                log.warning("Ignoring %s, which does not follow seq %d", self._segment_path(base_seq),
+                            self.committed_seq)
+                continue
+            path = self._segment_path(base_seq)
+            offset, last_time = self._scan(path, len(self.segments), last_time)
+            if offset < os.path.getsize(path):
+                log.warning("Truncating %s after an incomplete write", path, extra={"offset": offset})
+                os.truncate(path, offset)
+            self.segments.append(os.open(path, READ_FLAGS))
+            self.position = offset
+        if path is not None:
+            self.file = open(path, "ab")
+        else:
+            self._roll(1)
+        return last_time
+
+    def _scan(self, path, segment, last_time):
+        size = os.path.getsize(path)
+        offset = 0
+        if not size:
+            return offset, last_time
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            unpack_from = RECORD_HEADER.unpack_from
+            while offset + RECORD_HEADER.size <= size:
+                length, seq, timestamp = unpack_from(data, offset)
+                end = offset + RECORD_HEADER.size + length
+                if end > size or seq != self.committed_seq + 1:
+                    break
+                self._index(seq, timestamp, segment, offset)
+                self.committed_seq = seq
+                last_time = timestamp
+                offset = end
+        return offset, last_time
+
+    def _index(self, seq, timestamp, segment, offset):
+        if (seq - 1) % self.index_interval == 0:
+            self.index_segment.append(segment)
+            self.index_offset.append(offset)
+            self.index_time.append(timestamp)
+
+    def _roll(self, base_seq):
+        if self.file is not None:
+            self.file.close()
+        path = self._segment_path(base_seq)
+        self.file = open(path, "ab")
+        self.segments.append(os.open(path, READ_FLAGS))
+        self.position = 0
+
+    def append(self, payload, timestamp=None):
+        # Thread-safe and does not wait for the disk; returns the record's seq
+        with self.changed:
+            while len(self.queue) >= MAX_PENDING and not self.closed and self.failed is None:
+                self.changed.wait()
+            if self.failed is not None:
+                raise ValueError(f"Message store failed: {self.failed}")
+            if self.closed:
+                raise ValueError("Message store is closed")
+            timestamp = int((time.time() if timestamp is None else timestamp) * 1_000_000)
+            # Timestamps never go backwards, so the index can be bisected
+            timestamp = self.last_time = max(timestamp, self.last_time)
+            seq = self.next_seq
+            self.next_seq += 1
+            record = (seq, timestamp, bytes(payload))
+            self.queue.append(record)
+            self.tail.append(record)
+            self.changed.notify_all()
+            return seq
+
+    def sync(self, timeout=None):
+        """Wait until everything appended so far is on disk; False if it never will be."""
+        with self.changed:
+            seq = self.next_seq - 1
+            self.changed.wait_for(lambda: self.committed_seq >= seq or self.failed is not None, timeout)
+            return self.committed_seq >= seq
+
+    def _write_loop(self):
+        while True:
+            with self.changed:
+                while not self.queue and not self.closed:
+                    self.changed.wait()
+                if not self.queue:
+                    return
+                batch, self.queue = self.queue, []
+                self.writing = batch
+                self.changed.notify_all()
+            start = time.perf_counter()
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # The batch may be half written, and recovery stops at the first
+                # missing seq, so writing anything after it would lose it too
+                log.exception("Failed to write records; no longer accepting messages",
+                              extra={"records": len(batch), "first_seq": batch[0][0]})
+                with self.changed:
+                    self.failed = e
+                    self.changed.notify_all()
+                return
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Committed", extra={"records": len(batch), "last_seq": batch[-1][0],
+                                              "ms": round((time.perf_counter() - start) * 1000, 3)})
+
+    def _commit(self, batch):
+        encrypt = self.cipher.encrypt
+        chunks = []
+        indexed = []
+        for seq, timestamp, payload in batch:
+            if self.position >= self.segment_bytes:
+                self._write(chunks)
+                chunks = []
+                self._roll(seq)
+            header = RECORD_HEADER.pack(0, seq, timestamp)
+            packet = encrypt(payload, aad=header[RECORD_AAD])
+            chunks += [RECORD_HEADER.pack(len(packet), seq, timestamp), packet]
+            indexed.append((seq, timestamp, len(self.segments) - 1, self.position))
+            self.position += RECORD_HEADER.size + len(packet)
+        self._write(chunks)
+
+        # Only durable records become visible to readers
+        for entry in indexed:
+            self._index(*entry)
+        with self.changed:
+            self.committed_seq = batch[-1][0]
+            self.writing = []
+            self.commits += 1
+            self.changed.notify_all()
+
+    def _write(self, chunks):
+        if not chunks:
+            return
+        self.file.write(b"".join(chunks))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def _records_from(self, segment, offset):
+        # (seq, timestamp, header, packet) for every record from a position on
+        size = RECORD_HEADER.size
+        while segment < len(self.segments):
+            fd = self.segments[segment]
+            buf = b""
+            pos = 0
+            while True:
+                if len(buf) - pos < size:
+                    buf, pos = pread(fd, READ_BLOCK, offset), 0
+                    if len(buf) < size:
+                        break
+                length, seq, timestamp = RECORD_HEADER.unpack_from(buf, pos)
+                end = pos + size + length
+                if end > len(buf):
+                    buf, pos = pread(fd, max(READ_BLOCK, size + length), offset), 0
+                    if len(buf) < size + length:
+                        break
+                    continue
+                yield seq, timestamp, buf[pos:pos + size], buf[pos + size:end]
+                offset += end - pos
+                pos = end
+            segment += 1
+            offset = 0
+
+    def _read_disk(self, lo, hi, raw=False):
+        hi = min(hi, self.committed_seq + 1)
+        if lo >= hi:
+            return []
+        k = (lo - 1) // self.index_interval
+        decrypt = self.cipher.decrypt
+        records = []
+        for seq, timestamp, header, packet in self._records_from(self.index_segment[k], self.index_offset[k]):
+            if seq >= hi:
+                break
+            if seq >= lo:
+                payload = decrypt(packet, aad=header[RECORD_AAD])
+                records.append((seq, timestamp, payload) if raw else (seq, timestamp / 1e6, payload))
+        return records
+
+    def read_range(self, lo, hi):
+        """Records with lo <= seq < hi as (seq, timestamp, payload), oldest first."""
+        lo = max(lo, 1)
+        with self.changed:
+            hi = min(hi, self.next_seq)
+            if lo >= hi:
+                return []
+            if self.tail and lo >= self.tail[0][0]:
+                first = self.tail[0][0]
+                tail = list(self.tail)
+                return [(seq, timestamp / 1e6, payload)
+                        for seq, timestamp, payload in tail[lo - first:hi - first]]
+            committed = self.committed_seq
+            # Appended but not on disk yet, and possibly no longer in the tail either
+            pending = [] if hi <= committed + 1 else self.writing + self.queue
+        records = self._read_disk(lo, min(hi, committed + 1))
+        records += [(seq, timestamp / 1e6, payload) for seq, timestamp, payload in pending if lo <= seq < hi]
+        return records
+
+    def latest(self, count):
+        return self.read_range(self.next_seq - count, self.next_seq)
+
+    def before(self, seq, count):
+        return self.read_range(max(1, seq - count), seq)
+
+    def seq_at(self, timestamp):
+        """First seq written at or after timestamp, or next_seq if there is none."""
+        timestamp = int(timestamp * 1_000_000)
+        with self.changed:
+            committed = self.committed_seq
+            # Anything older than the in-memory tail is earlier than its first record
+            if self.tail and self.tail[0][1] < timestamp:
+                for seq, recorded, _ in self.tail:
+                    if recorded >= timestamp:
+                        return seq
+                return self.next_seq
+        # The sparse entry at or before the timestamp, then scan forward
+        k = bisect.bisect_left(self.index_time, timestamp) - 1
+        if k < 0:
+            return 1
+        for seq, recorded, _, _ in self._records_from(self.index_segment[k], self.index_offset[k]):
+            if recorded >= timestamp or seq > committed:
+                return seq
+        return committed + 1
+
+    def read_time_range(self, start, end, limit=None):
+        """Records with start <= timestamp < end, oldest first, at most limit of them."""
+        lo = self.seq_at(start)
+        hi = self.seq_at(end)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return self.read_range(lo, hi)
+
+    def close(self):
+        with self.changed:
+            if self.closed:
+                return
+            self.closed = True
+            self.changed.notify_all()
+        self.writer.join()
+        self.file.close()
+        for fd in self.segments:
+            os.close(fd)
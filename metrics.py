@@ -0,0 +1,271 @@
+import bisect
+import logging
+import math
+import os
+
+# Seconds; from 10 us to 2.5 s, for work done per frame or per broadcast
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25,
+                   0.5, 1.0, 2.5)
+# Counts, such as the recipients of one broadcast
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+log = logging.getLogger(__name__)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    """A named family of samples, one per combination of label values.
+
+    Metrics are updated without locks: the server only touches them on
+    its event loop thread, and elsewhere a rare lost increment is an
+    acceptable price for keeping hot paths cheap. `func`, if given, is
+    called at scrape time instead, returning a value or a
+    {label values: value} dict, so numbers the server already keeps
+    (such as the hub's counters) cost nothing until scraped.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), func=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.children = {}
+
+    def labels(self, *values):
+        # Callers on hot paths keep the child rather than looking it up per event
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        if self.func is not None:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in values.items():
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                yield self.name, format_labels(self.labelnames, labels), value
+            return
+        for labels, child in self.children.items():
+            yield self.name, format_labels(self.labelnames, labels), child.value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples()]
+        return lines
+
+
+class Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    """Prometheus histogram: cumulative counts at fixed upper bounds, plus sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for labels, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield (f"{self.name}_bucket", format_labels(self.labelnames, labels, [("le", format_value(bound))]),
+                       cumulative)
+            yield f"{self.name}_sum", format_labels(self.labelnames, labels), child.sum
+            yield f"{self.name}_count", format_labels(self.labelnames, labels), child.count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=(), func=None):
+        return self.register(Counter(name, help, labelnames, func))
+
+    def gauge(self, name, help, labelnames=(), func=None):
+        return self.register(Gauge(name, help, labelnames, func))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines += metric.render()
+            except Exception:
+                log.exception("Failed to collect %s", metric.name)
+        return lines
+
+
+# Process-wide metrics of modules used outside the server too, such as encryption
+REGISTRY = Registry()
+
+
+def render(*registries):
+    lines = []
+    for registry in registries:
+        lines += registry.render()
+    return ("\n".join(lines) + "\n").encode()
+
+
+class MetricsServer:
+    """Serves the registries as Prometheus text over HTTP, on TCP or a Unix socket.
+
+    `address` is "host:port", ":port" (loopback) or a socket path. It runs
+    on the caller's event loop, so scrapes see the server's metrics
+    between events, never halfway through one. GET /metrics returns the
+    metrics; GET /profile?seconds=N samples stacks for N seconds (see
+    profiling.py) and returns them in collapsed form.
+    """
+
+    def __init__(self, address, registries, profiler=None):
+        self.address = address
+        self.registries = registries
+        self.profiler = profiler
+        self.server = None
+
+    async def start(self):
+        # Only a server imports asyncio for this; clients load the module for its counters
+        import asyncio
+
+        if "/" in self.address or os.sep in self.address:
+            self.server = await asyncio.start_unix_server(self._serve, self.address)
+            os.chmod(self.address, 0o600)
+        else:
+            host, _, port = self.address.rpartition(":")
+            self.server = await asyncio.start_server(self._serve, host or "127.0.0.1", int(port))
+        log.info("Metrics on %s", self.address)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            if "/" in self.address or os.sep in self.address:
+                try:
+                    os.remove(self.address)
+                except OSError:
+                    pass
+
+    async def _serve(self, reader, writer):
+        import asyncio
+
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # Headers are read and ignored
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            path, _, query = (parts[1] if len(parts) > 1 else "").partition("?")
+            if len(parts) < 2 or parts[0] != "GET":
+                status, body = "405 Method Not Allowed", b""
+            elif path == "/metrics":
+                status, body = "200 OK", render(*self.registries)
+            elif path == "/profile" and self.profiler is not None:
+                params = dict(pair.partition("=")[::2] for pair in query.split("&") if pair)
+                seconds = min(float(params.get("seconds", 5)), 300)
+                stacks = await asyncio.get_running_loop().run_in_executor(None, self.profiler.sample, seconds)
+                status, body = "200 OK", stacks.encode()
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,81 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_DURATION = 10.0
+DEFAULT_PROFILE_DIR = "profiles"
+MAX_DEPTH = 128
+
+log = logging.getLogger(__name__)
+
+
+def frame_label(code):
+    # ";" separates frames in collapsed stacks and " " the count
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class SamplingProfiler:
+    """Samples every thread's Python stack from a background thread.
+
+    Nothing is hooked into the interpreter, so the server runs at full
+    speed until a profile is asked for, and only pays for a
+    sys._current_frames() call every `interval` while one runs. Stacks
+    come out collapsed, one "thread;outer;...;inner count" line each,
+    which flamegraph.pl, speedscope and inferno read directly.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, directory=DEFAULT_PROFILE_DIR):
+        self.interval = interval
+        self.directory = directory
+        # One profile at a time; a trigger while one runs is ignored
+        self.busy = threading.Lock()
+
+    def sample(self, seconds):
+        """Profile for `seconds` on the calling thread and return the collapsed stacks."""
+        with self.busy:
+            return self._sample(seconds)
+
+    def _sample(self, seconds):
+        stacks = Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < MAX_DEPTH:
+                    labels.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}").replace(";", ":").replace(" ", "_"))
+                stacks[";".join(reversed(labels))] += 1
+            time.sleep(self.interval)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def trigger(self, seconds=DEFAULT_DURATION):
+        """Profile in the background and write the stacks to a file; safe to call from a signal handler."""
+        if self.busy.locked():
+            log.warning("A profile is already running")
+            return
+        threading.Thread(target=self._write, args=(seconds,), name="profiler", daemon=True).start()
+
+    def _write(self, seconds):
+        if not self.busy.acquire(blocking=False):
+            return
+        try:
+            log.info("Profiling for %.0fs", seconds)
+            stacks = self._sample(seconds)
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+            with open(path, "w") as f:
+                f.write(stacks)
+            log.info("Wrote profile to %s", path, extra={"stacks": stacks.count("\n")})
+        except Exception:
+            log.exception("Profiling failed")
+        finally:
+            self.busy.release()
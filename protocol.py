@@ -0,0 +1,341 @@
+import json
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+# Every frame on the wire is: type (1 byte) || payload length (8 bytes) || payload
+FRAME_TEXT = 1
+FRAME_IMAGE = 2
+FRAME_CONTROL = 3
+FRAME_CHUNK = 4
+FRAME_HISTORY = 5
+
+FRAME_TYPES = (FRAME_TEXT, FRAME_IMAGE, FRAME_CONTROL, FRAME_CHUNK, FRAME_HISTORY)
+FRAME_NAMES = {FRAME_TEXT: "text", FRAME_IMAGE: "image", FRAME_CONTROL: "control", FRAME_CHUNK: "chunk",
+               FRAME_HISTORY: "history"}
+
+# Control frames carry a JSON object whose "type" is one of these
+CONTROL_HELLO = "hello"
+CONTROL_HELLO_RETRY = "hello_retry"
+CONTROL_WELCOME = "welcome"
+CONTROL_ATTACH_START = "attach_start"
+CONTROL_ATTACH_RESUME = "attach_resume"
+CONTROL_ATTACH_END = "attach_end"
+CONTROL_HISTORY = "history"
+CONTROL_PING = "ping"
+CONTROL_PONG = "pong"
+# The seq given to the sender's own message, which is not relayed back to it
+CONTROL_ACK = "ack"
+
+HEADER = struct.Struct("!BQ")
+HEADER_SIZE = HEADER.size
+
+# After the welcome, text frames from the server start with the message's
+# seq, authenticated as associated data of the packet that follows
+SEQ_HEADER = struct.Struct("!Q")
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# Largest payload a client may send the server: a 256 KiB attachment chunk
+# with its chunk header and cipher overhead, with room to spare. Until the
+# handshake completes a peer only sends a hello or, for legacy clients,
+# short texts, so the limit is much lower.
+MAX_FRAME_SIZE = 256 * 1024 + 4096
+MAX_HANDSHAKE_FRAME_SIZE = 16 * 1024
+
+# Clients that ask for heartbeats ping this often (the server's welcome
+# says how often), and either side gives up on a peer that has sent
+# nothing for HEARTBEAT_MISSES intervals
+DEFAULT_HEARTBEAT = 15.0
+HEARTBEAT_MISSES = 3
+
+# Nagle-style batching budget: how long a frame may wait for others to
+# share its write when the socket was written to just before
+DEFAULT_WRITE_LATENCY = 0.001
+# Flush without waiting out the budget once this much is pending, and make
+# bulk senders wait while more than MAX_PENDING_BYTES of theirs is; a write
+# takes at most WRITE_BATCH_BYTES of bulk frames, so others wait for no more
+WRITE_BATCH_BYTES = 256 * 1024
+MAX_PENDING_BYTES = 4 * 1024 * 1024
+# Buffers per sendmsg() call (the usual IOV_MAX)
+MAX_IOVECS = 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(frame_type, length):
+    return HEADER.pack(frame_type, length)
+
+
+def encode_frame(frame_type, payload):
+    return HEADER.pack(frame_type, len(payload)) + payload
+
+
+def send_frame(sock, frame_type, payload):
+    # Header and payload go out separately so large payloads are never copied
+    sock.sendall(HEADER.pack(frame_type, len(payload)))
+    sock.sendall(payload)
+
+
+def set_nodelay(sock):
+    # Batching happens in FrameWriter and the hub, so the kernel must not hold writes back too
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def encode_control(msg_type, /, **fields):
+    fields["type"] = msg_type
+    return json.dumps(fields, separators=(",", ":")).encode()
+
+
+def decode_control(payload):
+    msg = json.loads(bytes(payload))
+    if not isinstance(msg, dict) or "type" not in msg:
+        raise ProtocolError("Malformed control frame")
+    return msg
+
+
+def control_int(msg, name, default=None):
+    # A control message's non-negative integer field, or default when it is absent
+    value = msg.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ProtocolError(f"Invalid {name} in {msg['type']} control frame")
+    return value
+
+
+class FrameDecoder:
+    """Incremental frame parser over a single reusable receive buffer.
+
+    The caller asks for a writable view with get_buffer(), fills it (for
+    example with sock.recv_into) and reports the byte count through
+    buffer_updated(). frames() then yields (frame_type, memoryview) pairs.
+    Yielded views point into the receive buffer and are only valid until
+    the next get_buffer() call; copy them with bytes() to keep them.
+
+    The method names match asyncio.BufferedProtocol so the same decoder
+    can sit behind a blocking socket or an event loop transport.
+
+    A frame longer than max_frame_size (None: no limit) raises
+    ProtocolError as soon as its header is read, before any of it is
+    buffered, so an untrusted peer cannot make the buffer grow without
+    bound.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_frame_size=None):
+        self.max_frame_size = max_frame_size
+        self._initial_size = buffer_size
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._need = HEADER_SIZE
+
+    @property
+    def pending(self):
+        return self._end - self._start
+
+    def get_buffer(self, sizehint=-1):
+        pending = self._end - self._start
+        if pending == 0:
+            self._start = self._end = 0
+        if len(self._buf) > self._initial_size and max(self._need, pending) <= self._initial_size // 2:
+            # Back to the initial size after a large frame, once what is left is small
+            self._reallocate(self._initial_size)
+        elif self._start and (self._need > len(self._buf) - self._start or self._end == len(self._buf)):
+            if self._need > len(self._buf):
+                self._reallocate(self._need)
+            else:
+                self._buf[:pending] = self._buf[self._start:self._end]
+                self._start, self._end = 0, pending
+        elif self._need > len(self._buf):
+            self._reallocate(self._need)
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    def _reallocate(self, size):
+        pending = self._end - self._start
+        buf = bytearray(max(size, pending))
+        buf[:pending] = self._view[self._start:self._end]
+        self._view.release()
+        self._buf = buf
+        self._view = memoryview(buf)
+        self._start, self._end = 0, pending
+
+    def frames(self):
+        view = self._view
+        while self._end - self._start >= HEADER_SIZE:
+            frame_type, length = HEADER.unpack_from(view, self._start)
+            if frame_type not in FRAME_TYPES:
+                raise ProtocolError(f"Unknown frame type {frame_type}")
+            if self.max_frame_size is not None and length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes is over the {self.max_frame_size} byte limit")
+            total = HEADER_SIZE + length
+            if self._end - self._start < total:
+                self._need = total
+                return
+            body = self._start + HEADER_SIZE
+            self._start += total
+            yield frame_type, view[body:body + length]
+        self._need = HEADER_SIZE
+
+
+class FrameReader:
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.sock = sock
+        self.decoder = FrameDecoder(buffer_size)
+
+    def __iter__(self):
+        decoder = self.decoder
+        recv_into = self.sock.recv_into
+        while True:
+            nbytes = recv_into(decoder.get_buffer())
+            if not nbytes:
+                if decoder.pending:
+                    raise ProtocolError("Connection closed mid-frame")
+                return
+            decoder.buffer_updated(nbytes)
+            yield from decoder.frames()
+
+
+class FrameWriter:
+    """Writes frames to a blocking socket from one thread, in vectored batches.
+
+    send() is safe from any thread. It queues the header and payload
+    without joining them. The writer thread sends whatever is pending with
+    a single sendmsg() (scatter-gather), so a burst of frames costs one
+    syscall instead of two per frame. As with Nagle's algorithm, a frame
+    goes out at once if the socket has been idle for `latency` seconds and
+    otherwise waits at most that long for company. The socket gets
+    TCP_NODELAY so the kernel adds no delay of its own.
+
+    Frames sent with bulk=True (attachment chunks, and whatever must
+    follow them) wait in a queue of their own: each write takes every
+    other pending frame first and then at most WRITE_BATCH_BYTES of bulk
+    ones, so a chat message waits for about one chunk, never an upload.
+    Only bulk senders block, while more than MAX_PENDING_BYTES of bulk
+    frames is queued, which paces file uploads.
+
+    A failed write is raised from the next send().
+    """
+
+    def __init__(self, sock, latency=DEFAULT_WRITE_LATENCY):
+        set_nodelay(sock)
+        self.sock = sock
+        self.latency = latency
+        self.cond = threading.Condition()
+        self.pending = []
+        self.bulk = deque()
+        self.pending_bytes = 0
+        self.bulk_bytes = 0
+        self.writing = False
+        self.closed = False
+        self.error = None
+        self.last_write = 0.0
+        self.counters = {"frames": 0, "syscalls": 0, "bytes": 0}
+        self.thread = threading.Thread(target=self._run, name="frame-writer", daemon=True)
+        self.thread.start()
+
+    def send(self, frame_type, payload, bulk=False):
+        with self.cond:
+            while bulk and self.bulk_bytes > MAX_PENDING_BYTES and not (self.closed or self.error):
+                self.cond.wait()
+            if self.error is not None:
+                raise self.error
+            if self.closed:
+                raise ConnectionError("Writer is closed")
+            header = HEADER.pack(frame_type, len(payload))
+            size = HEADER_SIZE + len(payload)
+            if bulk:
+                self.bulk.append((header, payload))
+                self.bulk_bytes += size
+            else:
+                self.pending += (header, payload)
+            self.pending_bytes += size
+            self.counters["frames"] += 1
+            # The writer only needs waking for its first frame or a full batch
+            if len(self.pending) + len(self.bulk) * 2 == 2 or self.pending_bytes >= WRITE_BATCH_BYTES:
+                self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        # Waits until everything queued so far has been written
+        with self.cond:
+            if not self.cond.wait_for(lambda: not (self.pending or self.bulk or self.writing) or self.error, timeout):
+                raise TimeoutError("Frames still pending")
+            if self.error is not None:
+                raise self.error
+
+    def close(self, timeout=1.0):
+        # Flushes what it can; closing the socket stays with the caller
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def stats(self):
+        stats = dict(self.counters)
+        syscalls = stats["syscalls"] or 1
+        stats["frames_per_syscall"] = stats["frames"] / syscalls
+        stats["bytes_per_syscall"] = stats["bytes"] / syscalls
+        return stats
+
+    def _run(self):
+        cond = self.cond
+        while True:
+            with cond:
+                while not (self.pending or self.bulk) and not self.closed:
+                    cond.wait()
+                if not (self.pending or self.bulk):
+                    return
+                deadline = self.last_write + self.latency
+                while (not self.closed and self.pending_bytes < WRITE_BATCH_BYTES
+                       and time.monotonic() < deadline):
+                    cond.wait(deadline - time.monotonic())
+                buffers, self.pending = self.pending, []
+                bulk_bytes = 0
+                while self.bulk and bulk_bytes < WRITE_BATCH_BYTES:
+                    header, payload = self.bulk.popleft()
+                    buffers += (header, payload)
+                    bulk_bytes += HEADER_SIZE + len(payload)
+                self.writing = True
+            try:
+                self._write(buffers)
+            except OSError as e:
+                with cond:
+                    self.error = e
+                    self.pending, self.bulk, self.writing = [], deque(), False
+                    self.pending_bytes = self.bulk_bytes = 0
+                    cond.notify_all()
+                return
+            with cond:
+                self.pending_bytes -= sum(map(len, buffers))
+                self.bulk_bytes -= bulk_bytes
+                self.writing = False
+                self.last_write = time.monotonic()
+                cond.notify_all()
+
+    def _write(self, buffers):
+        if not hasattr(self.sock, "sendmsg"):
+            # Windows: one joined write instead
+            data = b"".join(buffers)
+            self.sock.sendall(data)
+            self.counters["syscalls"] += 1
+            self.counters["bytes"] += len(data)
+            return
+        views = [memoryview(buffer).cast("B") for buffer in buffers]
+        first = 0
+        while first < len(views):
+            sent = self.sock.sendmsg(views[first:first + MAX_IOVECS])
+            self.counters["syscalls"] += 1
+            self.counters["bytes"] += sent
+            # Partial writes leave the rest of the batch for the next call
+            while first < len(views) and sent >= len(views[first]):
+                sent -= len(views[first])
+                first += 1
+            if sent:
+                views[first] = views[first][sent:]
@@ -0,0 +1,680 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+
+from attachments import AttachmentReceiver, OutgoingTransfer, CHUNK_HEADER, KIND_FILE
+from cluster import BusClient
+from compression import Compressor, dictionary_id, load_dictionary, negotiate_codec, MODE_OFF, MODE_SAFE
+from config import ChatConfig, SERVER_IP, PORT, ATTACHMENT_DIR, HISTORY_DIR, COMPRESSION_DICT
+from encryption import MessageCipher, SUITE_CBC_HMAC, SUPPORTED_SUITES, negotiate_suite
+from handshake import TicketCache, accept_hello, ROOM_KEY_SIZE, TICKET_CACHE_SIZE
+from hub import BroadcastHub, DEFAULT_QUEUE_SIZE, POLICY_DROP
+from logs import trace_packet
+from message_store import MessageStore
+from metrics import MetricsServer, Registry, REGISTRY, SIZE_BUCKETS
+from profiling import SamplingProfiler, DEFAULT_PROFILE_DIR
+from protocol import (FrameDecoder, ProtocolError, set_nodelay, encode_frame, encode_control, decode_control,
+                      control_int, MAX_FRAME_SIZE, MAX_HANDSHAKE_FRAME_SIZE, DEFAULT_WRITE_LATENCY,
+                      DEFAULT_HEARTBEAT, HEARTBEAT_MISSES, SEQ_HEADER, FRAME_TEXT, FRAME_IMAGE,
+                      FRAME_CONTROL, FRAME_CHUNK, FRAME_HISTORY, FRAME_NAMES, CONTROL_HELLO, CONTROL_HELLO_RETRY,
+                      CONTROL_ATTACH_START, CONTROL_ATTACH_RESUME, CONTROL_ATTACH_END, CONTROL_HISTORY,
+                      CONTROL_PING, CONTROL_PONG, CONTROL_ACK)
+from timer_wheel import TimerWheel
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+EVENT_CONNECTED = "connected"
+EVENT_DISCONNECTED = "disconnected"
+EVENT_MESSAGE = "message"
+EVENT_ATTACHMENT = "attachment"
+EVENT_PROGRESS = "progress"
+
+# How long a file stream waits for slow peers before pushing the next chunk
+STREAM_STALL_TIMEOUT = 5.0
+# Files streamed to clients that can still be resumed, the oldest forgotten first
+MAX_DOWNLOADS = 256
+
+# Messages replayed to a client when it connects, and the most per page
+DEFAULT_REPLAY = 50
+MAX_HISTORY_PAGE = 500
+# Most messages sent to a reconnecting client that missed more
+MAX_SYNC = 10 * MAX_HISTORY_PAGE
+
+# Idle connections are checked this often
+REAP_INTERVAL = 1.0
+
+# Each connection's receive buffer starts this small and grows for large
+# frames only while they arrive, so idle connections cost little memory
+RECEIVE_BUFFER_SIZE = 4 * 1024
+
+log = logging.getLogger(__name__)
+
+
+def history_page(messages, **fields):
+    # A history page's JSON as parts for Compressor.compress_parts, one per message
+    parts = [b'{"messages": [']
+    for i, message in enumerate(messages):
+        parts.append((b", " if i else b"") + json.dumps(message).encode())
+    parts.append(b"], " + json.dumps(fields).encode()[1:])
+    return parts
+
+
+def raise_fd_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class ServerMetrics:
+    """A ServerCore's counters, gauges and histograms, in a registry of its own.
+
+    Numbers the core or its hub already keep are read when scraped; the
+    rest are updated in place on the hot paths, through children looked
+    up once here.
+    """
+
+    def __init__(self, core):
+        hub = core.hub
+        self.registry = registry = Registry()
+
+        registry.gauge("chat_connections", "Open client connections", func=lambda: len(core.connections))
+        self.accepted = registry.counter("chat_connections_accepted_total", "Client connections accepted").labels()
+        registry.counter("chat_connections_reaped_total", "Connections dropped for being silent too long",
+                         func=lambda: core.reaped)
+        registry.counter("chat_slow_disconnects_total", "Connections dropped for not reading their queue",
+                         func=lambda: hub.counters["slow_disconnects"])
+        self.protocol_errors = registry.counter(
+            "chat_protocol_errors_total", "Connections dropped for malformed or undecryptable frames").labels()
+        registry.gauge("chat_session_tickets", "Session tickets held for resumption", func=lambda: len(core.tickets))
+
+        frames = registry.counter("chat_frames_received_total", "Frames received, by type", ("type",))
+        self.frames_received = {frame_type: frames.labels(name) for frame_type, name in FRAME_NAMES.items()}
+        self.bytes_received = registry.counter("chat_bytes_received_total", "Bytes read from clients").labels()
+        self.messages = registry.counter("chat_messages_total", "Chat messages received from clients").labels()
+        self.attachments = registry.counter("chat_attachments_total", "Attachments received from clients, by kind",
+                                            ("kind",))
+        self.history_requests = registry.counter("chat_history_requests_total", "Pages of history asked for").labels()
+
+        registry.counter("chat_broadcasts_total", "Frames fanned out to connections",
+                         func=lambda: hub.counters["broadcasts"])
+        registry.counter("chat_frames_sent_total", "Frames written to clients", func=lambda: hub.counters["sent"])
+        registry.counter("chat_bytes_sent_total", "Bytes written to clients",
+                         func=lambda: hub.counters["bytes_written"])
+        registry.counter("chat_writes_total", "Socket writes, each of one or more frames",
+                         func=lambda: hub.counters["writes"])
+        registry.counter("chat_frames_dropped_total", "Frames dropped from full queues",
+                         func=lambda: hub.counters["dropped"])
+        registry.counter("chat_frames_coalesced_total", "Queued frames merged into one",
+                         func=lambda: hub.counters["coalesced"])
+        registry.gauge("chat_queued_frames", "Frames waiting in outbound queues",
+                       func=lambda: sum(hub.queue_depths().values()))
+        registry.gauge("chat_max_queue_depth", "Frames waiting in the fullest outbound queue",
+                       func=lambda: max(hub.queue_depths().values(), default=0))
+
+        self.receive_seconds = registry.histogram(
+            "chat_receive_seconds", "Time to parse and handle the frames of one read").labels()
+        self.decrypt_seconds = registry.histogram("chat_decrypt_seconds", "Time to decrypt a chat message").labels()
+        self.encrypt_seconds = registry.histogram(
+            "chat_encrypt_seconds", "Time to encrypt one variant of an outgoing frame").labels()
+        self.text_seconds = registry.histogram(
+            "chat_relay_seconds", "Time to handle a chat message, fan-out included").labels()
+        self.broadcast_seconds = registry.histogram(
+            "chat_broadcast_seconds", "Time to queue a frame for every recipient").labels()
+        self.broadcast_recipients = registry.histogram(
+            "chat_broadcast_recipients", "Queues a broadcast frame went to", buckets=SIZE_BUCKETS).labels()
+
+
+class Connection(asyncio.BufferedProtocol):
+    def __init__(self, core):
+        self.core = core
+        # Raised to MAX_FRAME_SIZE once the handshake completes
+        self.decoder = FrameDecoder(RECEIVE_BUFFER_SIZE, max_frame_size=MAX_HANDSHAKE_FRAME_SIZE)
+        self.transport = None
+        self.addr = None
+        # Until the handshake completes the peer is treated as a legacy
+        # client using cbc-hmac under the static shared key
+        self.suite = SUITE_CBC_HMAC
+        self.cipher = core.legacy_cipher
+        # Set by the handshake: session keys, room-key broadcasts, seq headers and history
+        self.established = False
+        # Negotiated in the handshake; applies to text and history plaintexts
+        self.compressor = None
+        # Waiting for a replay or sync read off the loop thread; it includes
+        # any message delivered meanwhile, so live ones are held back
+        self.replaying = False
+        # Dropped after this long without a frame (None: never); see ServerCore.reap
+        self.timeout = None
+        self.last_seen = 0.0
+        self.attachments = AttachmentReceiver(core.spool_dir)
+        # Ids of the files being streamed to it; see ServerCore.resume_download
+        self.downloads = set()
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        self.last_seen = self.core.loop.time()
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            # asyncio sets it too; the hub's write batching relies on it
+            set_nodelay(sock)
+        self.core._add_connection(self)
+
+    @property
+    def name(self):
+        if isinstance(self.addr, tuple):
+            return f"Client {self.addr[0]}:{self.addr[1]}"
+        return "Client"
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def drain(self):
+        await self.can_write.wait()
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        start = time.perf_counter()
+        metrics = self.core.metrics
+        metrics.bytes_received.inc(nbytes)
+        self.last_seen = self.core.loop.time()
+        self.decoder.buffer_updated(nbytes)
+        try:
+            for frame_type, payload in self.decoder.frames():
+                metrics.frames_received[frame_type].inc()
+                self.core.handle_frame(self, frame_type, payload)
+        except (ProtocolError, ValueError) as e:
+            metrics.protocol_errors.inc()
+            log.warning("Dropping %s: %s", self.addr, e)
+            self.transport.abort()
+        metrics.receive_seconds.observe(time.perf_counter() - start)
+
+    def connection_lost(self, exc):
+        self.can_write.set()
+        self.attachments.close()
+        self.core._remove_connection(self)
+
+    def close(self):
+        self.transport.close()
+
+
+class ServerCore:
+    """Headless chat server: accepts connections, decrypts and relays frames.
+
+    Everything runs on one asyncio loop. UIs observe the server through
+    subscribe(); callbacks run on the loop thread as callback(event, conn, data).
+
+    Chat messages are numbered and, given a history_dir, appended to a
+    MessageStore; clients get the last `replay` of them when they connect
+    and can page further back with history requests.
+
+    Clients that offer a codec get text and history compressed before
+    encryption; compression is "safe" by default (see Compressor), "on"
+    for trusted content, or "off".
+
+    As one of several workers (see cluster.py) it shares the port through
+    reuse_port and hands chat messages to the MessageBus at bus_path,
+    which numbers and stores them and delivers them back to every worker.
+
+    Clients that ask for heartbeats are told to ping every `heartbeat`
+    seconds and dropped after HEARTBEAT_MISSES silent intervals; other
+    connections are dropped after idle_timeout, if one is set.
+
+    Given a metrics_address ("host:port", ":port" or a Unix socket path)
+    it serves Prometheus metrics there (see ServerMetrics), and a stack
+    profile at /profile; SIGUSR1 writes a profile to profile_dir.
+    """
+
+    def __init__(self, host=SERVER_IP, port=PORT, key=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, slow_policy=POLICY_DROP, spool_dir=ATTACHMENT_DIR,
+                 history_dir=HISTORY_DIR, replay=DEFAULT_REPLAY, ticket_cache_size=TICKET_CACHE_SIZE,
+                 compression=MODE_SAFE, compression_dict=COMPRESSION_DICT, write_latency=DEFAULT_WRITE_LATENCY,
+                 reuse_port=False, bus_path=None, worker=0, heartbeat=DEFAULT_HEARTBEAT, idle_timeout=None,
+                 metrics_address=None, profile_dir=DEFAULT_PROFILE_DIR):
+        self.host = host
+        self.port = port
+        self.spool_dir = spool_dir
+        # The static key authenticates handshakes; traffic uses per-session
+        # keys, and broadcasts a room key that lives only as long as the process
+        if key is None:
+            key = ChatConfig.from_env().key
+        self.psk = key
+        self.legacy_cipher = MessageCipher(key)
+        self.room_key = os.urandom(ROOM_KEY_SIZE)
+        self.room_ciphers = {suite: MessageCipher(self.room_key, suite) for suite in SUPPORTED_SUITES}
+        self.tickets = TicketCache(ticket_cache_size)
+        self.store = MessageStore(history_dir, key) if history_dir else None
+        self.last_seq = 0
+        self.replay = replay
+        self.compression = compression
+        self.dictionary = load_dictionary(compression_dict) if compression != MODE_OFF else None
+        # One per codec and dictionary, shared by the connections using it
+        self.compressors = {}
+        self.connections = set()
+        # Transfer id -> (path, kind, name) of files streamed from disk, for resumes
+        self.downloads = OrderedDict()
+        self.hub = BroadcastHub(queue_size, slow_policy, write_latency=write_latency)
+        self.subscribers = []
+        self.reuse_port = reuse_port
+        self.bus = BusClient(self, bus_path, worker) if bus_path else None
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        # Connections with a timeout, checked by reap()
+        self.wheel = TimerWheel(REAP_INTERVAL)
+        self.reaped = 0
+        self.metrics = ServerMetrics(self)
+        self.metrics_address = metrics_address
+        self.metrics_server = None
+        self.profiler = SamplingProfiler(directory=profile_dir)
+        self.loop = None
+        self.server = None
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def publish(self, event, conn=None, data=None):
+        for callback in self.subscribers:
+            try:
+                callback(event, conn, data)
+            except Exception:
+                log.exception("Subscriber error on %s", event)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.bus is not None:
+            await self.bus.connect()
+        self.server = await self.loop.create_server(
+            lambda: Connection(self), self.host, self.port, backlog=4096, reuse_port=self.reuse_port or None)
+        self.loop.create_task(self.reap())
+        if self.metrics_address:
+            self.metrics_server = MetricsServer(self.metrics_address, (self.metrics.registry, REGISTRY), self.profiler)
+            await self.metrics_server.start()
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            self.loop.add_signal_handler(signal.SIGUSR1, self.profiler.trigger)
+        log.info("Server started on %s:%s", self.host, self.port)
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+            if self.bus is not None:
+                self.bus.close()
+            if self.store is not None:
+                self.store.close()
+
+    def run(self):
+        raise_fd_limit()
+        try:
+            asyncio.run(self.serve_forever())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+
+    def run_in_thread(self):
+        ready = threading.Event()
+
+        def target():
+            async def main():
+                await self.start()
+                ready.set()
+                await self.serve_forever()
+            try:
+                asyncio.run(main())
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                log.exception("Server stopped")
+            finally:
+                ready.set()
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        ready.wait()
+        return thread
+
+    def _add_connection(self, conn):
+        self.metrics.accepted.inc()
+        self.connections.add(conn)
+        self.hub.add(conn)
+        if self.idle_timeout:
+            self.watch(conn, self.idle_timeout)
+        log.info("Connected to %s", conn.addr, extra={"connections": len(self.connections)})
+        self.publish(EVENT_CONNECTED, conn)
+
+    def _remove_connection(self, conn):
+        self.connections.discard(conn)
+        self.hub.remove(conn)
+        log.info("Disconnected from %s", conn.addr, extra={"connections": len(self.connections)})
+        self.publish(EVENT_DISCONNECTED, conn)
+
+    def watch(self, conn, timeout):
+        # From now on conn is dropped after `timeout` seconds without a frame
+        if conn.timeout is None:
+            self.wheel.add(conn, conn.last_seen + timeout)
+        conn.timeout = timeout
+
+    async def reap(self):
+        # One timer for every connection: a tick of the wheel, and only the
+        # connections whose (possibly outdated) deadline came up are looked at
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            now = self.loop.time()
+            for conn in self.wheel.advance(now):
+                if conn not in self.connections:
+                    continue
+                deadline = conn.last_seen + conn.timeout
+                if deadline > now:
+                    self.wheel.add(conn, deadline)
+                    continue
+                self.reaped += 1
+                log.info("Dropping %s: nothing received for %.0fs", conn.addr, now - conn.last_seen)
+                conn.transport.abort()
+
+    def handle_frame(self, conn, frame_type, payload):
+        if frame_type == FRAME_TEXT:
+            metrics = self.metrics
+            metrics.messages.inc()
+            start = time.perf_counter()
+            data = conn.cipher.decrypt(payload)
+            metrics.decrypt_seconds.observe(time.perf_counter() - start)
+            if conn.compressor is not None:
+                data = conn.compressor.decompress(data)
+            msg = data.decode()
+            self.publish(EVENT_MESSAGE, conn, msg)
+            seq = self.send_message(conn.name, data, exclude=conn)
+            elapsed = time.perf_counter() - start
+            metrics.text_seconds.observe(elapsed)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Relayed message", extra={"seq": seq, "bytes": len(payload), "suite": conn.suite,
+                                                    "us": round(elapsed * 1e6)})
+            trace_packet(log, "Received packet", payload, seq=seq)
+        elif frame_type == FRAME_IMAGE:
+            # Old clients' images are neither encrypted nor authenticated, so
+            # anyone could inject one; images travel as attachments instead
+            log.warning("Ignoring an unencrypted image frame from %s", conn.addr)
+        elif frame_type == FRAME_CHUNK:
+            conn.attachments.chunk(conn.cipher, payload)
+        elif frame_type == FRAME_CONTROL:
+            self.handle_control(conn, decode_control(payload))
+
+    def handle_control(self, conn, msg):
+        if msg["type"] == CONTROL_HELLO:
+            suite = negotiate_suite(msg.get("suites", ()))
+            compressor, options = self.negotiate_compression(msg)
+            if msg.get("heartbeat") and self.heartbeat:
+                options["heartbeat"] = self.heartbeat
+            # What its messages are recorded as, so it can tell them apart in history
+            options["name"] = conn.name
+            welcome, cipher = accept_hello(self.psk, msg, suite, self.tickets, self.room_key, **options)
+            if welcome is None:
+                # Unknown or expired ticket: the client starts over with a key exchange
+                self.send_control(conn, encode_control(CONTROL_HELLO_RETRY))
+                return
+            conn.suite, conn.cipher, conn.established = suite, cipher, True
+            conn.decoder.max_frame_size = MAX_FRAME_SIZE
+            conn.compressor = compressor
+            if "heartbeat" in options:
+                self.watch(conn, self.heartbeat * HEARTBEAT_MISSES)
+            self.send_control(conn, welcome)
+            if msg.get("since") is not None:
+                # A reconnect: everything it missed instead of the latest page
+                self.loop.create_task(self.sync_history(conn, control_int(msg, "since")))
+            elif self.bus is not None and self.replay:
+                conn.replaying = True
+                self.loop.create_task(self.fetch_history(conn, None, self.replay))
+            elif self.store is not None and self.replay:
+                self.send_history(conn, self.store.latest(self.replay), self.store.next_seq)
+        elif msg["type"] == CONTROL_PING:
+            self.send_control(conn, encode_control(CONTROL_PONG))
+        elif msg["type"] == CONTROL_HISTORY:
+            self.metrics.history_requests.inc()
+            limit = min(max(1, control_int(msg, "limit", DEFAULT_REPLAY)), MAX_HISTORY_PAGE)
+            self.loop.create_task(self.fetch_history(conn, control_int(msg, "before"), limit))
+        elif msg["type"] == CONTROL_ATTACH_RESUME:
+            self.resume_download(conn, msg)
+        elif msg["type"] == CONTROL_ATTACH_START:
+            transfer = conn.attachments.start(msg)
+            self.send_control(conn, transfer.resume_message())
+        elif msg["type"] == CONTROL_ATTACH_END:
+            transfer = conn.attachments.finish(msg)
+            if not transfer.complete:
+                raise ProtocolError(f"Attachment {transfer.name} is incomplete")
+            self.metrics.attachments.labels(transfer.kind).inc()
+            self.publish(EVENT_ATTACHMENT, conn, transfer)
+            self.loop.create_task(self.stream_file(
+                OutgoingTransfer(transfer.path, transfer.kind, transfer.name), exclude=conn))
+            if self.bus is not None:
+                self.bus.share_attachment(os.path.abspath(transfer.path), transfer.kind, transfer.name)
+
+    def negotiate_compression(self, msg):
+        # The client's offer -> (compressor, welcome fields); none for old clients
+        codec = negotiate_codec(msg.get("compress", ())) if self.compression != MODE_OFF else None
+        if codec is None:
+            return None, {}
+        dictionary = self.dictionary
+        if dictionary is not None and msg.get("dict") != dictionary_id(dictionary):
+            dictionary = None
+        compressor = self.compressors.get((codec, dictionary))
+        if compressor is None:
+            compressor = self.compressors[codec, dictionary] = Compressor(
+                codec, dictionary, safe=self.compression == MODE_SAFE)
+        return compressor, {"compress": codec, "dict": dictionary is not None, "safe": compressor.safe}
+
+    def send_control(self, conn, payload):
+        self.hub.send(conn, encode_frame(FRAME_CONTROL, payload))
+
+    def send_message(self, sender, data, exclude=None):
+        # Numbers, stores and broadcasts a chat message, returning its seq;
+        # with workers the bus does that and the seq is not known yet
+        if self.bus is not None:
+            self.bus.publish(sender, data, exclude)
+            return None
+        seq = self.record_message(sender, data.decode())
+        self.deliver(seq, sender, data, exclude)
+        return seq
+
+    def deliver(self, seq, sender, data, exclude=None):
+        # Established peers get the sender too, as a record like those in history pages.
+        # The sender (excluded) gets just the seq, unless a replay or sync it
+        # is waiting for includes the message anyway.
+        record = json.dumps({"from": sender, "text": data.decode()}).encode()
+        self.broadcast_data(data, exclude=exclude, seq=seq, compress=True, record=record)
+        if exclude is not None and exclude.established and not exclude.replaying:
+            self.send_control(exclude, encode_control(CONTROL_ACK, seq=seq))
+
+    def relay_attachment(self, path, kind, name):
+        # Another worker's upload, streamed from the shared spool directory
+        self.loop.create_task(self.stream_file(OutgoingTransfer(path, kind, name)))
+
+    def record_message(self, sender, msg):
+        # Returns the message's seq, persisting it when there is a store
+        if self.store is None:
+            self.last_seq += 1
+            return self.last_seq
+        return self.store.append(json.dumps({"from": sender, "text": msg}).encode())
+
+    def send_history(self, conn, records, before, older=False):
+        # records are the messages just before seq `before`, oldest first
+        messages = [dict(json.loads(payload), seq=seq, time=timestamp) for seq, timestamp, payload in records]
+        first = records[0][0] if records else before
+        parts = history_page(messages, before=before, older=older, more=first > 1)
+        if conn.compressor is not None:
+            body = conn.compressor.compress_parts(parts)
+        else:
+            body = b"".join(parts)
+        self.hub.send(conn, encode_frame(FRAME_HISTORY, conn.cipher.encrypt(body)))
+
+    async def fetch_history(self, conn, before, limit):
+        # Older pages come off disk, so they are read on a worker thread.
+        # With workers the bus has the store; before=None is the replay.
+        records = []
+        if self.bus is not None:
+            records, next_seq = await self.bus.history(before, limit)
+            if before is None:
+                conn.replaying = False
+                self.send_history(conn, records, next_seq)
+                return
+        elif self.store is not None:
+            records = await self.loop.run_in_executor(None, self.store.before, before, limit)
+        self.send_history(conn, records, before, older=True)
+
+    async def sync_history(self, conn, since):
+        # Every message after seq `since`, up to MAX_SYNC of the latest,
+        # in pages; live messages wait until it has been read
+        conn.replaying = True
+        try:
+            if self.bus is not None:
+                records, next_seq = await self.bus.history(None, MAX_SYNC, after=since)
+            elif self.store is not None:
+                next_seq = self.store.next_seq
+                records = await self.loop.run_in_executor(
+                    None, self.store.read_range, max(since + 1, next_seq - MAX_SYNC), next_seq)
+                # Whatever arrived meanwhile, which is usually still in the store's tail
+                records += self.store.read_range(next_seq, self.store.next_seq)
+            else:
+                records = []
+        finally:
+            conn.replaying = False
+        for start in range(0, len(records), MAX_HISTORY_PAGE):
+            page = records[start:start + MAX_HISTORY_PAGE]
+            self.send_history(conn, page, page[-1][0] + 1)
+
+    def relay(self, frame, exclude=None, recipients=None):
+        start = time.perf_counter()
+        enqueued = self.hub.broadcast(frame, exclude=exclude, recipients=recipients)
+        self.metrics.broadcast_seconds.observe(time.perf_counter() - start)
+        self.metrics.broadcast_recipients.observe(enqueued)
+        return enqueued
+
+    def broadcast_data(self, data, exclude=None, recipients=None, frame_type=FRAME_TEXT, header=b"",
+                       seq=None, compress=False, record=None):
+        # Encrypted once per cipher suite in use under the room key (or the
+        # static key for legacy peers), not once per recipient. A header is
+        # sent in the clear ahead of the packet and authenticated; a seq goes
+        # only to established peers, and so does record in place of data if
+        # given. With compress, data is compressed once per negotiated
+        # compressor first.
+        frames = {}
+        plaintexts = {}
+        encrypt_seconds = self.metrics.encrypt_seconds
+
+        def frame_for(conn):
+            if seq is not None and conn.replaying:
+                return None
+            compressor = conn.compressor if compress else None
+            variant = (conn.suite, conn.established, compressor)
+            frame = frames.get(variant)
+            if frame is None:
+                source = record if record is not None and conn.established else data
+                plaintext = plaintexts.get((source is data, compressor))
+                if plaintext is None:
+                    plaintext = source if compressor is None else compressor.compress(source)
+                    plaintexts[source is data, compressor] = plaintext
+                if conn.established:
+                    cipher = self.room_ciphers[conn.suite]
+                    prefix = header if seq is None else header + SEQ_HEADER.pack(seq)
+                else:
+                    cipher, prefix = self.legacy_cipher, header
+                start = time.perf_counter()
+                packet = cipher.encrypt(plaintext, aad=prefix)
+                encrypt_seconds.observe(time.perf_counter() - start)
+                frame = frames[variant] = encode_frame(frame_type, prefix + packet)
+            return frame
+
+        self.relay(frame_for, exclude=exclude, recipients=recipients)
+
+    def broadcast_text(self, msg):
+        self.send_message("Server", msg.encode())
+
+    async def stream_file(self, transfer, exclude=None, recipients=None):
+        # Only peers connected when the transfer starts receive it
+        if recipients is None:
+            recipients = [conn for conn in self.connections if conn is not exclude]
+        if transfer.path is not None and not transfer.cleanup:
+            self.downloads[transfer.id] = (transfer.path, transfer.kind, transfer.name)
+            self.downloads.move_to_end(transfer.id)
+            while len(self.downloads) > MAX_DOWNLOADS:
+                self.downloads.popitem(last=False)
+        for conn in recipients:
+            conn.downloads.add(transfer.id)
+        try:
+            self.relay(encode_frame(FRAME_CONTROL, transfer.start_message()), recipients=recipients)
+            for index, data in transfer.iter_chunks():
+                self.broadcast_data(data, recipients=recipients, frame_type=FRAME_CHUNK,
+                                    header=CHUNK_HEADER.pack(transfer.id, index))
+                self.publish(EVENT_PROGRESS, None, transfer)
+                await self.hub.wait_for_space(recipients, STREAM_STALL_TIMEOUT)
+            self.relay(encode_frame(FRAME_CONTROL, transfer.end_message()), recipients=recipients)
+        except Exception as e:
+            log.warning("Failed to send %s: %s", transfer.name, e)
+        finally:
+            for conn in recipients:
+                conn.downloads.discard(transfer.id)
+            transfer.done()
+
+    def resume_download(self, conn, msg):
+        # A client that missed chunks of a file (dropped while it was slow,
+        # or cut off by a reconnect) asks for the rest from its first missing
+        # chunk; ignored while a stream of it is still on its way there
+        index = control_int(msg, "index")
+        try:
+            transfer_id = bytes.fromhex(msg["id"])
+        except (KeyError, TypeError, ValueError):
+            raise ProtocolError("Invalid id in attach_resume control frame")
+        if transfer_id in conn.downloads:
+            return
+        download = self.downloads.get(transfer_id)
+        if download is None:
+            log.info("Cannot resume unknown download %s for %s", transfer_id.hex(), conn.addr)
+            return
+        try:
+            transfer = OutgoingTransfer(*download, transfer_id=transfer_id)
+        except OSError as e:
+            log.warning("Cannot resume %s for %s: %s", download[2], conn.addr, e)
+            return
+        transfer.resume_from(index)
+        self.loop.create_task(self.stream_file(transfer, recipients=[conn]))
+
+    def send_file(self, path, kind=KIND_FILE, name=None, cleanup=False, data=None):
+        # Safe to call from any thread; with `data`, path is None and name is required
+        transfer = OutgoingTransfer(path, kind, name, cleanup=cleanup, data=data)
+        self.call_threadsafe(lambda: self.loop.create_task(self.stream_file(transfer)))
+        return transfer
+
+    def call_threadsafe(self, func, *args):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def stop(self):
+        def close():
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+            if self.bus is not None:
+                self.bus.close()
+            for conn in list(self.connections):
+                conn.close()
+            if self.server is not None:
+                self.server.close()
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+        self.call_threadsafe(close)
@@ -0,0 +1,182 @@
+import logging
+import os
+import tkinter as tk
+from tkinter import messagebox, filedialog
+
+from attachments import KIND_IMAGE, KIND_FILE
+from chat_view import UIDispatcher, ChatView
+from server_core import EVENT_DISCONNECTED, EVENT_MESSAGE, EVENT_ATTACHMENT, EVENT_PROGRESS
+from transcode import Transcoder
+
+log = logging.getLogger("server")
+
+
+class ChatServer:
+    def __init__(self, root, core):
+        self.root = root
+        self.root.title("Server - Secure Chat")
+        self.root.geometry("600x700")
+        self.core = core
+        self.transcoder = Transcoder()
+        self.running = True
+        self.dark_mode = True
+        self.emoji_list = ["😊", "😂", "❤️", "👍", "😍", "😎", "🙏", "🎉", "🔥", "💯"]
+
+        self.create_widgets()
+        self.bind_keys()
+        self.toggle_theme()
+
+        # Network threads never touch Tk directly; they go through the dispatcher
+        self.ui = UIDispatcher(self.root)
+        self.chat = ChatView(self.ui, self.chat_window)
+        self.ui.start()
+
+        self.core.subscribe(self.on_server_event)
+        self.server_thread = self.core.run_in_thread()
+
+    def create_widgets(self):
+        # Chat window
+        self.chat_window = tk.Text(self.root, height=25, width=70, wrap=tk.WORD, bd=0, padx=10, pady=10)
+        self.chat_window.pack(pady=30)  # Adjusted padding
+        self.chat_window.config(state=tk.DISABLED)
+
+        # Emoji frame
+        emoji_frame = tk.Frame(self.root)
+        emoji_frame.pack(pady=10)
+
+        for i, emoji_char in enumerate(self.emoji_list):
+            btn = tk.Button(emoji_frame, text=emoji_char, font=("Arial", 14),
+                            command=lambda e=emoji_char: self.insert_emoji(e))
+            btn.grid(row=0, column=i, padx=5)
+
+        # Entry box
+        self.entry = tk.Entry(self.root, width=50)
+        self.entry.pack(pady=10)
+
+        # Button frame
+        button_frame = tk.Frame(self.root)
+        button_frame.pack()
+
+        self.send_button = tk.Button(button_frame, text="Send", command=self.send_msg)
+        self.send_button.grid(row=0, column=0, padx=5)
+
+        self.image_button = tk.Button(button_frame, text="Send Image", command=self.send_image)
+        self.image_button.grid(row=0, column=1, padx=5)
+
+        # Images go as a preview; this adds the full-resolution version after it
+        self.full_size = tk.BooleanVar(value=False)
+        self.full_size_check = tk.Checkbutton(button_frame, text="Full size", variable=self.full_size)
+        self.full_size_check.grid(row=1, column=1, padx=5)
+
+        self.file_button = tk.Button(button_frame, text="Send File", command=self.send_file)
+        self.file_button.grid(row=0, column=2, padx=5)
+
+        self.theme_button = tk.Button(button_frame, text="Toggle Theme", command=self.toggle_theme)
+        self.theme_button.grid(row=0, column=3, padx=5)
+
+        self.exit_button = tk.Button(button_frame, text="Exit", command=self.close_chat)
+        self.exit_button.grid(row=0, column=4, padx=5)
+
+        # Transfer progress
+        self.status_label = tk.Label(self.root, text="")
+        self.status_label.pack(pady=5)
+
+    def bind_keys(self):
+        self.root.bind('<Return>', lambda event: self.send_msg())
+
+    def insert_emoji(self, emoji_char):
+        self.entry.insert(tk.END, emoji_char)
+
+    def toggle_theme(self):
+        bg = "#2E2E2E" if self.dark_mode else "#FFFFFF"
+        fg = "#FFFFFF" if self.dark_mode else "#000000"
+        entry_bg = "#3C3F41" if self.dark_mode else "#FFFFFF"
+        self.root.config(bg=bg)
+        self.chat_window.config(bg=bg, fg=fg)
+        self.entry.config(bg=entry_bg, fg=fg)
+        self.dark_mode = not self.dark_mode
+
+    def on_server_event(self, event, conn, data):
+        # Called on the server loop thread
+        if event == EVENT_MESSAGE:
+            self.display_message("Client", data, bubble_color="green", align="left")
+        elif event == EVENT_ATTACHMENT:
+            self.display_attachment("Client", data, align="left")
+        elif event == EVENT_PROGRESS:
+            self.show_progress("Sending", data)
+        elif event == EVENT_DISCONNECTED and self.running:
+            # Clients reconnect on their own; the server keeps running
+            self.display_message("System", f"{conn.name} disconnected.", "red", align="center")
+
+    def show_progress(self, action, transfer):
+        if transfer.progress >= 1.0:
+            self.set_status("")
+        else:
+            self.set_status(f"{action} {transfer.name}: {transfer.progress:.0%}")
+
+    def set_status(self, text):
+        self.ui.post(self.status_label.config, {"text": text})
+
+    def display_attachment(self, sender, transfer, align="left"):
+        if transfer.kind == KIND_IMAGE:
+            self.display_image(sender, transfer.path, align=align)
+        else:
+            self.display_message(sender, f"📎 {transfer.name} (saved to {transfer.path})",
+                                 bubble_color="green" if align == "left" else "blue", align=align)
+
+    def display_message(self, sender, msg, bubble_color="blue", align="right"):
+        # Safe from any thread; drawn on the next UI tick
+        self.chat.add_message(sender, msg, bubble_color, align)
+
+    def display_image(self, sender, source, align="right"):
+        self.chat.add_image(sender, source, align)
+
+    def send_msg(self):
+        msg = self.entry.get().strip()
+        if msg:
+            log.debug("Sending message", extra={"chars": len(msg)})
+            self.core.call_threadsafe(self.core.broadcast_text, msg)
+            self.display_message("Server", msg, bubble_color="blue", align="right")
+            self.entry.delete(0, tk.END)
+            
+    def send_image(self):
+        file_path = filedialog.askopenfilename(filetypes=[("Image Files", "*.jpg *.jpeg *.png *.webp")])
+        if file_path:
+            # Resized and re-encoded in a worker process; the window stays responsive meanwhile
+            self.set_status(f"Preparing {os.path.basename(file_path)}...")
+            self.transcoder.submit(file_path, full=self.full_size.get()).add_done_callback(self.send_transcoded)
+
+    def send_transcoded(self, future):
+        # On the process pool's result thread
+        if not self.running:
+            return
+        self.set_status("")
+        try:
+            image = future.result()
+        except Exception as e:
+            self.ui.post(messagebox.showerror, "Error", f"Failed to send image: {e}")
+            return
+        # Streamed in this order, so receivers have the preview before the full version
+        self.core.send_file(None, KIND_IMAGE, image.preview_name, data=image.preview)
+        if image.full is not None:
+            self.core.send_file(None, KIND_FILE, image.full_name, data=image.full)
+        self.display_image("Server", image.preview, align="right")
+
+    def send_file(self):
+        file_path = filedialog.askopenfilename()
+        if file_path:
+            try:
+                transfer = self.core.send_file(file_path, KIND_FILE)
+                self.display_message("Server", f"📎 {transfer.name}", bubble_color="blue", align="right")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to send file: {str(e)}")
+
+    def close_chat(self):
+        if not self.running:
+            return
+        self.running = False
+        self.ui.stop()
+        self.chat.close()
+        self.transcoder.shutdown()
+        self.core.stop()
+        self.root.quit()
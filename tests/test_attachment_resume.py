@@ -0,0 +1,67 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from attachments import CHUNK_HEADER, CHUNK_SIZE
+from headless_client import connect
+from protocol import CONTROL_ATTACH_END
+from server_core import ServerCore
+
+KEY = os.urandom(32)
+CHUNKS = 4
+
+
+class AttachmentResumeTest(unittest.IsolatedAsyncioTestCase):
+    """A download that lost a chunk on the way is finished by asking the server for the rest."""
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.core = ServerCore("127.0.0.1", 0, key=KEY, history_dir=None,
+                               spool_dir=os.path.join(self.directory, "server"))
+        await self.core.start()
+        self.port = self.core.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.core.server.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    async def test_missing_chunk_is_sent_again(self):
+        spool = os.path.join(self.directory, "client")
+        ended = []
+
+        def on_attachment(event, msg):
+            if event == CONTROL_ATTACH_END:
+                ended.append(msg["id"])
+
+        receiver = await connect("127.0.0.1", self.port, key=KEY, spool_dir=spool, on_attachment=on_attachment)
+        chunk = receiver.attachments.chunk
+        dropped = []
+
+        def drop_second_chunk(cipher, payload):
+            # As if the server's queue for this client had been full
+            if CHUNK_HEADER.unpack_from(payload)[1] == 1 and not dropped:
+                dropped.append(payload)
+                return None
+            return chunk(cipher, payload)
+
+        receiver.attachments.chunk = drop_second_chunk
+        sender = await connect("127.0.0.1", self.port, key=KEY)
+        data = os.urandom(CHUNKS * CHUNK_SIZE - 100)
+        try:
+            await sender.send_file(None, name="data.bin", data=data)
+            for _ in range(500):
+                if ended:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            sender.close()
+            receiver.close()
+        self.assertTrue(dropped)
+        with open(os.path.join(spool, f"{ended[-1]}-data.bin"), "rb") as f:
+            self.assertEqual(f.read(), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import json
+import unittest
+
+from compression import Compressor, FLAG_PARTS, FLAG_RAW
+from server_core import history_page
+
+
+def page(texts):
+    messages = [{"from": f"Client 127.0.0.1:{40000 + i}", "text": text, "seq": i + 1, "time": 1.7e9 + i}
+                for i, text in enumerate(texts)]
+    return history_page(messages, before=len(texts) + 1, older=False, more=False)
+
+
+class CompressPartsTest(unittest.TestCase):
+    def test_safe_history_page_is_compressed_per_message(self):
+        compressor = Compressor(safe=True)
+        texts = ["the build is green again " * 10, "can you take a look " * 10, "ok"]
+        parts = page(texts)
+        packed = compressor.compress_parts(parts)
+        self.assertEqual(packed[0], FLAG_PARTS)
+        self.assertLess(len(packed), len(b"".join(parts)))
+        self.assertEqual([m["text"] for m in json.loads(compressor.decompress(packed))["messages"]], texts)
+        # Another sender's text does not change how the first message compresses
+        other = compressor.compress_parts(page([texts[0], "the build is green again " * 10, "ok"]))
+        first = compressor.compress(parts[1])
+        self.assertIn(first, packed)
+        self.assertIn(first, other)
+
+    def test_incompressible_page_goes_out_raw(self):
+        compressor = Compressor(safe=True)
+        parts = page(["hi", "ok"])
+        self.assertEqual(compressor.compress_parts(parts), bytes((FLAG_RAW,)) + b"".join(parts))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from protocol import FrameDecoder, ProtocolError, HEADER, FRAME_TEXT, encode_frame
+
+
+def feed(decoder, data):
+    # -> the (frame_type, payload) pairs decoded from data, fed in one read
+    buf = decoder.get_buffer()
+    buf[:len(data)] = data
+    decoder.buffer_updated(len(data))
+    return [(frame_type, bytes(payload)) for frame_type, payload in decoder.frames()]
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_oversized_header_is_rejected_before_buffering(self):
+        decoder = FrameDecoder(4096, max_frame_size=16 * 1024)
+        with self.assertRaises(ProtocolError):
+            feed(decoder, HEADER.pack(FRAME_TEXT, 1 << 30))
+        self.assertEqual(len(decoder.get_buffer()), 4096 - HEADER.size)
+
+    def test_frames_up_to_the_limit_pass(self):
+        decoder = FrameDecoder(4096, max_frame_size=16 * 1024)
+        payload = b"x" * (16 * 1024)
+        frames = []
+        data = encode_frame(FRAME_TEXT, payload)
+        while data:
+            size = min(len(decoder.get_buffer()), len(data))
+            frames += feed(decoder, data[:size])
+            data = data[size:]
+        self.assertEqual(frames, [(FRAME_TEXT, payload)])
+
+    def test_buffer_shrinks_back_after_a_large_frame(self):
+        decoder = FrameDecoder(4096, max_frame_size=64 * 1024)
+        data = encode_frame(FRAME_TEXT, b"x" * (64 * 1024)) + encode_frame(FRAME_TEXT, b"small")
+        frames = []
+        while data:
+            size = min(len(decoder.get_buffer()), len(data))
+            frames += feed(decoder, data[:size])
+            data = data[size:]
+        self.assertEqual([len(payload) for _, payload in frames], [64 * 1024, 5])
+        self.assertEqual(len(decoder.get_buffer()), 4096)
+
+
+if __name__ == "__main__":
+    unittest.main()
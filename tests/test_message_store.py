@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from message_store import MessageStore
+
+KEY = os.urandom(32)
+
+
+class RecoveryTest(unittest.TestCase):
+    """Reopening a store finds its segments by name and ignores anything else in the directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        store = MessageStore(self.directory, KEY, segment_bytes=1024, fsync=False)
+        for i in range(100):
+            store.append(f"message {i}".encode())
+        store.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def reopen(self):
+        store = MessageStore(self.directory, KEY, segment_bytes=1024, fsync=False)
+        self.addCleanup(store.close)
+        return store
+
+    def test_stray_files_are_ignored(self):
+        with open(os.path.join(self.directory, "server.log"), "wb") as f:
+            f.write(b"not a segment\n")
+        store = self.reopen()
+        self.assertEqual(store.committed_seq, 100)
+        store.append(b"message 100")
+        store.sync()
+        self.assertEqual([payload for _, _, payload in store.latest(2)], [b"message 99", b"message 100"])
+        with open(os.path.join(self.directory, "server.log"), "rb") as f:
+            self.assertEqual(f.read(), b"not a segment\n")
+
+    def test_segment_out_of_sequence_is_ignored(self):
+        stray = os.path.join(self.directory, f"{10 ** 6:020d}.log")
+        with open(stray, "wb") as f:
+            f.write(b"\0" * 64)
+        store = self.reopen()
+        self.assertEqual(store.committed_seq, 100)
+        self.assertEqual(os.path.getsize(stray), 64)
+
+
+if __name__ == "__main__":
+    unittest.main()
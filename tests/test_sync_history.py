@@ -0,0 +1,120 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from headless_client import connect
+from message_store import TAIL_RECORDS
+from protocol import encode_control, CONTROL_HISTORY, FRAME_CONTROL
+from server_core import ServerCore
+
+KEY = os.urandom(32)
+MESSAGES = TAIL_RECORDS + 1500
+SINCE = 10
+
+
+class SyncHistoryTest(unittest.IsolatedAsyncioTestCase):
+    """A client reconnecting with since=<seq> gets every later message, with no gaps."""
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.core = ServerCore("127.0.0.1", 0, key=KEY, history_dir=self.directory, spool_dir=self.directory,
+                               replay=0)
+        await self.core.start()
+        self.port = self.core.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.core.server.close()
+        self.core.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    async def send_messages(self):
+        sender = await connect("127.0.0.1", self.port, key=KEY)
+        for i in range(MESSAGES):
+            sender.send_text(f"message {i}")
+            if i % 100 == 0:
+                await sender.drain()
+        while self.core.store.next_seq <= MESSAGES:
+            await asyncio.sleep(0.01)
+        sender.close()
+
+    async def sync(self):
+        # -> the seqs of every message in the history pages sent for since=SINCE
+        seqs = []
+        client = await connect("127.0.0.1", self.port, key=KEY, since=SINCE,
+                               on_history=lambda body: seqs.extend(m["seq"] for m in body["messages"]))
+        try:
+            for _ in range(500):
+                if seqs and seqs[-1] >= MESSAGES:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            client.close()
+        return seqs
+
+    async def test_backlog_from_disk(self):
+        await self.send_messages()
+        self.core.store.sync()
+        self.assertEqual(await self.sync(), list(range(SINCE + 1, MESSAGES + 1)))
+
+    async def test_backlog_not_yet_written(self):
+        # The writer is held up, so most of the backlog is neither on disk nor in the tail
+        store = self.core.store
+        release = threading.Event()
+        commit = store._commit
+        store._commit = lambda batch: (release.wait(10), commit(batch))
+        try:
+            await self.send_messages()
+            self.assertLess(store.committed_seq, MESSAGES - TAIL_RECORDS)
+            self.assertEqual(await self.sync(), list(range(SINCE + 1, MESSAGES + 1)))
+        finally:
+            release.set()
+
+    async def wait_for_seq(self, client, seq):
+        for _ in range(500):
+            if client.last_seq >= seq:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f"last_seq stuck at {client.last_seq}, expected {seq}")
+
+    async def test_sender_learns_the_seq_of_its_own_messages(self):
+        sender = await connect("127.0.0.1", self.port, key=KEY)
+        peer = await connect("127.0.0.1", self.port, key=KEY)
+        try:
+            for i in range(3):
+                sender.send_text(f"mine {i}")
+            await self.wait_for_seq(sender, 3)
+            peer.send_text("theirs")
+            await self.wait_for_seq(sender, 4)
+            sender.send_text("mine 3")
+            await self.wait_for_seq(sender, 5)
+        finally:
+            peer.close()
+            sender.close()
+        self.assertEqual(sender.last_seq, 5)
+
+        pages = []
+        client = await connect("127.0.0.1", self.port, key=KEY, since=0, on_history=pages.append)
+        await asyncio.sleep(0.2)
+        client.close()
+        self.assertEqual([m["seq"] for page in pages for m in page["messages"] if m["from"] == sender.name],
+                         [1, 2, 3, 5])
+
+        # Reconnecting from its last_seq, nothing of its own comes back
+        pages = []
+        client = await connect("127.0.0.1", self.port, key=KEY, since=sender.last_seq, on_history=pages.append)
+        await asyncio.sleep(0.2)
+        client.close()
+        self.assertEqual(pages, [])
+
+    async def test_malformed_history_request_drops_the_connection(self):
+        for fields in ({}, {"before": "10"}, {"before": 10, "limit": None}, {"before": -1}):
+            client = await connect("127.0.0.1", self.port, key=KEY)
+            client.send(FRAME_CONTROL, encode_control(CONTROL_HISTORY, **fields))
+            await asyncio.wait_for(client.closed, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
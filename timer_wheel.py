@@ -0,0 +1,38 @@
+import math
+
+
+class TimerWheel:
+    """Hashed timing wheel for many coarse deadlines, such as idle connections.
+
+    Items go into the slot of their deadline, rounded up to `resolution`
+    seconds, so adding one is O(1) and a tick only touches the items that
+    come due. Nothing is rescheduled when a deadline moves: advance()
+    returns items whose slot has come up, and callers check the item's
+    current deadline and add() it again if it is not due yet. That also
+    covers deadlines more than one turn of the wheel away.
+    """
+
+    def __init__(self, resolution=1.0, slots=64, now=0.0):
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        self.tick = int(now // resolution)
+
+    def __len__(self):
+        return sum(map(len, self.slots))
+
+    def add(self, item, deadline):
+        tick = max(math.ceil(deadline / self.resolution), self.tick + 1)
+        self.slots[tick % len(self.slots)].append(item)
+
+    def advance(self, now):
+        due = []
+        target = int(now // self.resolution)
+        # Far behind, one pass over every slot covers everything
+        ticks = min(target - self.tick, len(self.slots))
+        for tick in range(target - ticks + 1, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                due += slot
+                slot.clear()
+        self.tick = max(self.tick, target)
+        return due
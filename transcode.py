@@ -0,0 +1,106 @@
+import io
+import os
+import time
+from collections import namedtuple
+
+FORMAT_WEBP = "webp"
+FORMAT_JPEG = "jpeg"
+IMAGE_FORMATS = (FORMAT_WEBP, FORMAT_JPEG)
+EXTENSIONS = {FORMAT_WEBP: "webp", FORMAT_JPEG: "jpg"}
+
+# The preview is what receivers show inline; the full version is optional.
+# Progressive JPEG previews encode and decode about twice as fast as WebP;
+# full-size WebP is about a third of the bytes (see bench/bench_transcode.py).
+PREVIEW_FORMAT = FORMAT_JPEG
+PREVIEW_SIZE = (1024, 1024)
+PREVIEW_QUALITY = 75
+FULL_QUALITY = 85
+# libwebp's fastest method; the slower ones take 2-4x as long on photos for no smaller output
+WEBP_METHOD = 0
+TRANSCODE_WORKERS = 2
+
+# preview, full: encoded bytes (full is None unless asked for)
+# names: file names to send them under; timings in milliseconds
+TranscodedImage = namedtuple("TranscodedImage", "preview full preview_name full_name width height encode_ms")
+
+
+def best_format():
+    from PIL import features
+
+    return FORMAT_WEBP if features.check("webp") else FORMAT_JPEG
+
+
+def encode(img, image_format, quality):
+    # No exif, XMP or ICC profile is passed on, so none ends up in the output
+    out = io.BytesIO()
+    if image_format == FORMAT_WEBP:
+        img.save(out, format="WEBP", quality=quality, method=WEBP_METHOD)
+    else:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(out, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def transcode(source, full=False, preview_format=PREVIEW_FORMAT, full_format=None, preview_size=PREVIEW_SIZE,
+              preview_quality=PREVIEW_QUALITY, full_quality=FULL_QUALITY, name=None):
+    """Decode an image (a path or bytes) and re-encode it without metadata.
+
+    Returns a TranscodedImage with a preview no larger than preview_size
+    and, if `full`, the whole image in full_format (WebP if this PIL
+    supports it). Runs in a worker process, so everything it takes and
+    returns is picklable.
+    """
+    from PIL import Image, ImageOps
+
+    start = time.perf_counter()
+    full_format = full_format or best_format()
+    img = Image.open(source if isinstance(source, str) else io.BytesIO(source))
+    if not full:
+        # JPEGs decode straight at a fraction of their size when only the preview is needed
+        img.draft("RGB", preview_size)
+    # Orientation lives in the exif data being dropped, so it is applied to the pixels
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "RGBA", "L"):
+        img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+
+    preview = img.copy()
+    preview.thumbnail(preview_size)
+    preview_data = encode(preview, preview_format, preview_quality)
+    full_data = encode(img, full_format, full_quality) if full else None
+
+    stem = os.path.splitext(os.path.basename(name or (source if isinstance(source, str) else "image")))[0]
+    return TranscodedImage(preview_data, full_data, f"{stem}.{EXTENSIONS[preview_format]}",
+                           f"{stem}-full.{EXTENSIONS[full_format]}", img.width, img.height,
+                           (time.perf_counter() - start) * 1000)
+
+
+class Transcoder:
+    """Runs transcode() on a pool of worker processes, away from the UI thread.
+
+    Decoding and encoding a large photo takes long enough to freeze Tk and
+    holds the GIL while it runs, so it happens in another process. The
+    pool starts with the first image; submit() returns a
+    concurrent.futures.Future of a TranscodedImage.
+    """
+
+    def __init__(self, workers=TRANSCODE_WORKERS, **options):
+        self.workers = workers
+        self.options = options
+        self.executor = None
+
+    def submit(self, source, full=False, name=None):
+        if self.executor is None:
+            # Imported with the first image: multiprocessing is slow to load
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # Not forked: the parent has Tk and network threads
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return self.executor.submit(transcode, source, full, name=name, **self.options)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None